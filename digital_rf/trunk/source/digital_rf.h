@@ -47,6 +47,11 @@
 /* chunk size for rf_data_index */
 #define CHUNK_SIZE_RF_DATA_INDEX 100
 
+/* manifest of closed Hdf5 files in each subdirectory, see digital_rf_write_manifest */
+#define DIGITAL_RF_MANIFEST "rf_manifest.bin"
+#define MANIFEST_BASENAME_SIZE 32
+#define MANIFEST_RECORD_SIZE 72
+
 #define DIGITAL_RF_EPOCH "1970-01-01T00:00:00Z"
 #define DIGITAL_RF_TIME_DESCRIPTION "All times in this format are in number of samples since the epoch in the epoch attribute.  The first sample time will be sample_rate * UTC time at first sample.  Attribute init_utc_timestamp records this init UTC time so that a conversion to any other time is possible given the number of leapseconds difference at init_utc_timestamp.  Leapseconds that occur during data recording are included in the data."
 
@@ -85,6 +90,7 @@ typedef struct digital_rf_write_object {
 	int        next_index_avail;		/* the next available row in /rf_data_index */
 	int        marching_dots;           /* non-zero if marching dots desired when writing, 0 if not */
 	uint64_t   init_utc_timestamp;      /* unix time when channel init called - stored as attribute in each file */
+	char       rf_basename[SMALL_HDF5_STR]; /* basename of Hdf5 file presently opened */
 
 } Digital_rf_write_object;
 
@@ -131,6 +137,9 @@ void digital_rf_write_metadata(Digital_rf_write_object *hdf5_data_object);
 uint64_t * digital_rf_create_rf_data_index(Digital_rf_write_object *hdf5_data_object, uint64_t samples_written, uint64_t * global_index_arr,
 			uint64_t * data_index_arr, uint64_t index_len, int * rows_to_write);
 int digital_rf_write_rf_data_index(Digital_rf_write_object * hdf5_data_object, uint64_t * rf_data_index_arr, int block_index_len);
+int digital_rf_close_hdf5_file(Digital_rf_write_object *hdf5_data_object);
+int digital_rf_write_manifest(Digital_rf_write_object *hdf5_data_object, uint64_t * rf_data_index_arr, int rows,
+		                      uint64_t samples_written);
 uint64_t digital_rf_get_global_sample(uint64_t samples_written, uint64_t * global_index_arr, uint64_t * data_index_arr,
 		                              uint64_t index_len);
 int digital_rf_is_little_endian(void);
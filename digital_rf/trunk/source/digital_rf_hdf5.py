@@ -15,7 +15,12 @@ $Id: digital_rf_hdf5.py 813 2015-09-10 13:52:24Z brideout $
 import os, os.path, sys
 import types
 import glob
+import fnmatch
+import collections
+import multiprocessing.pool
+import threading
 import datetime, time
+import hashlib
 import warnings
 
 # third party imports
@@ -48,6 +53,79 @@ def get_unix_time(unix_sample_index, sample_rate):
     return((dt, picosecond))
 
 
+def _read_rf_data(rf_data, start_index, stop_index, subchannels=None):
+    """_read_rf_data is a private function that returns rows start_index to stop_index (excluded) of the /rf_data
+    dataset rf_data.  Only the columns in the list subchannels (all if None) are read by Hdf5, and are returned in
+    the order given.  Raises ValueError if a subchannel does not exist.
+    """
+    if subchannels is None:
+        return(rf_data[start_index:stop_index])
+    num_subchannels = rf_data.shape[1]
+    for subchannel in subchannels:
+        if subchannel < 0 or subchannel >= num_subchannels:
+            raise ValueError, 'Returned data has only %i subchannels, does not have subchannel %i' % (num_subchannels, subchannel)
+    columns = sorted(set(subchannels))
+    if columns[-1] - columns[0] + 1 == len(columns):
+        # a simple hyperslab
+        data = rf_data[start_index:stop_index, columns[0]:columns[-1] + 1]
+    else:
+        data = rf_data[start_index:stop_index, columns]
+    if columns != list(subchannels):
+        data = data[:, [columns.index(subchannel) for subchannel in subchannels]]
+    return(data)
+
+
+def _rf_file_key(rf_basename):
+    """_rf_file_key is a private function that returns the integer key of the rf file named rf_basename
+    (rf@<unix_seconds>.<milliseconds>.h5), unix_seconds*1000 + milliseconds.  Keys sort in time order.
+    """
+    seconds, milliseconds = rf_basename[3:-3].split('.')
+    return(long(seconds)*1000 + int(milliseconds))
+
+
+def _rf_file_keys(rf_basename_list):
+    """_rf_file_keys is a private function that returns a numpy int64 array of the keys (see _rf_file_key) of the
+    rf files named in rf_basename_list
+    """
+    return(numpy.array([_rf_file_key(rf_basename) for rf_basename in rf_basename_list], dtype=numpy.int64))
+
+
+def _rf_basename(rf_file_key):
+    """_rf_basename is a private function that returns the rf file basename with the key rf_file_key,
+    the inverse of _rf_file_key
+    """
+    seconds, milliseconds = divmod(long(rf_file_key), 1000)
+    return('rf@%i.%03i.h5' % (seconds, milliseconds))
+
+
+def _default_index_dir():
+    """_default_index_dir is a private function that returns the default directory of the metadata index files,
+    $XDG_CACHE_HOME/digital_rf, or ~/.cache/digital_rf if XDG_CACHE_HOME is not set
+    """
+    cache_dir = os.environ.get('XDG_CACHE_HOME', '')
+    if cache_dir == '':
+        cache_dir = os.path.join(os.path.expanduser('~'), '.cache')
+    return(os.path.join(cache_dir, 'digital_rf'))
+
+
+def _index_basename(channel_dir):
+    """_index_basename is a private function that returns the basename of the metadata index file of the full
+    path channel_dir.  The hash of the path keeps channels of different top level directories apart
+    """
+    return('rf_metadata_index_%s_%s.h5' % (os.path.basename(channel_dir), hashlib.md5(channel_dir).hexdigest()))
+
+
+def _read_rf_data_direct(rf_data, dest, source_sel, dest_sel):
+    """_read_rf_data_direct is a private function that reads the selection source_sel of rf_data (an h5py.Dataset or a
+    numpy.memmap from _file_pool.get_rf_data) into the selection dest_sel of the numpy array dest, which must have the
+    dtype of rf_data.  Hdf5 reads straight into dest, a memmap is copied from the page cache.
+    """
+    if isinstance(rf_data, numpy.ndarray):
+        dest[dest_sel] = rf_data[source_sel]
+    else:
+        rf_data.read_direct(dest, source_sel, dest_sel)
+
+
 class write_hdf5_channel:
     """The class write_hdf5_channel is an object used to write rf data to Hdf5 files as specified
     in the http://www.haystack.mit.edu/pipermail/rapid-dev/2014-February/000273.html email thread.
@@ -308,7 +386,8 @@ class read_hdf5:
     This class allows random access to the rf data.
     
     """
-    def __init__(self, top_level_directory_arg, load_all_metadata=False):
+    def __init__(self, top_level_directory_arg, load_all_metadata=False, file_pool_size=16, use_mmap=True,
+                 index_dir=None):
         """__init__ will verify the data in top_level_directory_arg is as expected.  It will analyze metadata
         to the degree specified in the load_all_metadata flag so that other methods can return more quickly
         
@@ -319,6 +398,17 @@ class read_hdf5:
                 level metadata for faster __init__ speed.   A basic rule of thumb:
                     **** use load_all_metadata=False to make __init__ faster   ****
                     **** use load_all_metadata=True to make read_vector faster, at the cost of slower __init__ ****
+                The complete metadata is stored in an index file in index_dir (if writable), so that
+                later complete updates only read rf files newer than that index.
+            file_pool_size - maximum number of rf files kept open between reads, shared by all channels.  Sliding
+                windows or interleaved reads of several channels then do not open and close a file for every read.
+                Default is 16.
+            use_mmap - if True (the default), rf_data stored uncompressed and contiguous (no compression or checksums
+                when written) is read through a numpy.memmap of the file instead of through Hdf5.  Chunked data is
+                always read by Hdf5.
+            index_dir - directory of the metadata index files, one per channel directory.  Default None is
+                $XDG_CACHE_HOME/digital_rf (~/.cache/digital_rf), outside the data, so that readers never write
+                into the recording and do not change the modification times of its directories.
             
         A top level directory must contain <channel_name>/<YYYY-MM-DDTHH-MM-SS/rf@<unix_seconds>.<%03i milliseconds>.h5
         
@@ -334,6 +424,16 @@ class read_hdf5:
         
         self._load_all_metadata - True if full metadata search required by default, False if minimal metadata.
         
+        self._file_pool - a _file_pool object holding the open rf files, used for all rf data reads.
+        
+        self._dir_cache - a _dir_listing_cache object holding the directory listings of the last reload, so that
+            reload and reads only list directories that changed since.
+        
+        self._thread_pool - a multiprocessing.pool.ThreadPool used by read_vectors and iter_blocks, or None until
+            first needed.
+        
+        self._index_dir - directory of the metadata index files.
+        
         self._last_update_has_full_metadata - True if last update got full metadata, False is last update got minimal
             metadata.  At init will equal self._load_all_metadata, but will be set to the load_all_metadata in reload
             when that method is called later.
@@ -364,6 +464,13 @@ class read_hdf5:
         
         self._load_all_metadata = load_all_metadata
         
+        self._file_pool = _file_pool(file_pool_size, use_mmap)
+        self._dir_cache = _dir_listing_cache()
+        self._thread_pool = None # created by the first read_vectors or iter_blocks
+        if index_dir is None:
+            index_dir = _default_index_dir()
+        self._index_dir = index_dir
+        
         self.reload()
         
         
@@ -399,6 +506,9 @@ class read_hdf5:
                 remove_keys.append(channel_name)
         if len(remove_keys):
             for remove_key in remove_keys:
+                for top_level_meta in self._channel_dict[remove_key].top_level_dir_meta_list:
+                    self._file_pool.invalidate_directory(os.path.join(top_level_meta.top_level_dir, remove_key))
+                    self._dir_cache.invalidate_directory(os.path.join(top_level_meta.top_level_dir, remove_key))
                 del self._channel_dict[remove_key] 
                 
                     
@@ -409,7 +519,10 @@ class read_hdf5:
                 top_level_dir_metadata_list = []
                 for top_level_dir in channel_dict[channel_name]:
                     new_top_level_metaddata = _top_level_dir_metadata(top_level_dir, channel_name,
-                                                                      self._top_level_dir_dict[top_level_dir])
+                                                                      self._top_level_dir_dict[top_level_dir],
+                                                                      file_pool=self._file_pool,
+                                                                      dir_cache=self._dir_cache,
+                                                                      index_dir=self._index_dir)
                     top_level_dir_metadata_list.append(new_top_level_metaddata)
                 top_level_dir_metadata_list.sort()
                 new_channel_metadata = _channel_metadata(channel_name, top_level_dir_meta_list = top_level_dir_metadata_list)
@@ -430,7 +543,10 @@ class read_hdf5:
                     if not found:
                         # this is a new top level
                         new_top_level_meta = _top_level_dir_metadata(top_level_dir, channel_name,
-                                                                     self._top_level_dir_dict[top_level_dir])
+                                                                     self._top_level_dir_dict[top_level_dir],
+                                                                     file_pool=self._file_pool,
+                                                                     dir_cache=self._dir_cache,
+                                                                     index_dir=self._index_dir)
                         chan_obj.add_top_level(new_top_level_meta)
                         found_dirs.append(top_level_dir)
                         
@@ -438,6 +554,8 @@ class read_hdf5:
                 for chan_top_dir in chan_obj.top_level_dir_meta_list:
                     if chan_top_dir.top_level_dir not in found_dirs:
                         # this top level dir no longer has data
+                        self._file_pool.invalidate_directory(os.path.join(chan_top_dir.top_level_dir, channel_name))
+                        self._dir_cache.invalidate_directory(os.path.join(chan_top_dir.top_level_dir, channel_name))
                         chan_obj.remove_top_level_metadata(chan_top_dir.top_level_dir)
                         
                 chan_obj.update(complete_update=load_all_metadata)
@@ -467,6 +585,36 @@ class read_hdf5:
         return(self._channel_dict[channel_name].metadata_dict)
     
     
+    def get_file_pool_stats(self):
+        """get_file_pool_stats returns a dictionary describing the pool of rf files kept open between reads, with keys:
+            open_files - number of files open now
+            max_size - file_pool_size set in init
+            hits - number of file reads that found the file already open
+            misses - number of file reads that had to open the file
+        """
+        return(self._file_pool.get_stats())
+    
+    
+    def get_dir_cache_stats(self):
+        """get_dir_cache_stats returns a dictionary describing the cached directory listings, with keys:
+            directories - number of directory listings cached now
+            hits - number of directory listings found unchanged since the last listing
+            listings - number of directories actually listed, because they were new or modified
+        """
+        return(self._dir_cache.get_stats())
+    
+    
+    def close(self):
+        """close closes all rf files kept open between reads, and stops the threads of read_vectors and iter_blocks.
+        This object can still be used afterwards, files are opened again as needed.
+        """
+        self._file_pool.clear()
+        if not self._thread_pool is None:
+            self._thread_pool.close()
+            self._thread_pool.join()
+            self._thread_pool = None
+    
+    
     
     def get_metadata(self, channel_name, timestamp=None):
         """get_metadata returns a h5py.File object pointing to the metadata*.h5 file at the top level of the 
@@ -544,7 +692,7 @@ class read_hdf5:
         
         
         
-    def read_vector(self, unix_sample, vector_length, channel_name):
+    def read_vector(self, unix_sample, vector_length, channel_name, subchannels=None):
         """read_vector returns a numpy vector of complex8 type, no matter the dtype of the Hdf5 file
         or the number of channels. Shape is (vector_length, num_subchannels). Single value (real) files will
         have the imaginary part set to zero.
@@ -558,11 +706,14 @@ class read_hdf5:
             
             channel_name - the channel name to use
         
+            subchannels - list of subchannels to read, in the order of the returned columns.  Default is None,
+                read all subchannels.
+        
         This method will raise an IOError error if the returned vector would include any missing data. 
         It will also raise an IOError is any of the files needed to read the data have been deleted.  
         This is possible because metadata on which this call is based might be out of date.
         """
-        z = self.read_vector_raw(unix_sample, vector_length, channel_name)
+        z = self.read_vector_raw(unix_sample, vector_length, channel_name, subchannels=subchannels)
             
         if z.dtype == numpy.complex64:
             return(z)
@@ -578,7 +729,7 @@ class read_hdf5:
                 
         
     
-    def read_vector_raw(self, unix_sample, vector_length, channel_name):
+    def read_vector_raw(self, unix_sample, vector_length, channel_name, fill_gaps=False, subchannels=None, copy=True):
         """read_vector_raw returns a numpy array of dim(up to num_samples, num_subchannels) of the dtype in the Hdf5 files.
         
         If complex data, real and imag data will have names 'r' and 'i' if underlying data are integers 
@@ -591,7 +742,17 @@ class read_hdf5:
             
             channel_name - the channel name to use
         
-        This method will raise an IOError error if the returned vector would include any missing data. 
+            fill_gaps - if False (the default), missing data is an error.  If True, a numpy masked array of
+                dim(vector_length, num_subchannels) is returned, where missing samples are masked.
+        
+            subchannels - list of subchannels to read, in the order of the returned columns.  Only these are
+                read from the Hdf5 files.  Default is None, read all subchannels.
+                
+            copy - if True (the default), the returned array is always a new array.  If False, data within one
+                memory mapped file (see use_mmap in __init__) is returned as a read only view of the file.
+        
+        This method will raise an IOError error if the returned vector would include any missing data (unless
+        fill_gaps, in which case only if there is no data at all). 
         It will also raise an IOError is any of the files needed to read the data have been deleted.  
         This is possible because metadata on which this call is based might be out of date.
         """
@@ -602,6 +763,9 @@ class read_hdf5:
         unix_sample = long(unix_sample)
         vector_length = long(vector_length)
         
+        if fill_gaps:
+            return(self._read_vector_masked(unix_sample, vector_length, channel_name, subchannels))
+        
         channel_metadata = self._channel_dict[channel_name]
         
         ret_array = None
@@ -625,7 +789,8 @@ class read_hdf5:
             this_array, this_unix_sample = top_level_dir.get_continuous_vector(max(unix_sample, top_level_dir.unix_start_sample),
                                                                                min(unix_sample + vector_length, 
                                                                                    top_level_dir.unix_start_sample + top_level_dir.sample_extent),
-                                                                               self._last_update_has_full_metadata)
+                                                                               self._last_update_has_full_metadata,
+                                                                               subchannels)
             ret_array = self._combine_continuous_vectors(ret_array, this_array, first_unix_sample, this_unix_sample)
             if first_unix_sample is None:
                 first_unix_sample = unix_sample
@@ -636,13 +801,18 @@ class read_hdf5:
             
         if len(ret_array) != vector_length:
             raise IOError, 'Requested %i samples, but only found %i' % (vector_length, len(ret_array))
+        
+        if copy and not ret_array.flags.writeable:
+            # a view of a read only memmap
+            ret_array = numpy.array(ret_array)
                 
         return(ret_array)
         
         
-    def read_vector_c81d(self, unix_sample, vector_length, channel_name, subchannel=0):
+    def read_vector_c81d(self, unix_sample, vector_length, channel_name, subchannel=0, fill_gaps=False):
         """read_vector_c81d returns a numpy vector of complex8 type, no matter the dtype of the Hdf5 file
-        or the number of channels. Error thrown if subchannel doesn't exist.
+        or the number of channels. Error thrown if subchannel doesn't exist.  Only the requested subchannels
+        are read from the Hdf5 files.
         
         Inputs:
             unix_sample - the number of samples since 1970-01-01 at start of data
@@ -651,23 +821,29 @@ class read_hdf5:
             
             channel_name - the channel name to use
             
-            subchannel - which subchannel to use.  Default is 0 (first)
+            subchannel - which subchannel to use.  Default is 0 (first).  May also be a list of subchannels,
+                in which case the returned array has shape (vector_length, len(subchannel)).
         
-        This method will raise an IOError error if the returned vector would include any missing data. 
+            fill_gaps - if False (the default), missing data is an error.  If True, missing samples are set to nan.
+        
+        This method will raise an IOError error if the returned vector would include any missing data (unless fill_gaps). 
         It will also raise an IOError is any of the files needed to read the data have been deleted.  
         This is possible because metadata on which this call is based might be out of date.
         """
-        z = self.read_vector_raw(unix_sample, vector_length, channel_name)
-            
-        if z.shape[1] < subchannel + 1:
-            raise ValueError, 'Returned data has only %i subchannels, does not have subchannel %i' % (z.shape[1], subchannel)
+        if fill_gaps:
+            return(self._read_vector_complex(unix_sample, vector_length, channel_name, subchannel, numpy.complex64, True))
+        
+        if numpy.ndim(subchannel) == 0:
+            z = self.read_vector_raw(unix_sample, vector_length, channel_name, subchannels=[subchannel])[:,0]
+        else:
+            z = self.read_vector_raw(unix_sample, vector_length, channel_name, subchannels=subchannel)
         
         if z.dtype == numpy.complex64:
-            return(z[:,subchannel])
+            return(z)
         elif z.dtype in (numpy.complex128, numpy.complex256):
-            return(numpy.array(z[:,subchannel], dtype=numpy.complex64))
+            return(numpy.array(z, dtype=numpy.complex64))
         
-        slice = (z[:,subchannel])
+        slice = z
         if not hasattr(slice.dtype, 'names'):
             raise ValueError, 'Single valued channels cannot be cast to complex'
         elif slice.dtype.names is None:
@@ -676,7 +852,296 @@ class read_hdf5:
         return(slice)
         
         
+    def read_vector_c16d(self, unix_sample, vector_length, channel_name, subchannel=0, fill_gaps=False):
+        """read_vector_c16d returns a numpy vector of complex16 type (numpy.complex128), no matter the dtype of the Hdf5 file
+        or the number of channels. Error thrown if subchannel doesn't exist.
+        
+        Unlike read_vector_c81d, double precision complex data is read by Hdf5 straight into the returned
+        vector, with no conversion and no intermediate copies, so no precision is lost.
+        
+        Inputs:
+            unix_sample - the number of samples since 1970-01-01 at start of data
+            
+            vector_length - the number of continuous samples to include
+            
+            channel_name - the channel name to use
+            
+            subchannel - which subchannel to use.  Default is 0 (first).  May also be a list of subchannels,
+                in which case the returned array has shape (vector_length, len(subchannel)).
+        
+            fill_gaps - if False (the default), missing data is an error.  If True, missing samples are set to nan.
+        
+        This method will raise an IOError error if the returned vector would include any missing data (unless fill_gaps). 
+        It will also raise an IOError is any of the files needed to read the data have been deleted.  
+        This is possible because metadata on which this call is based might be out of date.
+        """
+        return(self._read_vector_complex(unix_sample, vector_length, channel_name, subchannel, numpy.complex128, fill_gaps))
+        
+        
+    def read_vector_into(self, out, unix_sample, channel_name, subchannel=None, fill_gaps=False):
+        """read_vector_into reads len(out) continuous samples into the caller supplied numpy array out, and returns the
+        number of samples found.  All files needed are planned from the metadata first, and each continuous piece is
+        then read straight into its slice of out.  If out has the dtype of the Hdf5 files, Hdf5 reads directly into it,
+        with no intermediate arrays.  A streaming reader can reuse one out array for all its reads.
+        
+        Inputs:
+            out - numpy array to read into.  Shape must be (vector_length, num_subchannels) if subchannel is None,
+                (vector_length, len(subchannel)) if subchannel is a list, or (vector_length,) otherwise.  dtype is either the dtype in the Hdf5 files (see read_vector_raw),
+                or a complex dtype, in which case data is converted as in read_vector_c81d.
+            
+            unix_sample - the number of samples since 1970-01-01 at start of data
+            
+            channel_name - the channel name to use
+            
+            subchannel - which subchannel to read, or a list of subchannels.  Default is None, read all subchannels
+            
+            fill_gaps - if False (the default), missing data is an error, and out is not changed.  If True, missing
+                samples are set to nan (zero if out is an integer dtype).
+        
+        This method will raise an IOError error if any data is missing (unless fill_gaps), or if any of the files
+        needed to read the data have been deleted.  Raises ValueError if out does not match the data.
+        """
+        vector_length = len(out)
+        if vector_length < 1:
+            raise IOError, 'Number of samples requested must be greater than 0, not %i' % (vector_length)
+        if subchannel is None and len(out.shape) != 2:
+            raise ValueError, 'out must have shape (vector_length, num_subchannels) to read all subchannels'
+        elif subchannel is not None and numpy.ndim(subchannel) == 1 and out.shape[1:] != (len(subchannel),):
+            raise ValueError, 'out must have shape (vector_length, %i) to read subchannels %s' % (len(subchannel), str(subchannel))
+        elif subchannel is not None and numpy.ndim(subchannel) == 0 and len(out.shape) != 1:
+            raise ValueError, 'out must have shape (vector_length,) to read subchannel %i' % (subchannel)
+        
+        # make sure everything is a long
+        unix_sample = long(unix_sample)
+        vector_length = long(vector_length)
+        
+        read_plan = self._get_read_plan(unix_sample, unix_sample + vector_length, channel_name)
+        samples_found = sum([read_len for full_hdf5_file, start_file_index, read_len, this_unix_sample in read_plan])
+        
+        if samples_found != vector_length:
+            if not fill_gaps:
+                raise IOError, 'Requested %i samples, but only found %i' % (vector_length, samples_found)
+            if out.dtype.names is not None or out.dtype.kind in ('i', 'u'):
+                out[...] = numpy.zeros((), dtype=out.dtype)
+            else:
+                out[...] = numpy.nan
+        self._read_plan_into(out, read_plan, unix_sample, subchannel)
+        return(samples_found)
+        
+        
+    def read_vectors(self, channel_names, unix_sample, vector_length, subchannel=0, dtype=numpy.complex64,
+                     fill_gaps=False, as_dict=False):
+        """read_vectors reads the same vector_length samples starting at unix_sample from several channels, each
+        channel in its own thread.  Returns a numpy array of complex type dtype and shape (len(channel_names),
+        vector_length), where row i is the data of channel_names[i], or a dictionary with key = channel name, value =
+        that row if as_dict.  Each row is the same as read_vector_c81d (or read_vector_c16d) would return.
+        
+        All channels are planned from the metadata first, so that a channel not covering the interval raises before
+        anything is read.  Copies from memory mapped files (see use_mmap in __init__) and the conversion to complex
+        release the python global interpreter lock, so that they overlap between channels.  Reads by Hdf5 do not.
+        
+        Inputs:
+            channel_names - list of channel names to read
+            
+            unix_sample - the number of samples since 1970-01-01 at start of data
+            
+            vector_length - the number of continuous samples to include
+            
+            subchannel - which subchannel to use.  Default is 0 (first).  May also be a list of subchannels,
+                in which case each row has shape (vector_length, len(subchannel)).
+            
+            dtype - complex numpy dtype of returned data.  Default is numpy.complex64.
+            
+            fill_gaps - if False (the default), missing data in any channel is an error.  If True, missing samples
+                are set to nan.
+            
+            as_dict - if True, return a dictionary of channel name to data instead of one array.  Default is False.
+        
+        This method will raise an IOError error if any channel is missing data (unless fill_gaps), naming those
+        channels, or if any of the files needed to read the data have been deleted.
+        """
+        if vector_length < 1:
+            raise IOError, 'Number of samples requested must be greater than 0, not %i' % (vector_length)
+        unix_sample = long(unix_sample)
+        vector_length = long(vector_length)
+        
+        # first pass - plan every channel, and check all cover the interval
+        read_plans = []
+        missing_channels = []
+        for channel_name in channel_names:
+            read_plan = self._get_read_plan(unix_sample, unix_sample + vector_length, channel_name)
+            samples_found = sum([read_len for full_hdf5_file, start_file_index, read_len, this_unix_sample in read_plan])
+            if samples_found != vector_length:
+                missing_channels.append('%s (%i samples)' % (channel_name, samples_found))
+            read_plans.append(read_plan)
+        if len(missing_channels) and not fill_gaps:
+            raise IOError, 'Requested %i samples at %i, but only found %s' % (vector_length, unix_sample,
+                                                                             ', '.join(missing_channels))
+        
+        ret_array = numpy.empty((len(channel_names), vector_length) + numpy.shape(subchannel), dtype=dtype)
+        if len(missing_channels):
+            ret_array[...] = numpy.nan
+        
+        # second pass - read every channel in its own thread
+        full_hdf5_files = set()
+        for read_plan in read_plans:
+            full_hdf5_files.update([piece[0] for piece in read_plan])
+        read_args = [(ret_array[i], read_plans[i], unix_sample, subchannel) for i in range(len(channel_names))]
+        if len(channel_names) < 2 or len(full_hdf5_files) > self._file_pool.max_size:
+            # also read in this thread if the pool could close a file one thread is still reading
+            for args in read_args:
+                self._read_plan_into(*args)
+        else:
+            self._get_thread_pool(len(channel_names)).map(self._read_plan_into_args, read_args, 1)
+        
+        if as_dict:
+            return(dict([(channel_names[i], ret_array[i]) for i in range(len(channel_names))]))
+        return(ret_array)
+        
+        
     
+    def read_windows(self, channel_name, unix_starts, vector_length, subchannel=0, dtype=numpy.complex64):
+        """read_windows returns a tuple of (data, valid) for many windows of vector_length samples of one channel.
+        data is a numpy array of complex type dtype and shape (len(unix_starts), vector_length), valid is a numpy bool
+        array of the same shape that is True where data was found.  Missing data is left as zero and is not an error.
+
+        All windows are planned from the metadata first, and the reads are then grouped by file so that
+        each Hdf5 file is opened only once, no matter how many windows fall into it.
+
+        Inputs:
+            channel_name - the channel name to use
+
+            unix_starts - sequence of unix samples (samples since 1970-01-01) at the start of each window
+
+            vector_length - the number of continuous samples in each window
+
+            subchannel - which subchannel to use.  Default is 0 (first)
+
+            dtype - complex numpy dtype of returned data.  Default is numpy.complex64.  Use numpy.complex128
+                to keep the full precision of double precision channels.
+        """
+        if vector_length < 1:
+            raise IOError, 'Number of samples requested must be greater than 0, not %i' % (vector_length)
+        vector_length = long(vector_length)
+        unix_starts = [long(unix_sample) for unix_sample in unix_starts]
+
+        ret_array = numpy.zeros((len(unix_starts), vector_length), dtype=dtype)
+        valid = numpy.zeros((len(unix_starts), vector_length), dtype=numpy.bool_)
+
+        # first pass - plan all windows, grouping the reads by file
+        file_dict = {} # key = full path to Hdf5 file, value = list of (window, window offset, file index, read len)
+        checked_subdirectories = set()
+        for window, unix_sample in enumerate(unix_starts):
+            read_plan = self._get_read_plan(unix_sample, unix_sample + vector_length, channel_name,
+                                            checked_subdirectories)
+            for full_hdf5_file, start_file_index, read_len, this_unix_sample in read_plan:
+                if not file_dict.has_key(full_hdf5_file):
+                    file_dict[full_hdf5_file] = []
+                file_dict[full_hdf5_file].append((window, this_unix_sample - unix_sample, start_file_index, read_len))
+
+        # second pass - open each file once, and read every window that needs it
+        full_hdf5_files = file_dict.keys()
+        full_hdf5_files.sort()
+        for full_hdf5_file in full_hdf5_files:
+            try:
+                rf_data = self._file_pool.get_rf_data(full_hdf5_file)
+            except IOError:
+                # file deleted since metadata was read - leave these samples invalid
+                continue
+            if rf_data.shape[1] < subchannel + 1:
+                raise ValueError, 'Returned data has only %i subchannels, does not have subchannel %i' % (rf_data.shape[1], subchannel)
+            for window, offset, start_file_index, read_len in file_dict[full_hdf5_file]:
+                z = rf_data[start_file_index:start_file_index + read_len, subchannel]
+                ret_array[window, offset:offset + read_len] = self._convert_to_complex(z, dtype)
+                valid[window, offset:offset + read_len] = True
+
+        return((ret_array, valid))
+
+
+    def iter_blocks(self, channel_name, start_unix_sample, stop_unix_sample, block_len, prefetch=2, subchannel=0,
+                    dtype=numpy.complex64, gaps='raise'):
+        """iter_blocks is a generator that yields a tuple of (unix_sample, data) for each block of block_len samples
+        between (start_unix_sample, stop_unix_sample) (excludes stop_unix_sample), in time order.  The last block is
+        shorter if needed.  data is a new numpy array of complex type dtype, as returned by read_vector_c81d.
+        
+        While the caller processes one block, the next prefetch blocks are read by the threads of self._thread_pool,
+        so that processing overlaps with disk reads, Hdf5 decompression and conversion.  Blocks are only read ahead
+        as long as all the files being read fit in the pool of open files, a block with more files than that is read
+        when it is reached.  This object should not be reloaded, or read from by other calls, while iterating.
+        
+        Inputs:
+            channel_name - the channel name to use
+            
+            start_unix_sample, stop_unix_sample - only samples between (start_unix_sample, stop_unix_sample)
+                (excludes stop_unix_sample) will be returned.  Value of both are samples since 1970-01-01
+            
+            block_len - number of samples in each block
+            
+            prefetch - number of blocks read ahead.  Default is 2.  If 0, all blocks are read in the calling thread.
+            
+            subchannel - which subchannel to use, or a list of subchannels, or None for all subchannels.
+                Default is 0 (first)
+            
+            dtype - complex numpy dtype of returned data.  Default is numpy.complex64.
+            
+            gaps - how blocks with missing data are handled:
+                'raise' - the default, IOError is raised when that block is reached
+                'fill' - missing samples are set to nan
+                'skip' - only blocks with no missing data are returned
+        """
+        if block_len < 1:
+            raise IOError, 'Number of samples requested must be greater than 0, not %i' % (block_len)
+        if gaps not in ('raise', 'fill', 'skip'):
+            raise ValueError, 'gaps must be raise, fill or skip, not %s' % (str(gaps))
+        if prefetch < 0:
+            raise ValueError, 'prefetch must not be negative, not %i' % (prefetch)
+        start_unix_sample = long(start_unix_sample)
+        stop_unix_sample = long(stop_unix_sample)
+        block_len = long(block_len)
+        if subchannel is None:
+            num_subchannels = numpy.ravel(self._channel_dict[channel_name].metadata_dict['num_subchannels'])[0]
+            subchannel = range(int(num_subchannels))
+        
+        thread_pool = None
+        if prefetch > 0:
+            thread_pool = self._get_thread_pool(prefetch)
+        # [unix_sample, block_len, read_plan, set of files, AsyncResult or None until submitted] of blocks planned
+        pending = collections.deque()
+        checked_subdirectories = set()
+        try:
+            next_unix_sample = start_unix_sample
+            while next_unix_sample < stop_unix_sample or len(pending):
+                # plan up to prefetch blocks after the one returned next
+                while next_unix_sample < stop_unix_sample and len(pending) <= prefetch:
+                    this_len = min(block_len, stop_unix_sample - next_unix_sample)
+                    read_plan = self._get_read_plan(next_unix_sample, next_unix_sample + this_len, channel_name,
+                                                    checked_subdirectories)
+                    pending.append([next_unix_sample, this_len, read_plan, set([piece[0] for piece in read_plan]),
+                                    None])
+                    next_unix_sample += this_len
+                if not thread_pool is None:
+                    # start reading planned blocks in order, as long as the pool will not close a file being read
+                    files_in_flight = set()
+                    for block in pending:
+                        if block[4] is None:
+                            if len(files_in_flight | block[3]) > self._file_pool.max_size:
+                                break
+                            block[4] = thread_pool.apply_async(self._read_block, (block[2], block[0], block[1],
+                                                                                   subchannel, dtype, gaps))
+                        files_in_flight |= block[3]
+                unix_sample, this_len, read_plan, full_hdf5_files, result = pending.popleft()
+                if result is None:
+                    data = self._read_block(read_plan, unix_sample, this_len, subchannel, dtype, gaps)
+                else:
+                    data = result.get()
+                if not data is None:
+                    yield((unix_sample, data))
+        finally:
+            # blocks still being read use pooled files
+            for block in pending:
+                if not block[4] is None:
+                    block[4].wait()
+
     
     
     def _get_continuous_blocks(self, start_unix_sample, stop_unix_sample, channel_name):
@@ -714,6 +1179,188 @@ class read_hdf5:
                                                                                stop_unix_sample)
             
         return(ret_array)
+
+
+
+    def _get_read_plan(self, start_unix_sample, stop_unix_sample, channel_name, checked_subdirectories=None):
+        """_get_read_plan is a private method that returns a list of (full_hdf5_file, start_file_index, read_len, unix_sample)
+        tuples, one for each continuous piece of data found between (start_unix_sample, stop_unix_sample) (excludes
+        stop_unix_sample), in time order.  No rf data is read.  Samples with no data are simply not in the plan.
+
+        Inputs:
+            start_unix_sample, stop_unix_sample - only samples between (start_unix_sample, stop_unix_sample)
+                (excludes stop_unix_sample) will be planned.  Value of both are samples since 1970-01-01
+
+            channel_name - channel to examine
+
+            checked_subdirectories - a set of subdirectories already verified to be up to date, to allow many calls
+                to share one check.  Updated by this method.  If None (the default), every subdirectory is checked.
+        """
+        channel_metadata = self._channel_dict[channel_name]
+
+        read_plan = []
+        for top_level_dir in channel_metadata.top_level_dir_meta_list:
+            if top_level_dir.unix_start_sample + top_level_dir.sample_extent <= start_unix_sample:
+                # this top level dir is too early
+                continue
+            if stop_unix_sample <= top_level_dir.unix_start_sample:
+                # this top level dir is too late
+                continue
+            read_plan += top_level_dir.get_read_plan(max(start_unix_sample, top_level_dir.unix_start_sample),
+                                                     min(stop_unix_sample,
+                                                         top_level_dir.unix_start_sample + top_level_dir.sample_extent),
+                                                     checked_subdirectories)
+        return(read_plan)
+
+
+
+    def _read_vector_complex(self, unix_sample, vector_length, channel_name, subchannel, dtype, fill_gaps):
+        """_read_vector_complex returns a numpy vector of complex type dtype of one subchannel (or an array of
+        shape (vector_length, len(subchannel)) if subchannel is a list), read with read_vector_into.  Raises IOError if any data is missing, unless fill_gaps, in which case missing
+        samples are set to nan.
+        """
+        if vector_length < 1:
+            raise IOError, 'Number of samples requested must be greater than 0, not %i' % (vector_length)
+        
+        ret_array = numpy.empty((long(vector_length),) + numpy.shape(subchannel), dtype=dtype)
+        self.read_vector_into(ret_array, unix_sample, channel_name, subchannel, fill_gaps)
+        return(ret_array)
+    
+    
+    def _read_vector_masked(self, unix_sample, vector_length, channel_name, subchannels=None):
+        """_read_vector_masked returns a numpy masked array of dim(vector_length, num_subchannels) of the dtype in the
+        Hdf5 files, where missing samples are masked.  Only the continuous pieces of data are read, directly into the
+        returned array.  If subchannels is a list, only those subchannels are read, and the returned array has
+        dim(vector_length, len(subchannels)).  Raises IOError if no data found, or if a file has been deleted.
+        """
+        read_plan = self._get_read_plan(unix_sample, unix_sample + vector_length, channel_name)
+        if len(read_plan) == 0:
+            raise IOError, 'No data found for channel %s between %i and %i' % (channel_name, unix_sample, 
+                                                                               unix_sample + vector_length)
+        ret_array = None
+        for full_hdf5_file, start_file_index, read_len, this_unix_sample in read_plan:
+            try:
+                rf_data = self._file_pool.get_rf_data(full_hdf5_file)
+            except IOError:
+                raise IOError, 'File %s deleted since metadata was read' % (full_hdf5_file)
+            if ret_array is None:
+                if subchannels is None:
+                    num_columns = rf_data.shape[1]
+                else:
+                    num_columns = len(subchannels)
+                ret_array = numpy.zeros((vector_length, num_columns), dtype=rf_data.dtype)
+                mask = numpy.ones((vector_length, num_columns), dtype=numpy.bool_)
+            offset = this_unix_sample - unix_sample
+            if subchannels is None:
+                _read_rf_data_direct(rf_data, ret_array, numpy.s_[start_file_index:start_file_index + read_len],
+                                     numpy.s_[offset:offset + read_len])
+            else:
+                ret_array[offset:offset + read_len] = _read_rf_data(rf_data, start_file_index, start_file_index + read_len,
+                                                                    subchannels)
+            mask[offset:offset + read_len] = False
+        return(numpy.ma.array(ret_array, mask=mask))
+
+
+    def _read_plan_into(self, ret_array, read_plan, unix_sample, subchannel):
+        """_read_plan_into reads every piece of read_plan (as returned by _get_read_plan) of one subchannel into the
+        numpy vector ret_array, or of all subchannels (if subchannel is None) into the numpy array ret_array of shape
+        (N, num_subchannels), or of a list of subchannels into the numpy array ret_array of shape (N, len(subchannel)),
+        where ret_array[0] is at unix_sample.  If the data in a file has the same dtype as
+        ret_array, Hdf5 reads it directly into ret_array.  Otherwise ret_array must be complex, and the data is
+        converted with _convert_to_complex.
+        
+        Raises IOError if a file in read_plan has been deleted, ValueError if subchannel does not exist or if
+        ret_array does not match the data.
+        """
+        for full_hdf5_file, start_file_index, read_len, this_unix_sample in read_plan:
+            try:
+                rf_data = self._file_pool.get_rf_data(full_hdf5_file)
+            except IOError:
+                raise IOError, 'File %s deleted since metadata was read' % (full_hdf5_file)
+            if subchannel is None:
+                if rf_data.shape[1] != ret_array.shape[1]:
+                    raise ValueError, 'Data has %i subchannels, but array to read into has %i' % (rf_data.shape[1],
+                                                                                                  ret_array.shape[1])
+                source_sel = numpy.s_[start_file_index:start_file_index + read_len]
+            elif numpy.ndim(subchannel) == 1:
+                # only the listed subchannels are read, but not directly into ret_array
+                z = _read_rf_data(rf_data, start_file_index, start_file_index + read_len, subchannel)
+                offset = this_unix_sample - unix_sample
+                if z.dtype == ret_array.dtype:
+                    ret_array[offset:offset + read_len] = z
+                elif ret_array.dtype.kind == 'c':
+                    ret_array[offset:offset + read_len] = self._convert_to_complex(z, ret_array.dtype)
+                else:
+                    raise ValueError, 'Cannot read data of dtype %s into array of dtype %s' % (str(z.dtype),
+                                                                                             str(ret_array.dtype))
+                continue
+            elif rf_data.shape[1] < subchannel + 1:
+                raise ValueError, 'Returned data has only %i subchannels, does not have subchannel %i' % (rf_data.shape[1], subchannel)
+            else:
+                source_sel = numpy.s_[start_file_index:start_file_index + read_len, subchannel]
+            offset = this_unix_sample - unix_sample
+            if rf_data.dtype == ret_array.dtype:
+                _read_rf_data_direct(rf_data, ret_array, source_sel, numpy.s_[offset:offset + read_len])
+            elif ret_array.dtype.kind == 'c':
+                ret_array[offset:offset + read_len] = self._convert_to_complex(rf_data[source_sel], ret_array.dtype)
+            else:
+                raise ValueError, 'Cannot read data of dtype %s into array of dtype %s' % (str(rf_data.dtype),
+                                                                                         str(ret_array.dtype))
+
+
+
+    def _get_thread_pool(self, num_threads):
+        """_get_thread_pool returns self._thread_pool, created (or replaced by a larger one) so that it has at least
+        num_threads threads.  A replaced pool finishes the tasks it was given.
+        """
+        if not self._thread_pool is None and self._thread_pool._processes < num_threads:
+            self._thread_pool.close()
+            self._thread_pool = None
+        if self._thread_pool is None:
+            self._thread_pool = multiprocessing.pool.ThreadPool(num_threads)
+        return(self._thread_pool)
+        
+        
+    def _read_plan_into_args(self, args):
+        """_read_plan_into_args calls _read_plan_into with the tuple args, for multiprocessing.pool.ThreadPool.map
+        """
+        self._read_plan_into(*args)
+        
+        
+    def _read_block(self, read_plan, unix_sample, block_len, subchannel, dtype, gaps):
+        """_read_block returns a new numpy array of complex type dtype with block_len samples starting at unix_sample,
+        read from read_plan.  Used by iter_blocks, gaps is as defined there.  Returns None if gaps is 'skip' and data
+        is missing.
+        """
+        samples_found = sum([read_len for full_hdf5_file, start_file_index, read_len, this_unix_sample in read_plan])
+        data = numpy.empty((block_len,) + numpy.shape(subchannel), dtype=dtype)
+        if samples_found != block_len:
+            if gaps == 'skip':
+                return(None)
+            elif gaps == 'raise':
+                raise IOError, 'Requested %i samples at %i, but only found %i' % (block_len, unix_sample, samples_found)
+            data[...] = numpy.nan
+        self._read_plan_into(data, read_plan, unix_sample, subchannel)
+        return(data)
+
+
+    def _convert_to_complex(self, z, dtype=numpy.complex64):
+        """_convert_to_complex returns the numpy array z as complex data of type dtype.  Data stored as r/i columns
+        is combined.  Raises ValueError if z is single valued.
+        """
+        if z.dtype == dtype:
+            return(z)
+        elif z.dtype in (numpy.complex64, numpy.complex128, numpy.complex256):
+            return(numpy.array(z, dtype=dtype))
+
+        if not hasattr(z.dtype, 'names'):
+            raise ValueError, 'Single valued channels cannot be cast to complex'
+        elif z.dtype.names is None:
+            raise ValueError, 'Single valued channels cannot be cast to complex'
+        ret_array = numpy.empty(z.shape, dtype=dtype)
+        ret_array.real = z['r']
+        ret_array.imag = z['i']
+        return(ret_array)
     
     
     
@@ -781,16 +1428,243 @@ class read_hdf5:
             raise ValueError, 'access_mode %s not yet implemented' % (access_mode)
         
         if access_mode == 'local':
-            potential_channels = glob.glob(os.path.join(top_level_dir, '*', sub_directory_glob))
-            for potential_channel in potential_channels:
-                channel_name = os.path.dirname(potential_channel)
-                if channel_name not in retList:
-                    retList.append(channel_name)
+            for potential_channel in self._dir_cache.listdir(top_level_dir, '*'):
+                if len(self._dir_cache.listdir(potential_channel, sub_directory_glob)) > 0:
+                    retList.append(potential_channel)
                     
         return(retList)
     
  
     
+class _file_pool:
+    """The _file_pool is a private class that keeps a size limited pool of open read only h5py.File objects,
+    keyed by full path, so that repeated reads of the same files do not each pay for an open and close.  When
+    the pool is full, the least recently used file is closed.  A pooled file is reopened if it was modified
+    or replaced since it was opened, and closed if it has been deleted.  get, get_rf_data and get_with_rf_data may
+    be called from several threads.
+    """
+    
+    def __init__(self, max_size=16, use_mmap=True):
+        """__init__ creates a new, empty _file_pool
+        
+        Inputs:
+            max_size - maximum number of open files.  Must be at least 1.
+            
+            use_mmap - if True (the default), get_rf_data memory maps uncompressed contiguous rf_data datasets.
+            
+        Affects: creates self.max_size, self.use_mmap, and self.hits and self.misses, the number of calls to get that
+            found the file already open and that had to open it.
+        """
+        if max_size < 1:
+            raise ValueError, 'file pool size must be at least 1, not %i' % (max_size)
+        self.max_size = int(max_size)
+        self.use_mmap = use_mmap
+        self.hits = 0
+        self.misses = 0
+        self._files = collections.OrderedDict() # key = full path, value = [h5py.File, (inode, mtime, size) when opened,
+                                                #                          rf_data from get_rf_data or None]
+        self._lock = threading.Lock() # held by get and get_with_rf_data
+        
+        
+    def get(self, full_hdf5_file):
+        """get returns an open h5py.File for full_hdf5_file, opening it if needed.  The file belongs to the pool
+        and must not be closed by the caller.  Raises IOError if the file does not exist or cannot be opened.
+        """
+        self._lock.acquire()
+        try:
+            return(self._get(full_hdf5_file))
+        finally:
+            self._lock.release()
+    
+    
+    def get_rf_data(self, full_hdf5_file):
+        """get_rf_data returns the /rf_data dataset of full_hdf5_file, opening the file if needed.  If use_mmap and the
+        dataset is stored uncompressed and contiguous in the file, a read only numpy.memmap of it is returned, so that
+        reads are numpy slicing of the page cache.  Otherwise the h5py.Dataset is returned.  Both are indexed the same
+        way.  Raises IOError if the file does not exist or cannot be opened.
+        """
+        return(self.get_with_rf_data(full_hdf5_file)[1])
+    
+    
+    def get_with_rf_data(self, full_hdf5_file):
+        """get_with_rf_data returns the tuple (h5py.File, rf_data) for full_hdf5_file, as returned by get and get_rf_data,
+        with a single lookup in the pool.  Raises IOError if the file does not exist or cannot be opened.
+        """
+        self._lock.acquire()
+        try:
+            f = self._get(full_hdf5_file)
+            entry = self._files[full_hdf5_file]
+            if entry[2] is None:
+                rf_data = f['/rf_data']
+                if self.use_mmap:
+                    entry[2] = self._get_memmap(full_hdf5_file, rf_data, entry[1][2])
+                else:
+                    entry[2] = rf_data
+            return((f, entry[2]))
+        finally:
+            self._lock.release()
+    
+    
+    def _get(self, full_hdf5_file):
+        """_get is get without taking the lock
+        """
+        try:
+            st = os.stat(full_hdf5_file)
+        except OSError:
+            self.invalidate(full_hdf5_file)
+            raise IOError, 'File %s not found' % (full_hdf5_file)
+        stamp = (st.st_ino, st.st_mtime, st.st_size)
+        if self._files.has_key(full_hdf5_file):
+            entry = self._files.pop(full_hdf5_file)
+            if entry[1] == stamp:
+                self._files[full_hdf5_file] = entry
+                self.hits += 1
+                return(entry[0])
+            # Hdf5 caches what it has read, so a file written since it was opened must be reopened
+            self._close(entry[0])
+        self.misses += 1
+        f = h5py.File(full_hdf5_file, 'r')
+        self._files[full_hdf5_file] = [f, stamp, None]
+        while len(self._files) > self.max_size:
+            self._close(self._files.popitem(last=False)[1][0])
+        return(f)
+    
+    
+    def invalidate(self, full_hdf5_file):
+        """invalidate closes full_hdf5_file if it is in the pool.  Must be called before the file is opened other than
+        through the pool, since Hdf5 would share the pooled file and the data it has cached
+        """
+        if self._files.has_key(full_hdf5_file):
+            self._close(self._files.pop(full_hdf5_file)[0])
+            
+            
+    def invalidate_directory(self, directory, keep_list=None):
+        """invalidate_directory closes all pooled files in directory or its subdirectories, except those
+        in keep_list (a list of full paths) if given
+        """
+        prefix = os.path.join(directory, '')
+        if keep_list is None:
+            keep_list = []
+        keep_set = set(keep_list)
+        for full_hdf5_file in self._files.keys():
+            if full_hdf5_file.startswith(prefix) and full_hdf5_file not in keep_set:
+                self.invalidate(full_hdf5_file)
+                
+                
+    def clear(self):
+        """clear closes all pooled files.  Hit and miss counts are kept.
+        """
+        while len(self._files):
+            self._close(self._files.popitem(last=False)[1][0])
+            
+            
+    def get_stats(self):
+        """get_stats returns a dictionary with keys 'open_files', 'max_size', 'hits', and 'misses'
+        """
+        return({'open_files': len(self._files), 'max_size': self.max_size, 'hits': self.hits, 'misses': self.misses})
+    
+    
+    def _close(self, f):
+        """_close closes f, ignoring errors from a file that is already closed or deleted
+        """
+        try:
+            f.close()
+        except:
+            pass
+            
+            
+    def _get_memmap(self, full_hdf5_file, rf_data, file_size):
+        """_get_memmap returns a read only numpy.memmap of the h5py.Dataset rf_data in full_hdf5_file of size file_size,
+        or rf_data itself if it is chunked (and so maybe compressed or checksummed), not yet allocated, or not stored
+        with the memory layout of its numpy dtype.
+        """
+        if rf_data.chunks is not None or rf_data.size == 0:
+            return(rf_data)
+        offset = rf_data.id.get_offset()
+        if offset is None or offset + rf_data.size * rf_data.dtype.itemsize > file_size:
+            return(rf_data)
+        if rf_data.id.get_type().get_size() != rf_data.dtype.itemsize:
+            return(rf_data)
+        try:
+            rf_mmap = numpy.memmap(full_hdf5_file, dtype=rf_data.dtype, mode='r', offset=offset, shape=rf_data.shape)
+        except (IOError, OSError, ValueError):
+            return(rf_data)
+        # a compound type may still be laid out differently in the file, so check a row against Hdf5
+        if rf_mmap[0:1].tostring() != rf_data[0:1].tostring():
+            return(rf_data)
+        return(rf_mmap)
+    
+ 
+    
+class _dir_listing_cache:
+    """The _dir_listing_cache is a private class that caches the sorted list of entries matching a glob pattern in each
+    directory, together with the modification time of that directory.  A directory is only listed again after its
+    modification time changed, so that an update of unchanged data costs one os.stat per directory instead of a
+    listing.  Listings of directories modified in the last few seconds are not cached, since later changes in the same
+    clock tick may not modify the modification time again.
+    """
+    
+    def __init__(self):
+        """__init__ creates a new, empty _dir_listing_cache
+        
+        Affects: creates self.hits and self.listings, the number of calls to listdir answered from the cache
+            and the number that had to list the directory.
+        """
+        self.hits = 0
+        self.listings = 0
+        self._listings = {} # key = (directory, pattern), value = (dir mtime, sorted list of full paths)
+        
+        
+    def listdir(self, directory, pattern):
+        """listdir returns a sorted list of the full paths in directory whose basename matches the glob pattern,
+        the same as a sorted glob.glob(os.path.join(directory, pattern)).  Returns an empty list if directory does
+        not exist or is not a directory.  The list must not be modified by the caller.
+        """
+        key = (directory, pattern)
+        try:
+            dir_mtime = os.stat(directory).st_mtime
+        except OSError:
+            self._listings.pop(key, None)
+            return([])
+        if self._listings.has_key(key):
+            cached_mtime, path_list = self._listings[key]
+            if cached_mtime == dir_mtime:
+                self.hits += 1
+                return(path_list)
+        self.listings += 1
+        try:
+            basename_list = os.listdir(directory)
+        except OSError:
+            self._listings.pop(key, None)
+            return([])
+        # as glob, hidden files only match a pattern that starts with a dot
+        if pattern[0] != '.':
+            basename_list = [basename for basename in basename_list if basename[0] != '.']
+        path_list = [os.path.join(directory, basename) for basename in fnmatch.filter(basename_list, pattern)]
+        path_list.sort()
+        if time.time() - dir_mtime < 3:
+            self._listings.pop(key, None)
+        else:
+            self._listings[key] = (dir_mtime, path_list)
+        return(path_list)
+    
+    
+    def invalidate_directory(self, directory):
+        """invalidate_directory drops the cached listings of directory and all its subdirectories
+        """
+        prefix = os.path.join(directory, '')
+        for key in self._listings.keys():
+            if key[0] == directory or key[0].startswith(prefix):
+                del self._listings[key]
+                
+                
+    def get_stats(self):
+        """get_stats returns a dictionary with keys 'directories' (number of cached listings), 'hits', and 'listings'
+        """
+        return({'directories': len(self._listings), 'hits': self.hits, 'listings': self.listings})
+    
+ 
+    
 class _channel_metadata:
     """The _channel_metadata is a private class to hold and access metadata about a particular digital_rf channel.
     A channel can extend over one of more top level directories.
@@ -904,7 +1778,8 @@ class _top_level_dir_metadata:
     """
     
     def __init__(self, top_level_dir, channel_name, access_mode, unix_start_sample = 0, sample_extent = 0, 
-                 samples_per_file=0, sub_directory_recarray=None, sub_directory_dict=None):
+                 samples_per_file=0, sub_directory_recarray=None, sub_directory_dict=None, file_pool=None,
+                 dir_cache=None, index_dir=None):
         """__init__ creates a new _top_level_dir_metadata
         
         Inputs:
@@ -927,11 +1802,18 @@ class _top_level_dir_metadata:
                     metadata yet for this subdirectory
                 Order is by subdirectory and/or unix_start_sample
             sub_directory_dict - a dictionary with key = sub_directory, value = _sub_directory_metadata object
+            file_pool - _file_pool object used to open rf files for reading data, shared with the _sub_directory_metadata
+                objects.  If None (the default), a new one is created.
+            dir_cache - _dir_listing_cache object used to list subdirectories and rf files, shared with the
+                _sub_directory_metadata objects.  If None (the default), a new one is created.
+            index_dir - directory of the metadata index file of this channel directory.  If None (the default),
+                _default_index_dir()
             
-        Affects: creates an attribute for each input argument
+        Affects: creates an attribute for each input argument (file_pool as self._file_pool, dir_cache as 
+            self._dir_cache)
             
         Also creates cached attributes to speed reads with sparse metadata:
-            self._last_file - open H5py file last read
+            self._last_file - full path of rf file last read, open in self._file_pool
             self._last_start_sample - sample start index of cached file
             This file must be gap free, or it is never cached
             
@@ -945,10 +1827,18 @@ class _top_level_dir_metadata:
         self.sub_directory_recarray = sub_directory_recarray
         self.sub_directory_dict = sub_directory_dict
         self.metadata_dict = {} # to be populated by rf file metadata
-        
-        # data type of sub_directory_array
-        self.data_t = numpy.dtype([('subdirectory', numpy.str_, 512), ('unix_start_sample', numpy.uint64, 1), ('sample_extent', numpy.uint64, 1),
-                                   ('file_count', numpy.uint64, 1), ('last_timestamp', numpy.double, 1)])
+        if file_pool is None:
+            file_pool = _file_pool()
+        self._file_pool = file_pool
+        if dir_cache is None:
+            dir_cache = _dir_listing_cache()
+        self._dir_cache = dir_cache
+        
+        # data type of sub_directory_array, all subdirectory paths have the same length
+        subdirectory_len = len(os.path.join(self.top_level_dir, self.channel_name, 'YYYY-MM-DDTHH-MM-SS'))
+        self.data_t = numpy.dtype([('subdirectory', numpy.str_, subdirectory_len), ('unix_start_sample', numpy.uint64, 1),
+                                   ('sample_extent', numpy.uint64, 1), ('file_count', numpy.uint64, 1),
+                                   ('last_timestamp', numpy.double, 1)])
         
         if self.sub_directory_recarray is None:
             # create empty array
@@ -961,6 +1851,15 @@ class _top_level_dir_metadata:
         # attributes to allow caching
         self._last_file = None
         self._last_start_sample = None
+        self._rf_file_key_lists = {} # key = subdirectory, value = (listing, keys, sorted listing) by _get_rf_file_keys
+        
+        # persistent index of subdirectory metadata, so that a complete update does not have to read every rf file
+        if index_dir is None:
+            index_dir = _default_index_dir()
+        self._index_file = os.path.join(index_dir, _index_basename(os.path.join(self.top_level_dir, self.channel_name)))
+        self._index_version = 3
+        self._index = None # dictionary read by _load_index
+        self._index_dir_mtimes = {} # key = subdirectory basename, value = dir mtime of subdirectories in index file
         
         
     def update(self, complete_update=False):
@@ -1011,7 +1910,7 @@ class _top_level_dir_metadata:
             
             # now check that subdirectories with metadata are still up to date
             base_subdirectory = self.sub_directory_recarray['subdirectory'][i]
-            file_count, last_timestamp = self._get_subdirectory_file_info(base_subdirectory)
+            file_count, last_timestamp = self._get_subdirectory_file_info(base_subdirectory, i)
             self.sub_directory_dict[base_subdirectory].update_if_needed(file_count, last_timestamp)
             
             sub_dir_metadata = self.sub_directory_dict[self.sub_directory_recarray['subdirectory'][i]]
@@ -1023,7 +1922,8 @@ class _top_level_dir_metadata:
     
     
     
-    def get_continuous_vector(self, start_unix_sample, stop_unix_sample, last_update_has_full_metadata=False):
+    def get_continuous_vector(self, start_unix_sample, stop_unix_sample, last_update_has_full_metadata=False,
+                              subchannels=None):
         """get_continuous_vector returns a tuple of (numpy array of data, first unix_sample in returned data)
         Only samples between (start_unix_sample, stop_unix_sample) (excludes stop_unix_sample) will be returned.
         
@@ -1036,6 +1936,8 @@ class _top_level_dir_metadata:
             last_update_has_full_metadata - if True, use standard metadata to access data.  If False (the default), 
                 use glob to search for right file without using detailed metadata (slower performance, but less metadata
                 discovery time).
+                
+            subchannels - list of subchannels to read, or None (the default) for all
         """
         if last_update_has_full_metadata:
             # to improve speed, do searchsorted to get first index to look into
@@ -1060,7 +1962,8 @@ class _top_level_dir_metadata:
                 
                 sub_dir_metadata = self.sub_directory_dict[self.sub_directory_recarray['subdirectory'][i]]
                 this_array, unix_sample = sub_dir_metadata.get_continuous_vector(max(start_unix_sample, this_start_sample),
-                                                                                  min(stop_unix_sample, this_start_sample + this_extent))
+                                                                                  min(stop_unix_sample, this_start_sample + this_extent),
+                                                                                  subchannels)
                 
                 ret_array = self._combine_continuous_vectors(ret_array, this_array, first_unix_sample, unix_sample)
                 if first_unix_sample is None:
@@ -1073,13 +1976,9 @@ class _top_level_dir_metadata:
             if self._last_start_sample:
                 if start_unix_sample > self._last_start_sample and \
                     stop_unix_sample <= self._last_start_sample + self.samples_per_file:
-                    return(self._get_data_from_cache(start_unix_sample, stop_unix_sample))
+                    return(self._get_data_from_cache(start_unix_sample, stop_unix_sample, subchannels))
                 else:
                     # cache has expired
-                    try:
-                        self._last_file.close()
-                    except:
-                        pass
                     self._last_file = None
                     self._last_start_sample = None
                     
@@ -1087,7 +1986,7 @@ class _top_level_dir_metadata:
             files_to_search = self._get_files_to_search(start_unix_sample, stop_unix_sample)
             ret_array = None
             for file_to_search in files_to_search:
-                arr = self._read_data_from_file(file_to_search, start_unix_sample, stop_unix_sample, ret_array)
+                arr = self._read_data_from_file(file_to_search, start_unix_sample, stop_unix_sample, ret_array, subchannels)
                 if (not arr is None) and ret_array is None:
                     ret_array = arr
                 elif arr is None:
@@ -1106,6 +2005,68 @@ class _top_level_dir_metadata:
                 
             return((ret_array, start_unix_sample))
                 
+
+
+    def get_read_plan(self, start_unix_sample, stop_unix_sample, checked_subdirectories=None):
+        """get_read_plan returns a list of (full_hdf5_file, start_file_index, read_len, unix_sample) tuples, one for
+        each continuous piece of data found between (start_unix_sample, stop_unix_sample) (excludes stop_unix_sample),
+        in time order.  No rf data is read.
+
+        Works with both full and partial metadata.  Any subdirectory in the range that only has estimated metadata
+        has its detailed metadata loaded, so only the subdirectories touched by the request are analyzed.
+
+        Inputs:
+            start_unix_sample, stop_unix_sample - only samples between (start_unix_sample, stop_unix_sample)
+                (excludes stop_unix_sample) will be planned.
+
+            checked_subdirectories - a set of subdirectories already verified to be up to date.  Updated by this
+                method.  If None (the default), every subdirectory is checked.
+        """
+        if len(self.sub_directory_recarray) == 0:
+            return([])
+
+        # to improve speed, do searchsorted to get first index to look into
+        first_index = numpy.searchsorted(self.sub_directory_recarray['unix_start_sample'],
+                                         numpy.array([start_unix_sample]))
+        first_index = first_index[0]
+        if first_index > 0:
+            first_index -= 1
+        if first_index > 0 and self.sub_directory_recarray['sample_extent'][first_index] == 0:
+            # start sample only estimated from directory name - data may be in the subdirectory before
+            first_index -= 1
+
+        read_plan = []
+        for i in range(first_index, len(self.sub_directory_recarray)):
+            this_start_sample = long(self.sub_directory_recarray['unix_start_sample'][i])
+            if this_start_sample >= stop_unix_sample:
+                break
+            base_subdirectory = self.sub_directory_recarray['subdirectory'][i]
+            sub_dir_metadata = self.sub_directory_dict[base_subdirectory]
+
+            if checked_subdirectories is None or base_subdirectory not in checked_subdirectories:
+                try:
+                    if self.sub_directory_recarray['sample_extent'][i] == 0:
+                        # only estimated metadata so far - get detailed metadata for this subdirectory only
+                        if sub_dir_metadata.needs_update():
+                            sub_dir_metadata.update()
+                        updated = True
+                    else:
+                        file_count, last_timestamp = self._get_subdirectory_file_info(base_subdirectory, i)
+                        updated = sub_dir_metadata.update_if_needed(file_count, last_timestamp)
+                except IOError:
+                    # subdirectory now empty
+                    continue
+                if updated and len(sub_dir_metadata.metadata) > 0:
+                    first_unix_sample, sample_extent, file_count, samples_per_file, last_timestamp = \
+                        sub_dir_metadata.get_summary_metadata()
+                    self.sub_directory_recarray[i] = (base_subdirectory, first_unix_sample, sample_extent,
+                                                      file_count, last_timestamp)
+                if not checked_subdirectories is None:
+                    checked_subdirectories.add(base_subdirectory)
+
+            read_plan += sub_dir_metadata.get_read_plan(start_unix_sample, stop_unix_sample)
+
+        return(read_plan)
         
     
     
@@ -1113,25 +2074,27 @@ class _top_level_dir_metadata:
         """_high_level_reload updates only high level metadata.  Basically this is only the first and last sample
         """
         base_subdirectory_list = self._get_subdirectories()
+        base_subdirectory_set = set(base_subdirectory_list)
         dt1970 = datetime.datetime(1970,1,1)
         
         # first pass is to remove any subdirectories that have disappeared
         rows_to_delete_arr = []
         for i, subdirectory in enumerate(self.sub_directory_recarray['subdirectory']):
-            if subdirectory not in base_subdirectory_list:
+            if subdirectory not in base_subdirectory_set:
                 rows_to_delete_arr.append(i)
                 del self.sub_directory_dict[subdirectory]
+                self._file_pool.invalidate_directory(os.path.join(self.top_level_dir, self.channel_name, subdirectory))
+                self._dir_cache.invalidate_directory(os.path.join(self.top_level_dir, self.channel_name, subdirectory))
+                self._rf_file_key_lists.pop(subdirectory, None)
         if len(rows_to_delete_arr) > 0:
             rows_to_delete_arr = numpy.array(rows_to_delete_arr, numpy.int64)
             self.sub_directory_recarray = numpy.delete(self.sub_directory_recarray, rows_to_delete_arr)
         
         # next pass creates any new rows in _sub_directory_metadata
+        known_subdirectory_set = set(self.sub_directory_recarray['subdirectory'])
         for base_subdirectory in base_subdirectory_list:
-            try:
-                file_count, last_timestamp = self._get_subdirectory_file_info(base_subdirectory)
-            except IOError:
-                new_sub_dir_meta = _sub_directory_metadata(self.top_level_dir, self.channel_name, 
-                                                           self.access_mode, base_subdirectory)
+            if base_subdirectory not in known_subdirectory_set:
+                new_sub_dir_meta = self._new_sub_directory_metadata(base_subdirectory, load_index=False)
                 if not self.sub_directory_dict is None:
                     self.sub_directory_dict[base_subdirectory] = new_sub_dir_meta
                 else:
@@ -1150,10 +2113,12 @@ class _top_level_dir_metadata:
                 sample_index = total_secs * self.metadata_dict['sample_rate']
                 self.sub_directory_recarray[-1] = (base_subdirectory, sample_index, 0, 0, 0) # use default values
                 
-        # update first and last only
-        self.sub_directory_dict[base_subdirectory_list[0]].update()
+        # update first and last only, and only if files were added or removed since the last update
+        if self.sub_directory_dict[base_subdirectory_list[0]].needs_update():
+            self.sub_directory_dict[base_subdirectory_list[0]].update()
         if len(base_subdirectory_list) > 1:
-            self.sub_directory_dict[base_subdirectory_list[-1]].update()
+            if self.sub_directory_dict[base_subdirectory_list[-1]].needs_update():
+                self.sub_directory_dict[base_subdirectory_list[-1]].update()
             
         self.unix_start_sample = long(self.sub_directory_dict[base_subdirectory_list[0]].get_first_sample())
         last_sample = long(self.sub_directory_dict[base_subdirectory_list[-1]].get_last_sample())
@@ -1166,34 +2131,58 @@ class _top_level_dir_metadata:
         """_full_update will cause this _top_level_dir_metadata object to update all possible metadata
         """
         update_needed = False # will be set to True if any subdirectory updated
+        if self._index is None:
+            self._load_index()
         base_subdirectory_list = self._get_subdirectories(verify_files=True)
+        base_subdirectory_set = set(base_subdirectory_list)
         
         # first pass is to remove any subdirectories that have disappeared
         rows_to_delete_arr = []
         for i, subdirectory in enumerate(self.sub_directory_recarray['subdirectory']):
-            if subdirectory not in base_subdirectory_list:
+            if subdirectory not in base_subdirectory_set:
                 rows_to_delete_arr.append(i)
                 del self.sub_directory_dict[subdirectory]
+                self._file_pool.invalidate_directory(os.path.join(self.top_level_dir, self.channel_name, subdirectory))
+                self._dir_cache.invalidate_directory(os.path.join(self.top_level_dir, self.channel_name, subdirectory))
+                self._rf_file_key_lists.pop(subdirectory, None)
         if len(rows_to_delete_arr) > 0:
+            update_needed = True # first and last sample may have changed
             rows_to_delete_arr = numpy.array(rows_to_delete_arr, numpy.int64)
             self.sub_directory_recarray = numpy.delete(self.sub_directory_recarray, rows_to_delete_arr)
         
         # next pass
+        incomplete_subdirectory_list = [] # subdirectories with only a file still being written
         for i, base_subdirectory in enumerate(base_subdirectory_list):
             try:
-                file_count, last_timestamp = self._get_subdirectory_file_info(base_subdirectory)
+                file_count, last_timestamp = self._get_subdirectory_file_info(base_subdirectory, i)
+                sub_dir_meta = self.sub_directory_dict[base_subdirectory]
+                if not sub_dir_meta.needs_update():
+                    # no files added or removed, but row may still be the estimate from _high_level_reload
+                    summary = sub_dir_meta.get_summary_metadata()
+                    if summary[2] != file_count or summary[1] != self.sub_directory_recarray['sample_extent'][i]:
+                        self.sub_directory_recarray[i] = (base_subdirectory, summary[0], summary[1], 
+                                                          summary[2], summary[4])
+                        update_needed = True
+                    continue
                 # call update_if_needed to make faster
-                if self.sub_directory_dict[base_subdirectory].update_if_needed(file_count, last_timestamp):
+                if sub_dir_meta.update_if_needed(file_count, last_timestamp):
+                    if len(sub_dir_meta.metadata) == 0:
+                        # row estimated by _high_level_reload, but no file is complete yet
+                        incomplete_subdirectory_list.append(base_subdirectory)
+                        continue
                     first_unix_sample, sample_extent, file_count, samples_per_file, last_timestamp = \
-                        self.sub_directory_dict[base_subdirectory].get_summary_metadata()
+                        sub_dir_meta.get_summary_metadata()
                     self.sub_directory_recarray[i] = (base_subdirectory, first_unix_sample, sample_extent, 
                                                            file_count, last_timestamp)
                     update_needed = True
             except IOError:
+                new_sub_dir_meta = self._new_sub_directory_metadata(base_subdirectory)
+                if new_sub_dir_meta.needs_update():
+                    new_sub_dir_meta.update()
+                if len(new_sub_dir_meta.metadata) == 0:
+                    # only a file still being written - added by a later update once it is complete
+                    continue
                 update_needed = True
-                new_sub_dir_meta = _sub_directory_metadata(self.top_level_dir, self.channel_name, 
-                                                           self.access_mode, base_subdirectory)
-                new_sub_dir_meta.update()
                 if len(self.metadata_dict.keys()) == 0:
                     self.metadata_dict = new_sub_dir_meta.metadata_dict
                 if not self.sub_directory_dict is None:
@@ -1215,9 +2204,20 @@ class _top_level_dir_metadata:
                         (self.samples_per_file, samples_per_file, base_subdirectory)
                 continue
             
-            
+        if len(incomplete_subdirectory_list) > 0:
+            update_needed = True
+            for subdirectory in incomplete_subdirectory_list:
+                del self.sub_directory_dict[subdirectory]
+            self.sub_directory_recarray = self.sub_directory_recarray[numpy.logical_not(
+                numpy.in1d(self.sub_directory_recarray['subdirectory'], incomplete_subdirectory_list))]
                 
-        if update_needed:
+        if len(self.metadata_dict.keys()) == 0 and len(self.sub_directory_recarray) > 0:
+            # not read if all metadata came from the manifest or an index file written without it
+            first_sub_dir_meta = self.sub_directory_dict[self.sub_directory_recarray['subdirectory'][0]]
+            first_sub_dir_meta._set_metadata_dict()
+            self.metadata_dict = first_sub_dir_meta.metadata_dict
+                
+        if update_needed and len(self.sub_directory_recarray) > 0:
             self._verify_non_overlapping_data()
             # update summary metadata
             self.unix_start_sample = long(self.sub_directory_recarray['unix_start_sample'][0])
@@ -1225,6 +2225,137 @@ class _top_level_dir_metadata:
                 long(self.sub_directory_recarray['sample_extent'][-1])
             self.sample_extent = long(last_sample - self.unix_start_sample)
             
+        self._save_index()
+            
+    
+    def _new_sub_directory_metadata(self, subdirectory, load_index=True):
+        """_new_sub_directory_metadata returns a new _sub_directory_metadata object for subdirectory, filled
+        from the index file if it has an entry for subdirectory.  It still needs_update if files were added
+        or removed since the index was written, but then only files newer than the index are read.
+        
+        Inputs:
+            subdirectory - subdirectory as returned by _get_subdirectories
+            load_index - if False, only use the index if it was already read.  Reading it costs more than
+                the few rf files read by _high_level_reload
+        """
+        new_sub_dir_meta = _sub_directory_metadata(self.top_level_dir, self.channel_name, 
+                                                   self.access_mode, subdirectory, self._file_pool,
+                                                   self._dir_cache)
+        if self._index is None:
+            if not load_index:
+                return(new_sub_dir_meta)
+            self._load_index()
+        basename = os.path.basename(subdirectory)
+        if self._index.has_key(basename):
+            new_sub_dir_meta.set_from_index(self.metadata_dict, *self._index[basename])
+        return(new_sub_dir_meta)
+    
+    
+    def _load_index(self):
+        """_load_index reads the index file of this channel into self._index, a dictionary with key = subdirectory
+        basename, value = tuple of (metadata, cont_metadata, samples_per_file, file_count, last_timestamp,
+        dir_mtime, last_file_mtime, first_file_mtime).  Also sets self.metadata_dict if it is still empty.  A missing or
+        unreadable index file is ignored.
+        """
+        self._index = {}
+        self._index_dir_mtimes = {}
+        if self.access_mode != 'local' or not os.access(self._index_file, os.R_OK):
+            return
+        try:
+            f = h5py.File(self._index_file, 'r')
+            try:
+                if f.attrs['index_version'] != self._index_version:
+                    return
+                sub_arr = f['subdirectories'][...]
+                metadata = f['metadata'][...]
+                cont_metadata = f['cont_metadata'][...]
+                rf_data_attrs = {}
+                for attr in f['rf_data_attrs'].attrs:
+                    rf_data_attrs[str(attr)] = f['rf_data_attrs'].attrs[attr]
+            finally:
+                f.close()
+        except (IOError, OSError, KeyError, ValueError):
+            return
+        
+        if len(self.metadata_dict.keys()) == 0:
+            self.metadata_dict = rf_data_attrs
+        for row in sub_arr:
+            basename = str(row['subdirectory'])
+            self._index[basename] = (metadata[row['metadata_start']:row['metadata_start'] + row['metadata_len']],
+                                     cont_metadata[row['cont_start']:row['cont_start'] + row['cont_len']],
+                                     long(row['samples_per_file']), long(row['file_count']), 
+                                     float(row['last_timestamp']), float(row['dir_mtime']), 
+                                     float(row['last_file_mtime']), float(row['first_file_mtime']))
+            self._index_dir_mtimes[basename] = float(row['dir_mtime'])
+            
+            
+    def _save_index(self):
+        """_save_index writes the metadata of all subdirectories that are completely updated, and have
+        not changed for a few seconds, to the index file.  Does nothing if those are already in the index file,
+        or if the index file cannot be written (eg, read only data)
+        """
+        if self.access_mode != 'local' or self.sub_directory_dict is None:
+            return
+        sub_dir_list = []
+        dir_mtimes = {}
+        for subdirectory in self.sub_directory_recarray['subdirectory']:
+            sub_dir_meta = self.sub_directory_dict[subdirectory]
+            if sub_dir_meta._dir_mtime is None or len(sub_dir_meta.metadata) == 0:
+                continue
+            sub_dir_list.append(sub_dir_meta)
+            dir_mtimes[os.path.basename(subdirectory)] = sub_dir_meta._dir_mtime
+        if dir_mtimes == self._index_dir_mtimes:
+            return
+        
+        sub_t = numpy.dtype([('subdirectory', numpy.str_, 64), ('metadata_start', numpy.uint64, 1), 
+                             ('metadata_len', numpy.uint64, 1), ('cont_start', numpy.uint64, 1),
+                             ('cont_len', numpy.uint64, 1), ('samples_per_file', numpy.uint64, 1),
+                             ('file_count', numpy.uint64, 1), ('last_timestamp', numpy.double, 1),
+                             ('dir_mtime', numpy.double, 1), ('last_file_mtime', numpy.double, 1),
+                             ('first_file_mtime', numpy.double, 1)])
+        sub_arr = numpy.zeros((len(sub_dir_list),), dtype=sub_t)
+        metadata_start = 0
+        cont_start = 0
+        try:
+            for i, sub_dir_meta in enumerate(sub_dir_list):
+                last_file = os.path.join(self.top_level_dir, self.channel_name, sub_dir_meta.subdirectory,
+                                         _rf_basename(sub_dir_meta.metadata['rf_file_key'][-1]))
+                first_file = os.path.join(self.top_level_dir, self.channel_name, sub_dir_meta.subdirectory,
+                                          _rf_basename(sub_dir_meta.metadata['rf_file_key'][0]))
+                sub_arr[i] = (os.path.basename(sub_dir_meta.subdirectory), metadata_start, len(sub_dir_meta.metadata),
+                              cont_start, len(sub_dir_meta.cont_metadata), sub_dir_meta.samples_per_file,
+                              sub_dir_meta.file_count, sub_dir_meta.last_timestamp, sub_dir_meta._dir_mtime,
+                              os.path.getmtime(last_file), os.path.getmtime(first_file))
+                metadata_start += len(sub_dir_meta.metadata)
+                cont_start += len(sub_dir_meta.cont_metadata)
+        except OSError:
+            # files removed while saving, try again with the next update
+            return
+        
+        # write to a temporary file first, so that other readers never see a partial index
+        tmp_file = '%s.%i.tmp' % (self._index_file, os.getpid())
+        try:
+            if not os.path.isdir(os.path.dirname(self._index_file)):
+                os.makedirs(os.path.dirname(self._index_file))
+            f = h5py.File(tmp_file, 'w')
+            try:
+                f.attrs['index_version'] = self._index_version
+                f['subdirectories'] = sub_arr
+                f['metadata'] = numpy.concatenate([sub_dir_meta.metadata for sub_dir_meta in sub_dir_list])
+                f['cont_metadata'] = numpy.concatenate([sub_dir_meta.cont_metadata for sub_dir_meta in sub_dir_list])
+                rf_data_attrs = f.create_group('rf_data_attrs')
+                for key in self.metadata_dict.keys():
+                    rf_data_attrs.attrs[key] = self.metadata_dict[key]
+            finally:
+                f.close()
+            os.rename(tmp_file, self._index_file)
+        except (IOError, OSError, ValueError, TypeError):
+            try:
+                os.remove(tmp_file)
+            except OSError:
+                pass
+            return
+        self._index_dir_mtimes = dir_mtimes
     
     
     
@@ -1247,18 +2378,26 @@ class _top_level_dir_metadata:
             
                 
                 
-    def _get_subdirectory_file_info(self, subdirectory):
+    def _get_subdirectory_file_info(self, subdirectory, row=None):
         """_get_subdirectory_file_info returns a tuple ot (num_files, last_timestamp) for a given
         subdirectory using the self.sub_directory_recarray recarray.  Raises IOError if subdirectory
         not found in recarray.
+        
+        Inputs:
+            subdirectory - subdirectory as returned by _get_subdirectories
+            row - the expected row of subdirectory in self.sub_directory_recarray.  If given and correct, the
+                recarray is not searched.  Default is None.
         """
-        result = numpy.argwhere(self.sub_directory_recarray['subdirectory'] == subdirectory)
-        if len(result) == 0:
-            raise IOError, 'subdirectory %s not found' % (subdirectory)
-        if len(result) > 1:
-            raise ValueError, 'got unexpected result %s' % (str(result))
-        return((self.sub_directory_recarray['file_count'][result[0][0]], 
-                self.sub_directory_recarray['last_timestamp'][result[0][0]]))
+        if row is None or row >= len(self.sub_directory_recarray) or \
+                self.sub_directory_recarray['subdirectory'][row] != subdirectory:
+            result = numpy.argwhere(self.sub_directory_recarray['subdirectory'] == subdirectory)
+            if len(result) == 0:
+                raise IOError, 'subdirectory %s not found' % (subdirectory)
+            if len(result) > 1:
+                raise ValueError, 'got unexpected result %s' % (str(result))
+            row = result[0][0]
+        return((self.sub_directory_recarray['file_count'][row], 
+                self.sub_directory_recarray['last_timestamp'][row]))
         
         
         
@@ -1293,17 +2432,35 @@ class _top_level_dir_metadata:
         # for now only local access
         if self.access_mode not in ('local'):
             raise ValueError, 'access_mode %s not yet implemented' % (access_mode)
-        subdirectory_list = glob.glob(os.path.join(self.top_level_dir, self.channel_name, self._sub_directory_glob))
-        subdirectory_list.sort()
+        subdirectory_list = self._dir_cache.listdir(os.path.join(self.top_level_dir, self.channel_name),
+                                                    self._sub_directory_glob)
         if not verify_files:
-            return(subdirectory_list)
+            return(list(subdirectory_list))
         retList = [] # only return those with files
         for subdirectory in subdirectory_list:
-            if len(glob.glob(os.path.join(subdirectory, '*.h5'))) > 0:
+            if self._has_unchanged_files(subdirectory):
+                # known to have files, no need to list them
+                retList.append(subdirectory)
+            elif len(self._dir_cache.listdir(subdirectory, '*.h5')) > 0:
                 retList.append(subdirectory)
         return(retList)
     
     
+    def _has_unchanged_files(self, subdirectory):
+        """_has_unchanged_files returns True if subdirectory had rf files at the last update or in the index file,
+        and has not been modified since.  False if unknown.
+        """
+        if self.sub_directory_dict is not None and self.sub_directory_dict.has_key(subdirectory):
+            sub_dir_meta = self.sub_directory_dict[subdirectory]
+            return(len(sub_dir_meta.metadata) > 0 and not sub_dir_meta.needs_update())
+        if self._index is None or not self._index_dir_mtimes.has_key(os.path.basename(subdirectory)):
+            return(False)
+        try:
+            return(os.path.getmtime(subdirectory) == self._index_dir_mtimes[os.path.basename(subdirectory)])
+        except OSError:
+            return(False)
+    
+    
     
     def _combine_blocks(self, first_array, second_array, samples_per_file):
         """_combine_blocks combines two numpy array of dtype u64 and shape (N,2) where the first
@@ -1339,55 +2496,67 @@ class _top_level_dir_metadata:
             start_unix_sample, stop_unix_sample - only samples between (start_unix_sample, stop_unix_sample)
                 (excludes stop_unix_sample) will be returned, so only return files that might contain that range
         """
-        seconds_per_file =  1 + int(self.metadata_dict['samples_per_file'][0] / self.metadata_dict['sample_rate'][0])
-        start_integer_sec = long(start_unix_sample/self.metadata_dict['sample_rate'][0])
-        stop_integer_sec = long(stop_unix_sample/self.metadata_dict['sample_rate'][0])
-        seconds_list = range(start_integer_sec - seconds_per_file, stop_integer_sec + 1)
-    
-        # now glob for these files in all directories until no more found
-        files_to_search = []
+        if len(self.sub_directory_recarray) == 0:
+            return([])
+        # rf files are named by the time of their first sample to the millisecond.  Allow a millisecond for rounding.
+        sample_rate = self.metadata_dict['sample_rate'][0]
+        start_key = long(round(start_unix_sample * 1000.0 / sample_rate)) - 1
+        stop_key = long(round(stop_unix_sample * 1000.0 / sample_rate)) + 1
+        
+        # last subdirectory starting at or before start_unix_sample
         first_index = numpy.searchsorted(self.sub_directory_recarray['unix_start_sample'], 
-                                         numpy.array([start_unix_sample]))
-        first_index = first_index[0]
-        if first_index == len(self.sub_directory_recarray['unix_start_sample']):
-            first_index -= 1
-        first_index_sec = long(self.sub_directory_recarray['unix_start_sample'][first_index]/self.metadata_dict['sample_rate'][0])
-        if first_index > 0 and start_integer_sec - seconds_per_file < first_index_sec:
-            first_index -= 1
-        for i in range(first_index, len(self.sub_directory_recarray)):
-            files_this_subdir = 0 # one method to determine when to break
-            this_dir_start_sec = long(self.sub_directory_recarray['unix_start_sample'][i]/self.metadata_dict['sample_rate'][0])
-            if this_dir_start_sec > stop_integer_sec + seconds_per_file:
-                # another break test
+                                         numpy.array([start_unix_sample]), side='right')
+        first_index = max(long(first_index[0]) - 1, 0)
+        
+        # a file with gaps may span any time, so the file holding start_unix_sample is the last one named before it.
+        # That may be in an earlier subdirectory, since a subdirectory start estimated from its name is before its
+        # first file.
+        files_to_search = []
+        for i in range(first_index, -1, -1):
+            rf_file_keys, rf_file_list = self._get_rf_file_keys(self.sub_directory_recarray['subdirectory'][i])
+            first_file = numpy.searchsorted(rf_file_keys, start_key, side='right')
+            if first_file > 0:
+                files_to_search.append(rf_file_list[first_file - 1])
                 break
-            for second in seconds_list:
-                glob_str = os.path.join(self.sub_directory_recarray['subdirectory'][i],
-                                        'rf@%i.???.h5' % (second))
-                new_files = glob.glob(glob_str)
-                files_this_subdir += len(new_files)
-                files_to_search += new_files
-            # break if none found after second subdirectory
-            if i > first_index and files_this_subdir == 0:
+        
+        # then all files named in the range
+        for i in range(first_index, len(self.sub_directory_recarray)):
+            if self.sub_directory_recarray['unix_start_sample'][i] >= stop_unix_sample:
                 break
+            rf_file_keys, rf_file_list = self._get_rf_file_keys(self.sub_directory_recarray['subdirectory'][i])
+            first_file, last_file = numpy.searchsorted(rf_file_keys, [start_key, stop_key], side='right')
+            files_to_search += rf_file_list[first_file:last_file]
             
         files_to_search.sort()
         return(files_to_search)
     
     
-    def _read_data_from_file(self, file_to_search, start_unix_sample, stop_unix_sample, ret_array):
-        """_read_data_from_file reads data (if any) from file.  Used with minimal metadata
+    def _get_rf_file_keys(self, subdirectory):
+        """_get_rf_file_keys returns a tuple of (numpy int64 array of the key (see _rf_file_key) of each rf file,
+        list of the full paths of those rf files) for subdirectory, both sorted by key.  Only parses the file names
+        again if the subdirectory was listed again, so that finding the files of a time range is a searchsorted,
+        not a glob per second.
+        """
+        rf_file_list = self._dir_cache.listdir(subdirectory, self._rf_file_glob)
+        if self._rf_file_key_lists.has_key(subdirectory) and self._rf_file_key_lists[subdirectory][0] is rf_file_list:
+            return(self._rf_file_key_lists[subdirectory][1:])
+        rf_file_keys = _rf_file_keys([os.path.basename(rf_file) for rf_file in rf_file_list])
+        order = numpy.argsort(rf_file_keys, kind='mergesort')
+        sorted_rf_file_list = [rf_file_list[j] for j in order]
+        self._rf_file_key_lists[subdirectory] = (rf_file_list, rf_file_keys[order], sorted_rf_file_list)
+        return((rf_file_keys[order], sorted_rf_file_list))
+    
+    
+    def _read_data_from_file(self, file_to_search, start_unix_sample, stop_unix_sample, ret_array, subchannels=None):
+        """_read_data_from_file reads data (if any) from file, only the columns in the list subchannels if not None.
+        Used with minimal metadata
         """
         # make sure cache is clear if this called
-        if self._last_start_sample:
-            try:
-                self._last_file.close()
-            except:
-                pass
-            self._last_file = None
-            self._last_start_sample = None
+        self._last_file = None
+        self._last_start_sample = None
             
         samples_per_file = long(self.metadata_dict['samples_per_file'][0])
-        f = h5py.File(file_to_search, 'r')
+        f, file_rf_data = self._file_pool.get_with_rf_data(file_to_search)
         rf_data_index = f['/rf_data_index']
         
         if ret_array is None:
@@ -1402,6 +2571,8 @@ class _top_level_dir_metadata:
                 else:
                     samples_left = long(samples_per_file - this_file_index)
                 if this_sample_index + samples_left > start_unix_sample:
+                    if this_sample_index > start_unix_sample:
+                        raise IOError, 'Gap found before first sample in file %s read' % (file_to_search)
                     # the starting read point for the first file was found
                     file_start_index = long(this_file_index + (start_unix_sample-this_sample_index))
                     # make sure there are no gaps in this file to be read
@@ -1409,69 +2580,53 @@ class _top_level_dir_metadata:
                         samples_left_to_read = min(long(rf_data_index[i+1,1]) - file_start_index,
                                                    stop_unix_sample - start_unix_sample)
                         if samples_left_to_read < stop_unix_sample - start_unix_sample:
-                            f.close()
                             raise IOError, 'Gap found in first file %s read' % (file_to_search)
                     else:
                         samples_left_to_read = min(samples_per_file - file_start_index, stop_unix_sample - start_unix_sample)
-                    rf_data = f['/rf_data'][file_start_index:file_start_index + samples_left_to_read]
+                    rf_data = _read_rf_data(file_rf_data, file_start_index,
+                                            file_start_index + samples_left_to_read, subchannels)
                     # see if we can cache this file
                     if len(rf_data_index) == 1:
                         self._last_start_sample = this_sample_index
-                        self._last_file = f
-                    else:
-                        f.close()
+                        self._last_file = file_to_search
                     return(rf_data)
                 
             # no data found
-            try:
-                f.close()
-            except:
-                pass
             return(None)
                 
         else:
-            # make sure cache is clear if muliple file read
-            if self._last_start_sample:
-                try:
-                    self._last_file.close()
-                except:
-                    pass
-                self._last_file = None
-                self._last_start_sample = None
-            
             # append all needed data from this file
             # first, verify this file begins where we expect
             first_file_sample = rf_data_index[0,0]
             if first_file_sample != start_unix_sample + len(ret_array):
-                f.close()
                 raise IOError, 'gap found at file %s -expected index %i, got %i' % (file_to_search, start_unix_sample + len(ret_array),
                                                                                     first_file_sample)
             # verify no gaps over this read
             if len(rf_data_index) > 1:
                 samples_in_this_file = rf_data_index[1,1] - rf_data_index[0,1]
                 if samples_in_this_file < (stop_unix_sample - start_unix_sample) - len(ret_array):
-                    f.close()
                     raise IOError, 'not enough samples in file %s before data gap' % (file_to_search)
                 
             samples_to_read = min(samples_per_file, (stop_unix_sample - start_unix_sample) - len(ret_array))
-            rf_data = f['/rf_data'][0:samples_to_read]
-            f.close()
+            rf_data = _read_rf_data(file_rf_data, 0, samples_to_read, subchannels)
             return(rf_data)
                 
     
         
         
-    def _get_data_from_cache(self, start_unix_sample, stop_unix_sample):
+    def _get_data_from_cache(self, start_unix_sample, stop_unix_sample, subchannels=None):
         """_get_data_from_cache simple returns the desired data from the cached Hdf5 file
         
         Inputs: start_unix_sample, stop_unix_sample - only samples between (start_unix_sample, stop_unix_sample)
                 (excludes stop_unix_sample) will be returned.
+                subchannels - list of subchannels to return, or None (the default) for all
                 
         Calling method tested that this read is possible entirely within this file
         """
         start_index = start_unix_sample - self._last_start_sample
         samples_to_read = stop_unix_sample - start_unix_sample
-        return((self._last_file['/rf_data'][start_index: start_index+samples_to_read], start_unix_sample))
+        rf_data = self._file_pool.get_rf_data(self._last_file)
+        return((_read_rf_data(rf_data, start_index, start_index+samples_to_read, subchannels), start_unix_sample))
         
         
     def __cmp__(self, other):
@@ -1509,7 +2664,7 @@ class _sub_directory_metadata:
     a particular subdirectory.
     """
     
-    def __init__(self, top_level_dir, channel_name, access_mode, subdirectory):
+    def __init__(self, top_level_dir, channel_name, access_mode, subdirectory, file_pool=None, dir_cache=None):
         """__init__ creates a new _sub_directory_metadata object
         
         Inputs:
@@ -1517,13 +2672,18 @@ class _sub_directory_metadata:
             channel_name - the channel_name subdirectory name
             access_mode - string giving access mode (eg, 'local', 'file', or 'http')
             subdirectory - subdirectory name in form YYYY-MM-DDTHH-MM-SS
+            file_pool - _file_pool object used to open rf files for reading data.  If None (the default), a new
+                one is created.
+            dir_cache - _dir_listing_cache object used to list the rf files.  If None (the default), a new one 
+                is created.
             
         Affects:
             Sets self.metadata to None.  When update called, self.metadata will be set to a numpy.recarray
             with columns:  
                 1. unix_sample_index - number of samples since 1970-01-01 to the start of a contiguous data block (uint64_t)
                 2. file_index - where in the file this contiguous block of data begins
-                3. rf_basename (25 char string)
+                3. rf_file_key - unix_seconds*1000 + milliseconds of the rf file name (int64_t), see _rf_basename
+            Rows added by update are appended into self._metadata_buffer, of which self.metadata is then a view.
             
             Also sets self.cont_metadata to None.  When update called, self.cont_metadata will be set 
             to a numpy.recarray about block of contiguous data with columns:  
@@ -1534,7 +2694,7 @@ class _sub_directory_metadata:
             first call to update
             
             Also creates cached attributes to speed reads with detailed metadata:
-            self._last_file - open H5py file last read
+            self._last_file - full path of rf file last read, open in self._file_pool
             self._last_start_sample - sample start index of cached file
             This file must be gap free, or it is never cached
           
@@ -1549,24 +2709,40 @@ class _sub_directory_metadata:
         self.file_count = None
         self.last_timestamp = None # timestamp of last file in UTC
         self.metadata_dict = {} # to be populated by rf file metadata
+        if file_pool is None:
+            file_pool = _file_pool()
+        self._file_pool = file_pool
+        if dir_cache is None:
+            dir_cache = _dir_listing_cache()
+        self._dir_cache = dir_cache
         
         self._rf_file_glob = 'rf@[0-9]*.[0-9][0-9][0-9].h5'
         
         # data type of sub_directory_array
         self.data_t = numpy.dtype([('unix_sample_index', numpy.uint64, 1), ('file_index', numpy.uint64, 1), 
-                                   ('rf_basename', numpy.str_, 25)])
+                                   ('rf_file_key', numpy.int64, 1)])
         self.cont_data_t = numpy.dtype([('unix_sample_index', numpy.uint64, 1), ('sample_extent', numpy.uint64, 1)])
                 
+        # manifest of closed files written by the C writer, one record per /rf_data_index row (see rf_write_hdf5.c)
+        self._manifest_basename = 'rf_manifest.bin'
+        self.manifest_t = numpy.dtype([('rf_basename', numpy.str_, 32), ('unix_sample_index', '<u8', 1), 
+                                       ('file_index', '<u8', 1), ('samples_per_file', '<u8', 1),
+                                       ('samples_written', '<u8', 1), ('index_rows', '<u8', 1)])
+                
         # set to an empty recarray
         if self.metadata is None:
             self.metadata = numpy.array([], dtype=self.data_t)
         if self.cont_metadata is None:
             self.cont_metadata = numpy.array([], dtype=self.cont_data_t)
+        self._metadata_buffer = None # see _append_metadata
             
         # attributes to allow caching
         self._last_file = None
         self._last_start_sample = None
             
+        # modification time of subdirectory at last complete update, None if update needed
+        self._dir_mtime = None
+            
             
     def get_summary_metadata(self):
         """get_summary_metadata returns a tuple of (first_unix_sample, sample_extent, file_count, samples_per_file,
@@ -1596,12 +2772,10 @@ class _sub_directory_metadata:
         if self.access_mode not in ('local'):
             raise ValueError, 'access_mode %s not yet implemented' % (access_mode)
         
-        rf_file_list = glob.glob(os.path.join(self.top_level_dir, self.channel_name, self.subdirectory, 
-                                              self._rf_file_glob))
+        rf_file_list = self._get_rf_file_list()
         if len(rf_file_list) == 0:
             raise IOError, 'subdirectory %s empty' % (self.subdirectory)
         
-        rf_file_list.sort()
         if len(rf_file_list) != file_count:
             self.update()
             return(True)
@@ -1613,6 +2787,61 @@ class _sub_directory_metadata:
         return(False)
                 
                 
+    def set_from_index(self, metadata_dict, metadata, cont_metadata, samples_per_file, file_count, last_timestamp,
+                       dir_mtime, last_file_mtime, first_file_mtime):
+        """set_from_index sets the metadata of this subdirectory as stored in the index file of the channel.  If 
+        the last file was modified since, its rows are dropped so that update reads it again.  If the first file
+        was modified since, the subdirectory was written again (the index is kept outside the data, so it survives
+        a removed recording), and nothing is set.  If the subdirectory was modified since, needs_update will return
+        True, and update only reads files not in metadata.
+        
+        Inputs:
+            metadata_dict - rf file metadata of this channel (may be empty)
+            metadata, cont_metadata, samples_per_file, file_count, last_timestamp - as set by update
+            dir_mtime - modification time of subdirectory when stored in the index
+            last_file_mtime - modification time of the last rf file in metadata when stored in the index
+            first_file_mtime - modification time of the first rf file in metadata when stored in the index
+        """
+        if len(metadata) == 0:
+            return
+        try:
+            dir_mtime_now = self._get_dir_mtime()
+            last_file_mtime_now = os.path.getmtime(os.path.join(self.top_level_dir, self.channel_name, self.subdirectory,
+                                                                _rf_basename(metadata['rf_file_key'][-1])))
+            first_file_mtime_now = os.path.getmtime(os.path.join(self.top_level_dir, self.channel_name, self.subdirectory,
+                                                                 _rf_basename(metadata['rf_file_key'][0])))
+        except OSError:
+            # removed since, let update start from scratch
+            return
+        if first_file_mtime_now != first_file_mtime:
+            return
+        self.metadata_dict = metadata_dict
+        self.samples_per_file = samples_per_file
+        self.file_count = file_count
+        self.last_timestamp = last_timestamp
+        if last_file_mtime_now != last_file_mtime:
+            self.metadata = metadata[metadata['rf_file_key'] != metadata['rf_file_key'][-1]]
+            self._update_cont_metadata()
+            return
+        self.metadata = metadata
+        self.cont_metadata = cont_metadata
+        if dir_mtime_now == dir_mtime:
+            self._dir_mtime = dir_mtime
+                
+                
+    def needs_update(self):
+        """needs_update returns True if files may have been added to or removed from this subdirectory since
+        the last call to update, based on the modification time of the subdirectory.  Always returns True if
+        the last file was still being written at the time of the last update.
+        """
+        if self._dir_mtime is None:
+            return(True)
+        try:
+            return(self._get_dir_mtime() != self._dir_mtime)
+        except OSError:
+            return(True)
+                
+                
                 
     def update(self):
         """update updates self.metadata.  If it was a file name, it reads that data into memory, and then updates it
@@ -1621,35 +2850,41 @@ class _sub_directory_metadata:
         if self.access_mode not in ('local'):
             raise ValueError, 'access_mode %s not yet implemented' % (access_mode)
         
-        rf_file_list = glob.glob(os.path.join(self.top_level_dir, self.channel_name, self.subdirectory, 
-                                              self._rf_file_glob))
-        rf_file_list.sort()
+        # get the modification time before listing, so that any file added during this update triggers the next one
+        try:
+            dir_mtime = self._get_dir_mtime()
+        except OSError:
+            dir_mtime = None
+        rf_file_list = self._get_rf_file_list()
         rf_file_basename_list = [os.path.basename(rf_file) for rf_file in rf_file_list]
+        # close any pooled files that were deleted
+        self._file_pool.invalidate_directory(os.path.join(self.top_level_dir, self.channel_name, self.subdirectory),
+                                             rf_file_list)
+        
+        # fastest is the manifest of closed files written by the writer, no rf file needs to be opened
+        if self._update_from_manifest(rf_file_basename_list, rf_file_list):
+            self._set_metadata_dict()
+            self._set_dir_mtime(dir_mtime, rf_file_basename_list)
+            return
         
-        # first check to see if we can update things quickly if the data is continuous
+        # next check to see if we can update things quickly if the data is continuous
         if self._update_continuous_data(rf_file_basename_list, rf_file_list):
+            self._set_metadata_dict()
+            self._set_dir_mtime(dir_mtime, rf_file_basename_list)
             return
         
-        unique_rf_basenames = numpy.unique(self.metadata['rf_basename'])
-        
         # first step is to delete all lines where the rf file has been deleted
-        rows_to_delete_arr = numpy.array([], dtype=numpy.int64)
-        for rf_basename in unique_rf_basenames:
-            if rf_basename not in rf_file_basename_list:
-                # get a list of all rows with that file
-                result = numpy.argwhere(self.metadata['rf_basename'] == rf_basename)
-                result = result.flatten()
-                rows_to_delete_arr = numpy.concatenate((rows_to_delete_arr, result))
-        if len(rows_to_delete_arr) > 0:
-            self.metadata = numpy.delete(self.metadata, rows_to_delete_arr)
-            unique_rf_basenames = numpy.unique(self.metadata['rf_basename'])
+        rows_to_keep = numpy.in1d(self.metadata['rf_file_key'], _rf_file_keys(rf_file_basename_list))
+        if not numpy.all(rows_to_keep):
+            self.metadata = self.metadata[rows_to_keep]
             
         # the next step is to add rows from each file where it does not yet exist in self.metadata
-        if len(self.metadata['rf_basename']) > 0:
-            first_file_index = rf_file_basename_list.index(self.metadata['rf_basename'][-1]) + 1
+        if len(self.metadata) > 0:
+            first_file_index = rf_file_basename_list.index(_rf_basename(self.metadata['rf_file_key'][-1])) + 1
         else:
             first_file_index = 0
         # we are only looping over files not already in self.metadata, and all data will be appended
+        new_rows_list = []
         for i, rf_file_basename in enumerate(rf_file_basename_list[first_file_index:]):
             # verify the last file is not still being written
             if rf_file_basename == rf_file_basename_list[-1]:
@@ -1666,9 +2901,12 @@ class _sub_directory_metadata:
                 continue
             if len(self.metadata_dict.keys()) == 0:
                 self.metadata_dict = self._get_rf_metadata(rf_file_basename)
-            self.metadata = numpy.concatenate((self.metadata, added_rows))
+            new_rows_list.append(added_rows)
+        if len(new_rows_list) > 0:
+            self._append_metadata(numpy.concatenate(new_rows_list))
             
         self._update_cont_metadata()
+        self._set_dir_mtime(dir_mtime, rf_file_basename_list)
             
             
     def get_continuous_blocks(self, start_unix_sample, stop_unix_sample):
@@ -1734,7 +2972,7 @@ class _sub_directory_metadata:
         return(ret_arr)
     
     
-    def get_continuous_vector(self, start_unix_sample, stop_unix_sample):
+    def get_continuous_vector(self, start_unix_sample, stop_unix_sample, subchannels=None):
         """get_continuous_vector returns a tuple of (numpy array of data, first unix_sample in returned data)
         Only samples between (start_unix_sample, stop_unix_sample) (excludes stop_unix_sample) will be returned.
         
@@ -1743,18 +2981,15 @@ class _sub_directory_metadata:
         Inputs:
             start_unix_sample, stop_unix_sample - only samples between (start_unix_sample, stop_unix_sample)
                 (excludes stop_unix_sample) will be returned.
+            subchannels - list of subchannels to read, or None (the default) for all
         """
         # check if we can use cached file
         if self._last_start_sample:
             if start_unix_sample > self._last_start_sample and \
                 stop_unix_sample <= self._last_start_sample + self.samples_per_file:
-                return(self._get_data_from_cache(start_unix_sample, stop_unix_sample))
+                return(self._get_data_from_cache(start_unix_sample, stop_unix_sample, subchannels))
             else:
                 # cache has expired
-                try:
-                    self._last_file.close()
-                except:
-                    pass
                 self._last_file = None
                 self._last_start_sample = None
                     
@@ -1778,14 +3013,15 @@ class _sub_directory_metadata:
             if self.metadata['unix_sample_index'][i] >= stop_unix_sample:
                 raise IOError, 'Did not get expected read - debug'
             
-            this_hdf5_file = self.metadata['rf_basename'][i]
-            full_hdf5_file = os.path.join(self.top_level_dir, self.channel_name, self.subdirectory, this_hdf5_file)
+            this_hdf5_file = self.metadata['rf_file_key'][i]
+            full_hdf5_file = os.path.join(self.top_level_dir, self.channel_name, self.subdirectory,
+                                          _rf_basename(this_hdf5_file))
             
             # get max possible length of this read as block_len
             if i == len(self.metadata) - 1:
                 # last index
                 block_len = self.samples_per_file - long(self.metadata['file_index'][i])
-            elif self.metadata['rf_basename'][i+1] == this_hdf5_file:
+            elif self.metadata['rf_file_key'][i+1] == this_hdf5_file:
                 block_len = long(self.metadata['file_index'][i+1]) - long(self.metadata['file_index'][i])
             else:
                 block_len = self.samples_per_file - long(self.metadata['file_index'][i])
@@ -1805,8 +3041,8 @@ class _sub_directory_metadata:
                 read_len = block_len
                 
             # finally - read it!!!
-            f = h5py.File(full_hdf5_file, 'r')
-            rf_data = f['/rf_data'][start_file_index:start_file_index + read_len]
+            rf_data = _read_rf_data(self._file_pool.get_rf_data(full_hdf5_file), start_file_index,
+                                    start_file_index + read_len, subchannels)
             
             if ret_array is None:
                 ret_array = rf_data
@@ -1815,19 +3051,62 @@ class _sub_directory_metadata:
             samples_read += read_len
             if samples_read == samples_to_read:
                 # check whether we can cache it
-                if i == first_index and len(f['/rf_data_index']) == 1:
+                # the file has a single rf_data_index row if its neighbouring metadata rows are other files
+                if i == first_index and (i == 0 or self.metadata['rf_file_key'][i-1] != this_hdf5_file) and \
+                        (i == len(self.metadata) - 1 or self.metadata['rf_file_key'][i+1] != this_hdf5_file):
                     self._last_start_sample = long(self.metadata['unix_sample_index'][i])
-                    self._last_file = f
-                else:
-                    f.close()
+                    self._last_file = full_hdf5_file
                 break
-            else:
-                f.close()
                 
         return((ret_array, start_unix_sample))
     
     
     
+    def get_read_plan(self, start_unix_sample, stop_unix_sample):
+        """get_read_plan returns a list of (full_hdf5_file, start_file_index, read_len, unix_sample) tuples, one for
+        each continuous piece of data in this subdirectory found between (start_unix_sample, stop_unix_sample)
+        (excludes stop_unix_sample), in time order.  Gaps are not an error - they simply are not in the list.
+        Uses only self.metadata - no Hdf5 file is opened.
+
+        Inputs:
+            start_unix_sample, stop_unix_sample - only samples between (start_unix_sample, stop_unix_sample)
+                (excludes stop_unix_sample) will be planned.
+        """
+        read_plan = []
+        if len(self.metadata) == 0:
+            return(read_plan)
+
+        # to improve speed, do searchsorted to get first index to look into
+        first_index = numpy.searchsorted(self.metadata['unix_sample_index'],
+                                         numpy.array([start_unix_sample], dtype=numpy.uint64), side='right')
+        first_index = max(long(first_index[0]) - 1, 0)
+
+        for i in range(first_index, len(self.metadata)):
+            this_unix_sample = long(self.metadata['unix_sample_index'][i])
+            if this_unix_sample >= stop_unix_sample:
+                break
+            this_hdf5_file = self.metadata['rf_file_key'][i]
+
+            # get length of this continuous block
+            if i < len(self.metadata) - 1 and self.metadata['rf_file_key'][i+1] == this_hdf5_file:
+                block_len = long(self.metadata['file_index'][i+1]) - long(self.metadata['file_index'][i])
+            else:
+                block_len = self.samples_per_file - long(self.metadata['file_index'][i])
+
+            read_start = max(start_unix_sample, this_unix_sample)
+            read_stop = min(stop_unix_sample, this_unix_sample + block_len)
+            if read_stop <= read_start:
+                continue
+
+            full_hdf5_file = os.path.join(self.top_level_dir, self.channel_name, self.subdirectory,
+                                          _rf_basename(this_hdf5_file))
+            start_file_index = long(self.metadata['file_index'][i]) + (read_start - this_unix_sample)
+            read_plan.append((full_hdf5_file, start_file_index, read_stop - read_start, read_start))
+
+        return(read_plan)
+
+
+
     def get_first_sample(self):
         """get_first_sample returns the first sample index in this subdirectory.  May be exact (if self.metadata
         not is None) or an estimate based one subdirectory naming convention.
@@ -1835,14 +3114,11 @@ class _sub_directory_metadata:
         if len(self.metadata) > 0:
             return(self.metadata['unix_sample_index'][0])
         
-        rf_file_list = glob.glob(os.path.join(self.top_level_dir, self.channel_name, self.subdirectory, 
-                                              self._rf_file_glob))
+        rf_file_list = self._get_rf_file_list()
         
         if len(rf_file_list) == 0:
             raise IOError, 'No valid rf files found in subdirectory %s' % \
                 (os.path.join(self.top_level_dir, self.channel_name, self.subdirectory))
-                
-        rf_file_list.sort()
         
         new_rows = self._get_new_rows(os.path.basename(rf_file_list[0]))
         return(new_rows['unix_sample_index'][0])
@@ -1854,14 +3130,11 @@ class _sub_directory_metadata:
         if len(self.metadata) > 0 and len(self.metadata_dict.keys()):
             return(self.metadata['unix_sample_index'][-1] + self.metadata_dict['samples_per_file'] - self.metadata['file_index'][-1])
         
-        rf_file_list = glob.glob(os.path.join(self.top_level_dir, self.channel_name, self.subdirectory, 
-                                              self._rf_file_glob))
+        rf_file_list = self._get_rf_file_list()
         
         if len(rf_file_list) == 0:
             raise IOError, 'No valid rf files found in subdirectory %s' % \
                 (os.path.join(self.top_level_dir, self.channel_name, self.subdirectory))
-                
-        rf_file_list.sort()
         
         if len(self.metadata_dict.keys()) == 0:
             self.metadata_dict = self._get_rf_metadata(os.path.basename(rf_file_list[0]))
@@ -1930,6 +3203,9 @@ class _sub_directory_metadata:
             last_row = self._get_new_rows(rf_file_basename_list[-1])
             last_index = len(rf_file_basename_list)
             self.last_timestamp = self._get_utc_timestamp(rf_file_list[-1])
+        elif len(rf_file_basename_list) < 2:
+            # only file still being written
+            return(False)
         else:
             last_row = self._get_new_rows(rf_file_basename_list[-2])
             last_index = len(rf_file_basename_list) - 1
@@ -1950,7 +3226,7 @@ class _sub_directory_metadata:
         sample_data += first_sample
         self.metadata['unix_sample_index'] = sample_data
         self.metadata['file_index'][:] = 0
-        self.metadata['rf_basename'] = rf_file_basename_list[first_index:last_index]
+        self.metadata['rf_file_key'] = _rf_file_keys(rf_file_basename_list[first_index:last_index])
         
         self._update_cont_metadata()
         return(True)
@@ -1958,6 +3234,88 @@ class _sub_directory_metadata:
     
     
     
+    def _update_from_manifest(self, rf_file_basename_list, rf_file_list):
+        """_update_from_manifest updates all metadata from the manifest written by the writer, then returns True.
+        Does nothing and returns False if there is no manifest, or if any file in rf_file_basename_list other than
+        a last one still being written is not in it (eg, written by an older writer).
+        
+        Inputs:
+            rf_file_basename_list - sorted list of basenames in subdirectory
+            rf_file_list - sorted list of full names  in subdirectory
+        """
+        if len(rf_file_basename_list) == 0:
+            return(False)
+        manifest = self._read_manifest()
+        if manifest is None:
+            return(False)
+        
+        # ignore files removed since they were written
+        manifest = manifest[numpy.in1d(manifest['rf_basename'], rf_file_basename_list)]
+        if len(manifest) == 0:
+            return(False)
+        manifest_basenames = set(manifest['rf_basename'])
+        if len(manifest_basenames) < len(rf_file_basename_list):
+            if len(manifest_basenames) < len(rf_file_basename_list) - 1:
+                return(False)
+            if rf_file_basename_list[-1] in manifest_basenames:
+                return(False)
+            # the last file is not in the manifest, it must still be being written
+            if not self._file_is_open(rf_file_list[-1]):
+                return(False)
+        
+        # a file removed and written again would be out of order
+        unix_sample_index = manifest['unix_sample_index']
+        if numpy.any(unix_sample_index[1:] <= unix_sample_index[:-1]):
+            return(False)
+        samples_per_file = long(manifest['samples_per_file'][0])
+        if numpy.any(manifest['samples_per_file'] != samples_per_file):
+            raise IOError, 'Illegal change in samples_per_file in manifest of subdirectory %s' % (self.subdirectory)
+        if self.samples_per_file is None:
+            self.samples_per_file = samples_per_file
+        elif self.samples_per_file != samples_per_file:
+            raise IOError, 'Illegal change in samples_per_file from %i to %i in subdirectory %s' % (self.samples_per_file,
+                                                                                                  samples_per_file,
+                                                                                                  self.subdirectory)
+        
+        self.metadata = numpy.zeros((len(manifest),), dtype=self.data_t)
+        self.metadata['unix_sample_index'] = unix_sample_index
+        self.metadata['file_index'] = manifest['file_index']
+        self.metadata['rf_file_key'] = _rf_file_keys(manifest['rf_basename'])
+        self.file_count = len(manifest_basenames)
+        last_file = os.path.join(self.top_level_dir, self.channel_name, self.subdirectory, manifest['rf_basename'][-1])
+        self.last_timestamp = self._get_utc_timestamp(last_file)
+        self._update_cont_metadata()
+        return(True)
+    
+    
+    def _read_manifest(self):
+        """_read_manifest returns the records of the manifest of closed files in this subdirectory as a
+        numpy array of dtype self.manifest_t, or None if there is no manifest.  Records of a last file that
+        are still being appended are left out.
+        """
+        fullname = os.path.join(self.top_level_dir, self.channel_name, self.subdirectory, self._manifest_basename)
+        try:
+            f = open(fullname, 'rb')
+            try:
+                data = f.read()
+            finally:
+                f.close()
+        except IOError:
+            return(None)
+        
+        # ignore a partial record at the end
+        n_records = len(data) / self.manifest_t.itemsize
+        manifest = numpy.frombuffer(data, dtype=self.manifest_t, count=n_records)
+        if n_records == 0:
+            return(manifest)
+        
+        # and all records of the last file if not all its /rf_data_index rows are there yet
+        last_rows = numpy.argwhere(manifest['rf_basename'] == manifest['rf_basename'][-1]).flatten()
+        if len(last_rows) < manifest['index_rows'][-1]:
+            manifest = manifest[:last_rows[0]]
+        return(manifest)
+    
+    
     def _verify_no_gaps(self, start_unix_sample, stop_unix_sample):
         """_verify_no_gaps raises an IOError if there is a gap between start_unix_sample, stop_unix_sample
         """
@@ -1986,6 +3344,7 @@ class _sub_directory_metadata:
         """
         # read data from /rf_data_index
         fullname = os.path.join(self.top_level_dir, self.channel_name, self.subdirectory, rf_file_basename)
+        self._file_pool.invalidate(fullname)
         try:
             f = h5py.File(fullname, 'r')
         except IOError:
@@ -2003,13 +3362,20 @@ class _sub_directory_metadata:
         new_rows = numpy.zeros((len(rf_data_index),),dtype=self.data_t)
         new_rows['unix_sample_index'] = rf_data_index[:,0]
         new_rows['file_index'] = rf_data_index[:,1]
-        new_rows['rf_basename'] = rf_file_basename
+        new_rows['rf_file_key'] = _rf_file_key(rf_file_basename)
         
         f.close()
         
         return(new_rows)
     
     
+    def _set_metadata_dict(self):
+        """_set_metadata_dict sets self.metadata_dict from the first rf file in self.metadata, if not yet set
+        """
+        if len(self.metadata_dict.keys()) == 0 and len(self.metadata) > 0:
+            self.metadata_dict = self._get_rf_metadata(_rf_basename(self.metadata['rf_file_key'][0]))
+    
+    
     def _get_rf_metadata(self, rf_file_basename):
         """_get_rf_metadata is a private method that returns a dictionary of all metadata stored in each rf file,
         or empty dict if that file has disappeared
@@ -2024,6 +3390,7 @@ class _sub_directory_metadata:
         """
         ret_dict = {}
         fullname = os.path.join(self.top_level_dir, self.channel_name, self.subdirectory, rf_file_basename)
+        self._file_pool.invalidate(fullname)
         try:
             f = h5py.File(fullname, 'r')
         except IOError:
@@ -2066,45 +3433,47 @@ class _sub_directory_metadata:
     def _update_cont_metadata(self):
         """_update_cont_metadata completely rebuilds self.cont_metadata
         """
-        cont_meta = []
         # handle empty dir case
         if len(self.metadata) == 0:
-            self.cont_metadata = numpy.zeros((len(cont_meta),), dtype=self.cont_data_t)
+            self.cont_metadata = numpy.zeros((0,), dtype=self.cont_data_t)
             return
-        for i in range(len(self.metadata)):
-            if i == 0:
-                cont_meta.append([self.metadata['unix_sample_index'][0], 0])
-                last_sample = self.metadata['unix_sample_index'][0]
-                last_index = 0
-                continue
-            this_sample = self.metadata['unix_sample_index'][i]
-            this_index = self.metadata['file_index'][i]
-            if this_index == 0:
-                num_samples = self.samples_per_file - last_index
-            else:
-                num_samples = this_index - last_index
-                if num_samples < 1:
-                    raise ValueError, 'bug in self.metadata'
-            cont_meta[-1][1] += num_samples
-            if this_sample - last_sample == num_samples:
-                if this_index != 0:
-                    raise ValueError, 'bug 2 in self.metadata'
-            else:
-                cont_meta.append([this_sample, 0])
-            last_sample = this_sample
-            last_index = this_index
-                
-        # handle end of last file
-        edge_samples = self.samples_per_file - last_index
-
-        cont_meta[-1][1] += edge_samples
-        
-        cont_meta = numpy.array(cont_meta)
+        unix_sample_index = numpy.array(self.metadata['unix_sample_index'], dtype=numpy.int64)
+        file_index = numpy.array(self.metadata['file_index'], dtype=numpy.int64)
+        
+        # samples in each row, up to the next row in the same file or the end of the file
+        num_samples = numpy.empty((len(file_index),), dtype=numpy.int64)
+        num_samples[:-1] = numpy.where(file_index[1:] == 0, self.samples_per_file - file_index[:-1],
+                                       file_index[1:] - file_index[:-1])
+        num_samples[-1] = self.samples_per_file - file_index[-1]
+        if numpy.any((file_index[1:] != 0) & (num_samples[:-1] < 1)):
+            raise ValueError, 'bug in self.metadata'
+        
+        # a new block starts at each row that does not follow the previous one
+        is_continuous = unix_sample_index[1:] - unix_sample_index[:-1] == num_samples[:-1]
+        if numpy.any(is_continuous & (file_index[1:] != 0)):
+            raise ValueError, 'bug 2 in self.metadata'
+        block_starts = numpy.concatenate(([0], numpy.nonzero(numpy.logical_not(is_continuous))[0] + 1))
         
         # create self.cont_metadata
-        self.cont_metadata = numpy.zeros((len(cont_meta),), dtype=self.cont_data_t)
-        self.cont_metadata['unix_sample_index'] = cont_meta[:,0]
-        self.cont_metadata['sample_extent'] = cont_meta[:,1]
+        self.cont_metadata = numpy.zeros((len(block_starts),), dtype=self.cont_data_t)
+        self.cont_metadata['unix_sample_index'] = unix_sample_index[block_starts]
+        self.cont_metadata['sample_extent'] = numpy.add.reduceat(num_samples, block_starts)
+        
+        
+    def _append_metadata(self, new_rows):
+        """_append_metadata appends the rows in new_rows to self.metadata.  self.metadata is kept as a view of the
+        first rows of self._metadata_buffer, which is only reallocated (to twice the rows needed) when full, so that
+        adding a few rows at every update does not copy all of self.metadata each time.
+        """
+        metadata_len = len(self.metadata)
+        new_len = metadata_len + len(new_rows)
+        if self._metadata_buffer is None or self.metadata.base is not self._metadata_buffer or \
+                len(self._metadata_buffer) < new_len:
+            metadata_buffer = numpy.zeros((max(2*new_len, 64),), dtype=self.data_t)
+            metadata_buffer[:metadata_len] = self.metadata
+            self._metadata_buffer = metadata_buffer
+        self._metadata_buffer[metadata_len:new_len] = new_rows
+        self.metadata = self._metadata_buffer[:new_len]
         
     
     
@@ -2114,8 +3483,9 @@ class _sub_directory_metadata:
         if time.time() - os.path.getmtime(rf_file) < 3:
             return(True)
         else:
+            self._file_pool.invalidate(rf_file)
             try:
-                f = h5py.File(rf_file)
+                f = h5py.File(rf_file, 'r')
                 f['/rf_data'].attrs['digital_rf_version']
                 f.close()
                 return(False)
@@ -2127,6 +3497,35 @@ class _sub_directory_metadata:
                 return(True)
             
         
+    def _get_rf_file_list(self):
+        """_get_rf_file_list returns the sorted list of full paths of rf files in this subdirectory.  The directory
+        is only listed again if it was modified since the last listing.  The list must not be modified.
+        """
+        return(self._dir_cache.listdir(os.path.join(self.top_level_dir, self.channel_name, self.subdirectory),
+                                       self._rf_file_glob))
+    
+    
+    def _get_dir_mtime(self):
+        """_get_dir_mtime returns the modification time of this subdirectory.  Raises OSError if it no longer exists
+        """
+        return(os.path.getmtime(os.path.join(self.top_level_dir, self.channel_name, self.subdirectory)))
+    
+    
+    def _set_dir_mtime(self, dir_mtime, rf_file_basename_list):
+        """_set_dir_mtime stores dir_mtime as the modification time at the last complete update.  Stores None, so that
+        the next call to needs_update returns True, if the last file in rf_file_basename_list was not yet added to
+        self.metadata (still being written), or if dir_mtime is so recent that later changes may not modify it
+        """
+        self._dir_mtime = None
+        if dir_mtime is None or len(self.metadata) == 0 or len(rf_file_basename_list) == 0:
+            return
+        if self.metadata['rf_file_key'][-1] != _rf_file_key(rf_file_basename_list[-1]):
+            return
+        if time.time() - dir_mtime < 3:
+            return
+        self._dir_mtime = dir_mtime
+    
+    
     def _get_utc_timestamp(self, fullfile):
         """_get_utc_timestamp returns the last modification timestamp of fullfile in UTC
         """
@@ -2137,17 +3536,19 @@ class _sub_directory_metadata:
         return(os.path.getmtime(fullfile) - time.timezone)
     
     
-    def _get_data_from_cache(self, start_unix_sample, stop_unix_sample):
+    def _get_data_from_cache(self, start_unix_sample, stop_unix_sample, subchannels=None):
         """_get_data_from_cache simple returns the desired data from the cached Hdf5 file
         
         Inputs: start_unix_sample, stop_unix_sample - only samples between (start_unix_sample, stop_unix_sample)
                 (excludes stop_unix_sample) will be returned.
+                subchannels - list of subchannels to return, or None (the default) for all
                 
         Calling method tested that this read is possible entirely within this file
         """
         start_index = start_unix_sample - self._last_start_sample
         samples_to_read = stop_unix_sample - start_unix_sample
-        return((self._last_file['/rf_data'][start_index: start_index+samples_to_read], start_unix_sample))
+        rf_data = self._file_pool.get_rf_data(self._last_file)
+        return((_read_rf_data(rf_data, start_index, start_index+samples_to_read, subchannels), start_unix_sample))
     
     
 class _MissingMetadata(Exception):
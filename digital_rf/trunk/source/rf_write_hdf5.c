@@ -82,6 +82,7 @@ Digital_rf_write_object * digital_rf_create_write_hdf5(char * directory, hid_t d
 	hdf5_data_object->index_dataset = 0;
 	hdf5_data_object->index_prop = 0;
 	hdf5_data_object->next_index_avail = 0;
+	hdf5_data_object->rf_basename[0] = '\0';
 
 	/* this value not set until digital_rf_write_hdf5 called */
 	hdf5_data_object->chunk_size = 0;
@@ -380,6 +381,10 @@ int digital_rf_get_unix_time(uint64_t global_sample, double sample_rate, int * y
 int digital_rf_free_hdf5_data_object(Digital_rf_write_object *hdf5_data_object)
 /* digital_rf_free_hdf5_data_object frees all resources in hdf5_data_object */
 {
+	/* close any partly written Hdf5 file first, so that it is added to the manifest */
+	if (hdf5_data_object->hdf5_file)
+		digital_rf_close_hdf5_file(hdf5_data_object);
+
 	if (hdf5_data_object->directory != NULL)
 		free(hdf5_data_object->directory);
 	if (hdf5_data_object->sub_directory != NULL)
@@ -570,25 +575,7 @@ uint64_t digital_rf_write_samples_to_file(Digital_rf_write_object *hdf5_data_obj
 	if (hdf5_data_object->dataset_index == hdf5_data_object->samples_per_file)
 	{
 		/* hdf5 file full - close it */
-		H5Dclose (hdf5_data_object->dataset);
-		hdf5_data_object->dataset = 0;
-		H5Dclose (hdf5_data_object->index_dataset);
-		hdf5_data_object->index_dataset = 0;
-		H5Sclose (hdf5_data_object->dataspace);
-		hdf5_data_object->dataspace = 0;
-		if (hdf5_data_object->filespace)
-		{
-			H5Sclose (hdf5_data_object->filespace);
-			hdf5_data_object->filespace = 0;
-		}
-		if (hdf5_data_object->memspace)
-		{
-			H5Sclose (hdf5_data_object->memspace);
-			hdf5_data_object->memspace = 0;
-		}
-		H5Fclose (hdf5_data_object->hdf5_file);
-		hdf5_data_object->hdf5_file = 0;
-		hdf5_data_object->dataset_index = 0;
+		digital_rf_close_hdf5_file(hdf5_data_object);
 	}
 
 	return(samples_to_write);
@@ -654,6 +641,7 @@ int digital_rf_create_hdf5_file(Digital_rf_write_object *hdf5_data_object, uint6
 	strcat(fullname, hdf5_data_object->sub_directory);
 	sprintf(basename, "rf@%011.3f.h5", unix_timestamp);
 	strcat(fullname, basename);
+	strcpy(hdf5_data_object->rf_basename, basename);
 
 	/* Create a new file. If file exists will fail. */
 	hdf5_data_object->hdf5_file = H5Fcreate (fullname, H5F_ACC_EXCL, H5P_DEFAULT, H5P_DEFAULT);
@@ -1226,6 +1214,157 @@ int digital_rf_write_rf_data_index(Digital_rf_write_object * hdf5_data_object, u
 }
 
 
+int digital_rf_close_hdf5_file(Digital_rf_write_object *hdf5_data_object)
+/* digital_rf_close_hdf5_file closes the open Hdf5 file, and then adds its /rf_data_index rows to the manifest
+ * of its subdirectory, so that readers know it is complete without opening it
+ *
+ * Inputs:
+ *  Digital_rf_write_object *hdf5_data_object - the Digital_rf_write_object created by digital_rf_create_write_hdf5
+ *
+ *  Returns 0 if success, -1 if the manifest could not be written. The Hdf5 file is closed in either case.
+ */
+{
+	/* local variables */
+	uint64_t * rf_data_index_arr = NULL; /* copy of /rf_data_index of the file being closed */
+	int rows = hdf5_data_object->next_index_avail;
+	uint64_t samples_written = hdf5_data_object->dataset_index;
+	int result = -1;
+
+	/* read back /rf_data_index before the dataset is closed */
+	if (hdf5_data_object->index_dataset && rows > 0)
+	{
+		if ((rf_data_index_arr = (uint64_t *)malloc(sizeof(uint64_t)*rows*2))==0)
+		{
+			fprintf(stderr, "malloc failure - unrecoverable\n");
+			exit(-1);
+		}
+		if (H5Dread(hdf5_data_object->index_dataset, H5T_NATIVE_ULLONG, H5S_ALL, H5S_ALL, H5P_DEFAULT,
+				    rf_data_index_arr) < 0)
+		{
+			free(rf_data_index_arr);
+			rf_data_index_arr = NULL;
+		}
+	}
+
+	if (hdf5_data_object->dataset)
+	{
+		H5Dclose (hdf5_data_object->dataset);
+		hdf5_data_object->dataset = 0;
+	}
+	if (hdf5_data_object->index_dataset)
+	{
+		H5Dclose (hdf5_data_object->index_dataset);
+		hdf5_data_object->index_dataset = 0;
+	}
+	if (hdf5_data_object->dataspace)
+	{
+		H5Sclose (hdf5_data_object->dataspace);
+		hdf5_data_object->dataspace = 0;
+	}
+	if (hdf5_data_object->filespace)
+	{
+		H5Sclose (hdf5_data_object->filespace);
+		hdf5_data_object->filespace = 0;
+	}
+	if (hdf5_data_object->memspace)
+	{
+		H5Sclose (hdf5_data_object->memspace);
+		hdf5_data_object->memspace = 0;
+	}
+	H5Fclose (hdf5_data_object->hdf5_file);
+	hdf5_data_object->hdf5_file = 0;
+	hdf5_data_object->dataset_index = 0;
+
+	/* only add to the manifest once the file is complete on disk */
+	if (rf_data_index_arr)
+	{
+		result = digital_rf_write_manifest(hdf5_data_object, rf_data_index_arr, rows, samples_written);
+		free(rf_data_index_arr);
+	}
+	return(result);
+}
+
+
+int digital_rf_write_manifest(Digital_rf_write_object *hdf5_data_object, uint64_t * rf_data_index_arr, int rows,
+		                      uint64_t samples_written)
+/* digital_rf_write_manifest appends one record per /rf_data_index row of a closed Hdf5 file to the file
+ * DIGITAL_RF_MANIFEST in the present subdirectory.  Each record is MANIFEST_RECORD_SIZE bytes:
+ * 	rf_basename - MANIFEST_BASENAME_SIZE bytes, basename of the Hdf5 file padded with NUL
+ * 	unix_sample_index - /rf_data_index column 0, little-endian uint64_t
+ * 	file_index - /rf_data_index column 1, little-endian uint64_t
+ * 	samples_per_file - little-endian uint64_t
+ * 	samples_written - samples written to the file, less than samples_per_file only if the writer was closed
+ * 		before the file was full, little-endian uint64_t
+ * 	index_rows - number of /rf_data_index rows, and so of records, of the file, little-endian uint64_t
+ *
+ * Readers must ignore a file with fewer than index_rows records, or a trailing partial record, which may
+ * be seen while the records are being appended.
+ *
+ * Inputs:
+ *  Digital_rf_write_object *hdf5_data_object - the Digital_rf_write_object created by digital_rf_create_write_hdf5
+ *  uint64_t * rf_data_index_arr - the (rows, 2) /rf_data_index of the closed file
+ *  int rows - number of rows in rf_data_index_arr
+ *  uint64_t samples_written - number of samples written to the closed file
+ *
+ *  Returns 0 if success, -1 and error printed if failure
+ */
+{
+	/* local variables */
+	char fullname[BIG_HDF5_STR] = "";
+	unsigned char * records;
+	unsigned char * record;
+	uint64_t values[5];
+	FILE * fp;
+	int i, j, k;
+	size_t records_written;
+
+	if (strlen(hdf5_data_object->rf_basename) >= MANIFEST_BASENAME_SIZE)
+	{
+		fprintf(stderr, "basename %s too long for manifest\n", hdf5_data_object->rf_basename);
+		return(-1);
+	}
+
+	if ((records = (unsigned char *)calloc(rows, MANIFEST_RECORD_SIZE))==0)
+	{
+		fprintf(stderr, "malloc failure - unrecoverable\n");
+		exit(-1);
+	}
+	for (i=0; i<rows; i++)
+	{
+		record = records + i*MANIFEST_RECORD_SIZE;
+		strcpy((char *)record, hdf5_data_object->rf_basename);
+		values[0] = rf_data_index_arr[i*2];
+		values[1] = rf_data_index_arr[i*2 + 1];
+		values[2] = hdf5_data_object->samples_per_file;
+		values[3] = samples_written;
+		values[4] = rows;
+		/* byte by byte, so that the manifest is little-endian on any machine */
+		for (j=0; j<5; j++)
+			for (k=0; k<8; k++)
+				record[MANIFEST_BASENAME_SIZE + j*8 + k] = (unsigned char)((values[j] >> (8*k)) & 0xff);
+	}
+
+	strcpy(fullname, hdf5_data_object->directory); /* directory ends with "/" */
+	strcat(fullname, hdf5_data_object->sub_directory);
+	strcat(fullname, DIGITAL_RF_MANIFEST);
+	if ((fp = fopen(fullname, "ab")) == NULL)
+	{
+		fprintf(stderr, "Unable to open manifest %s\n", fullname);
+		free(records);
+		return(-1);
+	}
+	records_written = fwrite(records, MANIFEST_RECORD_SIZE, rows, fp);
+	fclose(fp);
+	free(records);
+	if (records_written != rows)
+	{
+		fprintf(stderr, "Unable to write manifest %s\n", fullname);
+		return(-1);
+	}
+	return(0);
+}
+
+
 uint64_t digital_rf_get_global_sample(uint64_t samples_written, uint64_t * global_index_arr, uint64_t * data_index_arr,
 		                              uint64_t index_len)
 /* digital_rf_get_global_sample calculates the global_sample given samples_written using global_index_arr and data_index_arr
@@ -48,6 +48,24 @@ def test_read(channel_name,test_read_obj, read_size=FILE_SAMPLES):
     speedMB = (read_size*1000*4)/(1.0E6*seconds)
     print('Total read time %f seconds, speed %1.2f MB/s' % (seconds, speedMB))
 
+def test_iter_blocks(channel_name, test_read_obj, prefetch):
+    """test_iter_blocks measures the speed of reading all the data back one file at a time with
+    iter_blocks, which reads prefetch files ahead while each block is being used
+    """
+    if sys.platform == 'darwin':
+        os.system('purge')
+    start_index, end_index = test_read_obj.get_bounds(channel_name)
+    t2 = time.time()
+    count = 0
+    for unix_sample, arr in test_read_obj.iter_blocks(channel_name, start_index, start_index + 1000*FILE_SAMPLES,
+                                                      FILE_SAMPLES, prefetch):
+        count += 1
+        if count % 100 == 0:
+            print('%i out of 1000' % (count))
+    seconds = time.time() - t2
+    speedMB = (FILE_SAMPLES*1000*4)/(1.0E6*seconds)
+    print('Total read time %f seconds, speed %1.2f MB/s' % (seconds, speedMB))
+
 t = time.time()
 test_read_obj = digital_rf_hdf5.read_hdf5('/tmp/benchmark', load_all_metadata=True)
 print('metadata analysis took %f seconds' % (time.time() - t))
@@ -58,6 +76,12 @@ test_read('junk0', test_read_obj)
 print("\nTest 0.1 - read Hdf5 files with no compress, no checksum, small read size - channel name = junk0")
 test_read('junk0', test_read_obj, 1000)
 
+print("\nTest 0.2 - read Hdf5 files with no compress, no checksum, with iter_blocks and no read ahead - channel name = junk0")
+test_iter_blocks('junk0', test_read_obj, 0)
+
+print("\nTest 0.3 - read Hdf5 files with no compress, no checksum, with iter_blocks reading 2 files ahead - channel name = junk0")
+test_iter_blocks('junk0', test_read_obj, 2)
+
 print("\nTest call to reload to update metadata")
 t = time.time()
 test_read_obj.reload()
@@ -0,0 +1,89 @@
+"""benchmark_rf_read_hdf5_metadata.py is a script to benchmark the memory used by, and the time needed to build,
+the complete metadata of subdirectories with many small rf files, such as 1 second phasecal files.
+
+The rf files are empty, only the writer manifest is real, so no Hdf5 file is opened.  Also times building the
+metadata a few files at a time, as a reader following the writer does.
+
+usage: python benchmark_rf_read_hdf5_metadata.py [files per subdirectory]
+"""
+# standard python imports
+import os, os.path, sys
+import time
+import shutil
+
+# third party imports
+import numpy
+
+# Millstone imports
+import digital_rf_hdf5
+
+# constants
+SAMPLE_RATE = 100
+FILE_SAMPLES = 100 # 1 second files
+START_SECOND = 1400000000
+TOP_LEVEL_DIR = '/tmp/benchmark_metadata'
+CHANNEL_NAME = 'junk0'
+SUBDIRECTORY = '2014-05-13T16-53-20'
+SECONDS_PER_MONTH = 30*24*3600
+
+
+def create_subdirectory(n_files):
+    """create_subdirectory creates a subdirectory with n_files empty rf files of one second, and their manifest
+    """
+    shutil.rmtree(TOP_LEVEL_DIR, ignore_errors=True)
+    subdirectory = os.path.join(TOP_LEVEL_DIR, CHANNEL_NAME, SUBDIRECTORY)
+    os.makedirs(subdirectory)
+    sub_dir_meta = digital_rf_hdf5._sub_directory_metadata(TOP_LEVEL_DIR, CHANNEL_NAME, 'local', SUBDIRECTORY)
+    manifest = numpy.zeros((n_files,), dtype=sub_dir_meta.manifest_t)
+    for i in range(n_files):
+        rf_basename = 'rf@%i.000.h5' % (START_SECOND + i)
+        open(os.path.join(subdirectory, rf_basename), 'w').close()
+        manifest['rf_basename'][i] = rf_basename
+    manifest['unix_sample_index'] = (START_SECOND + numpy.arange(n_files, dtype=numpy.uint64)) * SAMPLE_RATE
+    manifest['samples_per_file'] = FILE_SAMPLES
+    manifest['samples_written'] = FILE_SAMPLES
+    manifest['index_rows'] = 1
+    f = open(os.path.join(subdirectory, sub_dir_meta._manifest_basename), 'wb')
+    f.write(manifest.tostring())
+    f.close()
+    return(manifest)
+
+
+def test_build(n_files):
+    """test_build measures the time to build the complete metadata of n_files files from the manifest, and the
+    memory it takes
+    """
+    manifest = create_subdirectory(n_files)
+    sub_dir_meta = digital_rf_hdf5._sub_directory_metadata(TOP_LEVEL_DIR, CHANNEL_NAME, 'local', SUBDIRECTORY)
+    t = time.time()
+    sub_dir_meta.update()
+    seconds = time.time() - t
+    if len(sub_dir_meta.metadata) != n_files:
+        raise ValueError, 'expected %i metadata rows, got %i' % (n_files, len(sub_dir_meta.metadata))
+    n_bytes = sub_dir_meta.metadata.nbytes + sub_dir_meta.cont_metadata.nbytes
+    print('%i files: update took %f seconds, metadata %i bytes (%1.1f bytes per file, %1.1f MB per month)' % \
+        (n_files, seconds, n_bytes, n_bytes/float(n_files), n_bytes*SECONDS_PER_MONTH/(1.0E6*n_files)))
+
+    # a few files at a time, as added by update while the writer is running
+    sub_dir_meta = digital_rf_hdf5._sub_directory_metadata(TOP_LEVEL_DIR, CHANNEL_NAME, 'local', SUBDIRECTORY)
+    sub_dir_meta.samples_per_file = FILE_SAMPLES
+    new_rows = numpy.zeros((n_files,), dtype=sub_dir_meta.data_t)
+    new_rows['unix_sample_index'] = manifest['unix_sample_index']
+    new_rows['rf_file_key'] = digital_rf_hdf5._rf_file_keys(manifest['rf_basename'])
+    t = time.time()
+    for i in range(0, n_files, 10):
+        sub_dir_meta._append_metadata(new_rows[i:i+10])
+    seconds = time.time() - t
+    t = time.time()
+    sub_dir_meta._update_cont_metadata()
+    print('%i files: appending 10 files at a time took %f seconds, rebuilding cont_metadata %f seconds' % \
+        (n_files, seconds, time.time() - t))
+
+
+if len(sys.argv) > 1:
+    file_counts = [int(sys.argv[1])]
+else:
+    file_counts = [3600, 86400]
+for n_files in file_counts:
+    test_build(n_files)
+shutil.rmtree(TOP_LEVEL_DIR, ignore_errors=True)
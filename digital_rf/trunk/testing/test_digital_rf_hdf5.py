@@ -10,6 +10,7 @@ import datetime, time
 import traceback
 import glob
 import shutil
+import threading
 
 # third party imports
 import numpy
@@ -337,4 +338,390 @@ result = testReadObj.read_vector(start_index, end_index-start_index, 'junk1.01')
 if len(numpy.nonzero(result.imag.flatten())[0]) > 0:
     raise ValueError, 'Got imaginary part when not expected'
 
+print('Test of read_windows with windows inside and across data gaps')
+cont_data_arr = testReadObj.get_continuous_blocks(139436843434L, 139436843538L, 'junk4.1')
+first_block_start = long(cont_data_arr[0][0])
+first_block_len = long(cont_data_arr[0][1])
+starts = [first_block_start, first_block_start + first_block_len - 5, long(cont_data_arr[1][0])]
+result, valid = testReadObj.read_windows('junk4.1', starts, 10, subchannel=1)
+print('result.shape is %s' % (str(result.shape)))
+for i in (0, 2):
+    if not numpy.all(valid[i]):
+        raise ValueError, 'window %i should be valid' % (i)
+    expected = testReadObj.read_vector_c81d(starts[i], 10, 'junk4.1', subchannel=1)
+    if not numpy.all(result[i] == expected):
+        raise ValueError, 'read_windows disagrees with read_vector_c81d in window %i' % (i)
+if numpy.sum(valid[1]) != 5 or not numpy.all(valid[1][:5]):
+    raise ValueError, 'window across gap should have only its first 5 samples valid, got %s' % (str(valid[1]))
+
+print('Test of read_vector_c16d from double and integer channels')
+start_index, end_index = testReadObj.get_bounds('junk3.1')
+result = testReadObj.read_vector_c16d(start_index, end_index-start_index, 'junk3.1', subchannel=2)
+expected = testReadObj.read_vector_raw(start_index, end_index-start_index, 'junk3.1')[:,2]
+# samples past the end of the data in the last file are nan
+if result.dtype != numpy.complex128 or not numpy.all((result == expected) | (numpy.isnan(result) & numpy.isnan(expected))):
+    raise ValueError, 'read_vector_c16d disagrees with read_vector_raw for complex double channel'
+result = testReadObj.read_vector_c16d(cont_data_arr[0][0], cont_data_arr[0][1], 'junk4.1', subchannel=1)
+expected = testReadObj.read_vector_c81d(cont_data_arr[0][0], cont_data_arr[0][1], 'junk4.1', subchannel=1)
+if not numpy.all(result == expected):
+    raise ValueError, 'read_vector_c16d disagrees with read_vector_c81d for integer channel'
+try:
+    result = testReadObj.read_vector_c16d(cont_data_arr[0][0], cont_data_arr[0][1]+1, 'junk4.1')
+    raise ValueError, 'whoops - no error when reading across a gap with read_vector_c16d'
+except IOError:
+    pass
+
+print('Test of fill_gaps reads across a data gap')
+first_len = long(cont_data_arr[0][1])
+second_len = long(cont_data_arr[1][1])
+gap_len = long(cont_data_arr[1][0]) - long(cont_data_arr[0][0]) - first_len
+read_len = first_len + gap_len + second_len
+result = testReadObj.read_vector_c16d(cont_data_arr[0][0], read_len, 'junk4.1', subchannel=1, fill_gaps=True)
+missing = numpy.isnan(result)
+if numpy.sum(missing) != gap_len or not numpy.all(missing[first_len:first_len+gap_len]):
+    raise ValueError, 'expected %i nan samples at the gap, got %i' % (gap_len, numpy.sum(missing))
+result = testReadObj.read_vector_raw(cont_data_arr[0][0], read_len, 'junk4.1', fill_gaps=True)
+# mask of integer complex data has r and i fields
+if not numpy.all(result.mask[:,1]['r'] == missing):
+    raise ValueError, 'mask of read_vector_raw does not match gap'
+expected = testReadObj.read_vector_raw(cont_data_arr[1][0], second_len, 'junk4.1')
+if not numpy.all(result.data[first_len+gap_len:] == expected):
+    raise ValueError, 'read_vector_raw with fill_gaps disagrees with read_vector_raw after gap'
+
+print('Test of read_vector_into reusing caller supplied arrays')
+raw_result = testReadObj.read_vector_raw(cont_data_arr[0][0], first_len, 'junk4.1')
+out = numpy.empty(raw_result.shape, dtype=raw_result.dtype)
+if testReadObj.read_vector_into(out, cont_data_arr[0][0], 'junk4.1') != first_len or not numpy.all(out == raw_result):
+    raise ValueError, 'read_vector_into disagrees with read_vector_raw'
+out = numpy.empty((10,), dtype=numpy.complex64)
+for start_index in (cont_data_arr[0][0], cont_data_arr[1][0]):
+    testReadObj.read_vector_into(out, start_index, 'junk4.1', subchannel=1)
+    if not numpy.all(out == testReadObj.read_vector_c81d(start_index, 10, 'junk4.1', subchannel=1)):
+        raise ValueError, 'read_vector_into disagrees with read_vector_c81d at %i' % (start_index)
+out = numpy.empty((read_len,), dtype=numpy.complex128)
+if testReadObj.read_vector_into(out, cont_data_arr[0][0], 'junk4.1', subchannel=1, fill_gaps=True) != first_len + second_len:
+    raise ValueError, 'read_vector_into with fill_gaps returned wrong number of samples'
+if not numpy.all(numpy.isnan(out) == missing):
+    raise ValueError, 'read_vector_into with fill_gaps does not match gap'
+try:
+    testReadObj.read_vector_into(out, cont_data_arr[0][0], 'junk4.1', subchannel=1)
+    raise ValueError, 'whoops - no error when reading across a gap with read_vector_into'
+except IOError:
+    pass
+
+print('Test of iter_blocks reading ahead across a data gap')
+first_sample = long(cont_data_arr[0][0])
+expected = testReadObj.read_vector_c16d(first_sample, read_len, 'junk4.1', subchannel=1, fill_gaps=True)
+for prefetch in (0, 3):
+    blocks = list(testReadObj.iter_blocks('junk4.1', first_sample, first_sample + read_len, 7, prefetch,
+                                          subchannel=1, dtype=numpy.complex128, gaps='fill'))
+    if [unix_sample for unix_sample, data in blocks] != range(first_sample, first_sample + read_len, 7):
+        raise ValueError, 'iter_blocks returned wrong block starts with prefetch %i' % (prefetch)
+    result = numpy.concatenate([data for unix_sample, data in blocks])
+    if not numpy.all((result == expected) | (numpy.isnan(result) & numpy.isnan(expected))):
+        raise ValueError, 'iter_blocks disagrees with read_vector_c16d with prefetch %i' % (prefetch)
+    blocks = list(testReadObj.iter_blocks('junk4.1', first_sample, first_sample + read_len, 7, prefetch,
+                                          subchannel=1, gaps='skip'))
+    for unix_sample, data in blocks:
+        if numpy.any(numpy.isnan(expected[unix_sample - first_sample:unix_sample - first_sample + 7])):
+            raise ValueError, 'iter_blocks returned block at %i with missing data' % (unix_sample)
+    result = []
+    try:
+        for unix_sample, data in testReadObj.iter_blocks('junk4.1', first_sample, first_sample + read_len,
+                                                         first_len, prefetch, subchannel=1):
+            result.append(data)
+        raise ValueError, 'whoops - no error when iter_blocks reached a data gap'
+    except IOError:
+        pass
+    if len(result) != 1 or not numpy.all(result[0] == expected[0:first_len]):
+        raise ValueError, 'iter_blocks did not return the block before the gap with prefetch %i' % (prefetch)
+# blocks read ahead in threads, only as many as the open files fit in a small file pool
+smallPoolReadObj = digital_rf_hdf5.read_hdf5(['hdf5', 'hdf52'], file_pool_size=2)
+read_block = smallPoolReadObj._read_block
+block_threads = []
+def _record_read_block(*args):
+    block_threads.append(threading.current_thread().name)
+    return(read_block(*args))
+smallPoolReadObj._read_block = _record_read_block
+blocks = list(smallPoolReadObj.iter_blocks('junk4.1', first_sample, first_sample + read_len, 30, 3,
+                                           subchannel=1, dtype=numpy.complex128, gaps='fill'))
+result = numpy.concatenate([data for unix_sample, data in blocks])
+if not numpy.all((result == expected) | (numpy.isnan(result) & numpy.isnan(expected))):
+    raise ValueError, 'iter_blocks with a small file pool disagrees with read_vector_c16d'
+if threading.current_thread().name in block_threads or len(block_threads) != len(blocks):
+    raise ValueError, 'iter_blocks did not read blocks ahead in threads: %s' % (str(block_threads))
+smallPoolReadObj.close()
+
+print('Test of reading only selected subchannels')
+start_index, end_index = testReadObj.get_bounds('junk3.1')
+all_subchannels = testReadObj.read_vector_raw(start_index, end_index-start_index, 'junk3.1')
+def _same_or_nan(result, expected):
+    # samples past the end of the data in the last file are nan
+    return(numpy.all((result == expected) | (numpy.isnan(result) & numpy.isnan(expected))))
+for subchannels in ([2], [1, 2], [3, 0], [0, 2, 2]):
+    result = testReadObj.read_vector_raw(start_index, end_index-start_index, 'junk3.1', subchannels=subchannels)
+    if not _same_or_nan(result, all_subchannels[:,subchannels]):
+        raise ValueError, 'read_vector_raw of subchannels %s disagrees with all subchannels' % (str(subchannels))
+    result = testReadObj.read_vector_c81d(start_index, end_index-start_index, 'junk3.1', subchannel=subchannels)
+    if result.shape != (end_index-start_index, len(subchannels)) or \
+            not _same_or_nan(result, numpy.array(all_subchannels[:,subchannels], dtype=numpy.complex64)):
+        raise ValueError, 'read_vector_c81d of subchannels %s disagrees with all subchannels' % (str(subchannels))
+    result = testReadObj.read_vector_c16d(start_index, end_index-start_index, 'junk3.1', subchannel=subchannels)
+    if not _same_or_nan(result, all_subchannels[:,subchannels]):
+        raise ValueError, 'read_vector_c16d of subchannels %s disagrees with all subchannels' % (str(subchannels))
+result = testReadObj.read_vector_raw(cont_data_arr[0][0], read_len, 'junk4.1', fill_gaps=True, subchannels=[1])
+if result.shape != (read_len, 1) or not numpy.all(result.mask[:,0]['r'] == missing):
+    raise ValueError, 'read_vector_raw of one subchannel with fill_gaps does not match gap'
+try:
+    result = testReadObj.read_vector_raw(start_index, end_index-start_index, 'junk3.1', subchannels=[1, 4])
+    raise ValueError, 'whoops - no error when reading a subchannel that does not exist'
+except ValueError, e:
+    if str(e).find('does not have subchannel 4') == -1:
+        raise
+
+print('Test of reload only rescanning subdirectories that changed')
+bounds = testReadObj.get_bounds('junk4.1')
+testReadObj.reload()
+top_level_meta = testReadObj._channel_dict['junk4.1'].top_level_dir_meta_list[0]
+first_sub_dir_meta = top_level_meta.sub_directory_dict[top_level_meta.sub_directory_recarray['subdirectory'][0]]
+if first_sub_dir_meta.needs_update():
+    raise ValueError, 'unchanged subdirectory %s should not need an update' % (first_sub_dir_meta.subdirectory)
+dir_mtime = os.path.getmtime(first_sub_dir_meta.subdirectory)
+os.utime(first_sub_dir_meta.subdirectory, (dir_mtime + 1, dir_mtime + 1))
+if not first_sub_dir_meta.needs_update():
+    raise ValueError, 'modified subdirectory %s should need an update' % (first_sub_dir_meta.subdirectory)
+testReadObj.reload()
+if first_sub_dir_meta.needs_update():
+    raise ValueError, 'subdirectory %s should be up to date after reload' % (first_sub_dir_meta.subdirectory)
+if testReadObj.get_bounds('junk4.1') != bounds:
+    raise ValueError, 'bounds changed from %s to %s' % (str(bounds), str(testReadObj.get_bounds('junk4.1')))
+
+print('Test of metadata index file written by complete update')
+# subdirectories modified in the last few seconds are not indexed
+time.sleep(3)
+shutil.rmtree('/tmp/hdf5_index', ignore_errors=True)
+channel_dirs = ['/tmp/hdf5/junk4.1', '/tmp/hdf52/junk4.1']
+channel_dir_mtimes = [os.path.getmtime(channel_dir) for channel_dir in channel_dirs]
+fullReadObj = digital_rf_hdf5.read_hdf5(['hdf5', 'hdf52'], load_all_metadata=True, index_dir='/tmp/hdf5_index')
+index_file = fullReadObj._channel_dict['junk4.1'].top_level_dir_meta_list[0]._index_file
+if os.path.dirname(index_file) != '/tmp/hdf5_index' or not os.access(index_file, os.R_OK):
+    raise ValueError, 'no index file %s' % (index_file)
+# the index is kept outside the data, so the channel directories are not modified
+if [os.path.getmtime(channel_dir) for channel_dir in channel_dirs] != channel_dir_mtimes:
+    raise ValueError, 'channel directories %s modified by writing the index' % (str(channel_dirs))
+cont_data_arr = fullReadObj.get_continuous_blocks(bounds[0], bounds[1], 'junk4.1')
+# a second complete update must get all metadata from the index file, without reading any rf file
+get_new_rows = digital_rf_hdf5._sub_directory_metadata._get_new_rows
+def _no_rf_file_reads(self, rf_file_basename):
+    raise ValueError, 'rf file %s read although index file is up to date' % (rf_file_basename)
+digital_rf_hdf5._sub_directory_metadata._get_new_rows = _no_rf_file_reads
+try:
+    indexReadObj = digital_rf_hdf5.read_hdf5(['hdf5', 'hdf52'], load_all_metadata=True, index_dir='/tmp/hdf5_index')
+finally:
+    digital_rf_hdf5._sub_directory_metadata._get_new_rows = get_new_rows
+if not numpy.all(indexReadObj.get_continuous_blocks(bounds[0], bounds[1], 'junk4.1') == cont_data_arr):
+    raise ValueError, 'continuous blocks from index file differ'
+if indexReadObj.get_bounds('junk4.1') != fullReadObj.get_bounds('junk4.1'):
+    raise ValueError, 'bounds from index file differ'
+result = indexReadObj.read_vector_raw(cont_data_arr[1][0], cont_data_arr[1][1], 'junk4.1')
+if not numpy.all(result == fullReadObj.read_vector_raw(cont_data_arr[1][0], cont_data_arr[1][1], 'junk4.1')):
+    raise ValueError, 'read_vector_raw with metadata from index file differs'
+# an index entry of a subdirectory whose first file was written again (eg, a recording removed and made again
+# in the same place) is not used
+first_subdirectory = fullReadObj._channel_dict['junk4.1'].top_level_dir_meta_list[0].sub_directory_recarray['subdirectory'][0]
+first_rf_file = sorted(glob.glob(os.path.join(first_subdirectory, 'rf@*.h5')))[0]
+rf_file_mtime = os.path.getmtime(first_rf_file)
+os.utime(first_rf_file, (rf_file_mtime - 10, rf_file_mtime - 10))
+set_from_index = digital_rf_hdf5._sub_directory_metadata.set_from_index
+subdirectories_from_index = []
+def _record_set_from_index(self, *args):
+    set_from_index(self, *args)
+    if len(self.metadata) > 0:
+        subdirectories_from_index.append(os.path.join(self.top_level_dir, self.channel_name, self.subdirectory))
+digital_rf_hdf5._sub_directory_metadata.set_from_index = _record_set_from_index
+try:
+    staleReadObj = digital_rf_hdf5.read_hdf5(['hdf5', 'hdf52'], load_all_metadata=True, index_dir='/tmp/hdf5_index')
+finally:
+    digital_rf_hdf5._sub_directory_metadata.set_from_index = set_from_index
+if first_subdirectory in subdirectories_from_index or len(subdirectories_from_index) == 0:
+    raise ValueError, 'index entry of %s used although its first file changed' % (first_subdirectory)
+if not numpy.all(staleReadObj.get_continuous_blocks(bounds[0], bounds[1], 'junk4.1') == cont_data_arr):
+    raise ValueError, 'continuous blocks differ after first file changed'
+
+print('Test of metadata from manifest written by the writer')
+top_level_meta = fullReadObj._channel_dict['junk4.1'].top_level_dir_meta_list[0]
+for subdirectory in top_level_meta.sub_directory_recarray['subdirectory']:
+    if not os.access(os.path.join(subdirectory, 'rf_manifest.bin'), os.R_OK):
+        raise ValueError, 'no manifest in %s' % (subdirectory)
+    sub_dir_meta = digital_rf_hdf5._sub_directory_metadata(top_level_meta.top_level_dir, 'junk4.1', 'local', subdirectory)
+    digital_rf_hdf5._sub_directory_metadata._get_new_rows = _no_rf_file_reads
+    try:
+        sub_dir_meta.update()
+    finally:
+        digital_rf_hdf5._sub_directory_metadata._get_new_rows = get_new_rows
+    # same metadata read from the rf files
+    expected = digital_rf_hdf5._sub_directory_metadata(top_level_meta.top_level_dir, 'junk4.1', 'local', subdirectory)
+    expected._read_manifest = lambda: None
+    expected.update()
+    if not numpy.all(sub_dir_meta.metadata == expected.metadata) or \
+            not numpy.all(sub_dir_meta.cont_metadata == expected.cont_metadata):
+        raise ValueError, 'metadata from manifest differs in %s' % (subdirectory)
+    # rf file names are stored as integer keys
+    rf_basename_list = [os.path.basename(rf_file) for rf_file in sub_dir_meta._get_rf_file_list()]
+    for rf_file_key in sub_dir_meta.metadata['rf_file_key']:
+        if digital_rf_hdf5._rf_basename(rf_file_key) not in rf_basename_list:
+            raise ValueError, 'no rf file %s in %s' % (digital_rf_hdf5._rf_basename(rf_file_key), subdirectory)
+
+print('Test of rf files kept open between interleaved reads of two channels')
+poolReadObj = digital_rf_hdf5.read_hdf5(['hdf5', 'hdf52'], file_pool_size=2)
+for i in range(3):
+    for channel_name in ('junk0', 'junk3'):
+        start_index, end_index = poolReadObj.get_bounds(channel_name)
+        result = poolReadObj.read_vector_c81d(start_index + i, 10, channel_name)
+stats = poolReadObj.get_file_pool_stats()
+if stats['misses'] != 2 or stats['hits'] != 4 or stats['open_files'] != 2:
+    raise ValueError, 'unexpected file pool stats %s' % (str(stats))
+# a deleted file must be closed and give an IOError, not data from the open file
+start_index, end_index = poolReadObj.get_bounds('junk0')
+full_hdf5_file = poolReadObj._get_read_plan(start_index, start_index + 10, 'junk0')[0][0]
+os.rename(full_hdf5_file, full_hdf5_file + '.moved')
+try:
+    try:
+        poolReadObj.read_vector_c16d(start_index, 10, 'junk0')
+        raise ValueError, 'no error reading deleted file %s' % (full_hdf5_file)
+    except IOError:
+        pass
+finally:
+    os.rename(full_hdf5_file + '.moved', full_hdf5_file)
+if poolReadObj.get_file_pool_stats()['open_files'] != 1:
+    raise ValueError, 'deleted file %s still open' % (full_hdf5_file)
+poolReadObj.close()
+if poolReadObj.get_file_pool_stats()['open_files'] != 0:
+    raise ValueError, 'files still open after close'
+
+print('Test of reload and reads only listing directories that changed')
+bounds = fullReadObj.get_bounds('junk4.1')
+# directories modified in the last few seconds (here by moving an rf file) are always listed
+time.sleep(3)
+fullReadObj.reload()
+stats = fullReadObj.get_dir_cache_stats()
+fullReadObj.reload()
+fullReadObj.get_continuous_blocks(bounds[0], bounds[1], 'junk4.1')
+fullReadObj.read_vector_c81d(bounds[0], 10, 'junk4.1')
+if fullReadObj.get_dir_cache_stats()['listings'] != stats['listings']:
+    raise ValueError, 'unchanged directories listed again: %s then %s' % (str(stats), str(fullReadObj.get_dir_cache_stats()))
+# a removed subdirectory is pruned by the next reload, and added again when it comes back
+top_level_meta = fullReadObj._channel_dict['junk4.1'].top_level_dir_meta_list[-1]
+last_subdirectory = top_level_meta.sub_directory_recarray['subdirectory'][-1]
+subdirectory_count = len(top_level_meta.sub_directory_recarray)
+os.rename(last_subdirectory, last_subdirectory + '.moved')
+try:
+    fullReadObj.reload()
+    if len(top_level_meta.sub_directory_recarray) != subdirectory_count - 1 or \
+            last_subdirectory in top_level_meta.sub_directory_dict:
+        raise ValueError, 'removed subdirectory %s not pruned' % (last_subdirectory)
+    if fullReadObj.get_bounds('junk4.1')[1] >= bounds[1]:
+        raise ValueError, 'bounds %s not reduced after removing %s' % (str(fullReadObj.get_bounds('junk4.1')),
+                                                                     last_subdirectory)
+finally:
+    os.rename(last_subdirectory + '.moved', last_subdirectory)
+fullReadObj.reload()
+if fullReadObj.get_bounds('junk4.1') != bounds:
+    raise ValueError, 'bounds %s not restored to %s' % (str(fullReadObj.get_bounds('junk4.1')), str(bounds))
+
+print('Test of reads with partial metadata finding rf files without globbing')
+partialReadObj = digital_rf_hdf5.read_hdf5(['hdf5', 'hdf52'])
+cont_data_arr = fullReadObj.get_continuous_blocks(bounds[0], bounds[1], 'junk4.1')
+real_glob = glob.glob
+def _no_glob(pathname):
+    raise ValueError, 'glob of %s when reading with partial metadata' % (pathname)
+glob.glob = _no_glob
+try:
+    for unix_sample, length in cont_data_arr:
+        # whole blocks, and blocks from the middle, whose file may be named seconds earlier in another subdirectory
+        for offset in (0, length / 2):
+            result = partialReadObj.read_vector_raw(unix_sample + offset, length - offset, 'junk4.1')
+            if not numpy.all(result == fullReadObj.read_vector_raw(unix_sample + offset, length - offset, 'junk4.1')):
+                raise ValueError, 'read with partial metadata at %i differs' % (unix_sample + offset)
+    # a read starting in a gap is an error, not data from the next block
+    try:
+        partialReadObj.read_vector_raw(cont_data_arr[1][0] - 1, 2, 'junk4.1')
+    except IOError:
+        pass
+    else:
+        raise ValueError, 'no IOError reading from a gap with partial metadata'
+finally:
+    glob.glob = real_glob
+
+print('Test of memory mapped reads of uncompressed data')
+def _same_data(a, b):
+    # compares bytes, since NaN fill (as at the end of junk3.1) never compares equal
+    return(a.shape == b.shape and a.dtype == b.dtype and a.tostring() == b.tostring())
+mmapReadObj = digital_rf_hdf5.read_hdf5(['hdf5', 'hdf52'], load_all_metadata=True)
+hdf5ReadObj = digital_rf_hdf5.read_hdf5(['hdf5', 'hdf52'], load_all_metadata=True, use_mmap=False)
+for channel_name in ('junk0.1', 'junk1.2', 'junk3.1', 'junk4.1'):
+    start_index, end_index = mmapReadObj.get_bounds(channel_name)
+    for unix_sample, length in mmapReadObj.get_continuous_blocks(start_index, end_index, channel_name):
+        result = mmapReadObj.read_vector_raw(unix_sample, length, channel_name)
+        if not result.flags.writeable or \
+                not _same_data(result, hdf5ReadObj.read_vector_raw(unix_sample, length, channel_name)):
+            raise ValueError, 'memory mapped read of %s at %i differs' % (channel_name, unix_sample)
+        result = mmapReadObj.read_vector_raw(unix_sample, length, channel_name, subchannels=[2, 0])
+        if not _same_data(result, hdf5ReadObj.read_vector_raw(unix_sample, length, channel_name, subchannels=[2, 0])):
+            raise ValueError, 'memory mapped read of subchannels of %s at %i differs' % (channel_name, unix_sample)
+    full_hdf5_file = mmapReadObj._get_read_plan(start_index, start_index + 10, channel_name)[0][0]
+    rf_data = mmapReadObj._file_pool.get_rf_data(full_hdf5_file)
+    # junk4.1 is compressed, so it is read by Hdf5
+    if isinstance(rf_data, numpy.memmap) != (channel_name != 'junk4.1'):
+        raise ValueError, 'wrong rf_data type %s for %s' % (str(type(rf_data)), channel_name)
+    if channel_name != 'junk4.1':
+        result = mmapReadObj.read_vector_raw(start_index, 10, channel_name, copy=False)
+        if result.flags.writeable:
+            raise ValueError, 'read of %s with copy=False is not a view of the file' % (channel_name)
+mmapReadObj.close()
+
+print('Test of reading several channels at once')
+channel_names = ['junk0', 'junk0.1', 'junk3']
+start_index = max([fullReadObj.get_bounds(channel_name)[0] for channel_name in channel_names])
+for subchannel in (1, [3, 0]):
+    result = fullReadObj.read_vectors(channel_names, start_index, 70, subchannel, dtype=numpy.complex128)
+    as_dict = fullReadObj.read_vectors(channel_names, start_index, 70, subchannel, dtype=numpy.complex128, as_dict=True)
+    for i, channel_name in enumerate(channel_names):
+        expected = fullReadObj.read_vector_c16d(start_index, 70, channel_name, subchannel)
+        if not numpy.all(result[i] == expected) or not numpy.all(as_dict[channel_name] == expected):
+            raise ValueError, 'read_vectors of %s subchannel %s disagrees with read_vector_c16d' % (channel_name,
+                                                                                                  str(subchannel))
+# junk4.1 has a gap after read_len samples from first_block_start
+try:
+    fullReadObj.read_vectors(['junk4.1', 'junk4.1'], first_block_start, read_len)
+    raise ValueError, 'whoops - no error when read_vectors reached a data gap'
+except IOError, e:
+    if str(e).find('junk4.1') == -1:
+        raise
+result = fullReadObj.read_vectors(['junk4.1', 'junk4.1'], first_block_start, read_len, subchannel=1, fill_gaps=True)
+if not numpy.all(numpy.isnan(result[1]) == missing):
+    raise ValueError, 'read_vectors with fill_gaps does not match gap'
+fullReadObj.close()
+
+print('Test of a complete update skipping a subdirectory with only a file still being written')
+shutil.rmtree('/tmp/hdf5_incomplete', ignore_errors=True)
+shutil.copytree('/tmp/hdf5/junk0', '/tmp/hdf5_incomplete/junk0')
+for rf_file in glob.glob('/tmp/hdf5_incomplete/junk0/*/rf@*.h5'):
+    os.utime(rf_file, (time.time() - 60, time.time() - 60))
+incompleteReadObj = digital_rf_hdf5.read_hdf5('/tmp/hdf5_incomplete')
+bounds = digital_rf_hdf5.read_hdf5('/tmp/hdf5_incomplete', load_all_metadata=True).get_bounds('junk0')
+subdirectory = sorted(glob.glob('/tmp/hdf5_incomplete/junk0/*T*'))[-1]
+subDirDT = datetime.datetime.strptime(os.path.basename(subdirectory), '%Y-%m-%dT%H-%M-%S') + datetime.timedelta(hours=1)
+new_subdirectory = os.path.join('/tmp/hdf5_incomplete/junk0', subDirDT.strftime('%Y-%m-%dT%H-%M-%S'))
+os.mkdir(new_subdirectory)
+# a new file counts as still being written
+shutil.copyfile(glob.glob(os.path.join(subdirectory, 'rf@*.h5'))[0],
+                os.path.join(new_subdirectory, 'rf@%i.000.h5' % ((subDirDT - datetime.datetime(1970,1,1)).total_seconds())))
+# new subdirectory first estimated by the partial metadata, then by a complete update
+incompleteReadObj.reload()
+incompleteReadObj.get_continuous_blocks(bounds[0], bounds[1], 'junk0')
+if digital_rf_hdf5.read_hdf5('/tmp/hdf5_incomplete', load_all_metadata=True).get_bounds('junk0') != bounds:
+    raise ValueError, 'bounds changed by a subdirectory with only a file still being written'
+shutil.rmtree('/tmp/hdf5_incomplete')
+
 print('Overall test passed')
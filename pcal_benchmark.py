@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+#
+# End-to-end benchmark of the phasecal chain with synthetic data.
+#
+# Two channels of 16 bit samples at 25 MHz are generated, a tone at
+# 5 MHz on channel 0 and a tone at 5 MHz + 1 kHz on channel 1, with a
+# known time varying delay on channel 0. These are down converted the
+# same way as the dddc block (gr-drf/lib/dddc_impl.cc), written with
+# digital_rf in the same layout as pcal_rec.py records, read back and
+# turned into delays with pcal_get_delay. No USRP or GNU Radio is needed.
+#
+# The down conversion is a numpy model of dddc, not the C++ block itself,
+# which writes to a fixed directory and needs the rx_time tags of a USRP.
+# Its throughput says nothing about dddc regressions or the CPU needed to
+# record; it is reported separately and labelled as such.
+#
+# Reports writer latency per file, reader time per hour of data, the error
+# of the recovered delay and the throughput of the down conversion model.
+#
+import digital_rf_hdf5 as drf
+import numpy as n
+import scipy.signal
+import os, shutil, tempfile, time
+import pcal_get_delay
+from optparse import OptionParser
+
+# same as pcal_rec.py
+sample_rate = 25000000
+centerfreq0 = 5e6
+centerfreq1 = 214791314.0*100e6/float(2**32)
+window_len = 250000
+# output samples per file in dddc
+n_out = 100
+
+# 16 bit sample scaling in dddc
+scale = 1.0/16384.0
+
+def injected_delay(t, amplitude, period):
+    """ delay (s) of channel 0 at time t (seconds since start) """
+    return(amplitude*n.sin(2.0*n.pi*t/period))
+
+def synthetic_sc16(i0, n_samples, amplitude, delay_amplitude, delay_period, noise):
+    """
+    Interleaved 16 bit samples of both channels, as the USRP delivers them,
+    starting at sample i0 (counted from the start of the benchmark)
+    """
+    t = (i0 + n.arange(n_samples, dtype=n.float64))/sample_rate
+    tau = injected_delay(t, delay_amplitude, delay_period)
+    x = n.zeros(2*n_samples, dtype=n.float64)
+    x[0::2] = amplitude*n.cos(2.0*n.pi*centerfreq0*(t - tau))
+    x[1::2] = amplitude*n.cos(2.0*n.pi*centerfreq1*t)
+    if noise > 0.0:
+        x += noise*n.random.randn(2*n_samples)
+    return(n.array(n.round(x), dtype=n.int16))
+
+class dddc:
+    """
+    Numpy model of the double precision dual channel down converter, same
+    arithmetic as dddc_impl: windowed mixing of each block of window_len
+    samples into one output sample. The DC offset is not estimated, synthetic
+    data has none. Not a substitute for timing dddc_impl.
+    """
+    def __init__(self, coef):
+        i = n.arange(window_len, dtype=n.float64)
+        self.dsin0 = coef*n.exp(1j*2.0*n.pi*centerfreq0*i/sample_rate)
+        self.dsin1 = coef*n.exp(1j*2.0*n.pi*centerfreq1*i/sample_rate)
+        self.win_idx = 0
+
+    def consume(self, x):
+        """ output samples of both channels for x, which holds a whole number of windows """
+        n_win = len(x)/(2*window_len)
+        s0 = (x[0::2]*scale).reshape((n_win, window_len))
+        s1 = (x[1::2]*scale).reshape((n_win, window_len))
+        # phase of the mixer at the start of each window
+        k = self.win_idx + n.arange(n_win, dtype=n.float64)
+        phase0 = n.exp(1j*2.0*n.pi*centerfreq0*k*window_len/sample_rate)
+        phase1 = n.exp(1j*2.0*n.pi*centerfreq1*k*window_len/sample_rate)
+        z0 = phase0*(n.dot(s0, self.dsin0.real) + 1j*n.dot(s0, self.dsin0.imag))
+        z1 = phase1*(n.dot(s1, self.dsin1.real) + 1j*n.dot(s1, self.dsin1.imag))
+        self.win_idx += n_win
+        return(z0, z1)
+
+def run(dirn, duration, integrate, amplitude, delay_amplitude, delay_period, noise, t0=1448903000):
+    out_rate = sample_rate/window_len
+    n_files = int(duration*out_rate)/n_out
+    start = long(t0*out_rate)
+    coef = n.array(n.real(scipy.signal.blackmanharris(window_len)), dtype=n.float64)
+
+    writers = []
+    for ch in ["000", "001"]:
+        os.makedirs(os.path.join(dirn, ch))
+        writers.append(drf.write_hdf5_channel(os.path.join(dirn, ch), "d", n_out, 3600, start, out_rate,
+                                              "THIS_UUID_LACKS_ENTROPY", 0, False, True, 1, False))
+
+    dc = dddc(coef)
+    t_gen = 0.0
+    t_ddc = 0.0
+    t_write = []
+    arr = n.zeros((n_out, 2), dtype=n.float64)
+    for fi in range(n_files):
+        tt = time.time()
+        x = synthetic_sc16(long(fi)*n_out*window_len, n_out*window_len, amplitude, delay_amplitude, delay_period, noise)
+        t_gen += time.time() - tt
+
+        tt = time.time()
+        zs = dc.consume(x)
+        t_ddc += time.time() - tt
+
+        # one file per channel, as dddc writes
+        tt = time.time()
+        for ci in range(2):
+            arr[:,0] = zs[ci].real
+            arr[:,1] = zs[ci].imag
+            writers[ci].rf_write(arr)
+        t_write.append(time.time() - tt)
+    for w in writers:
+        w.close()
+    t_write = n.array(t_write)
+
+    # files modified in the last few seconds are considered to be still written
+    time.sleep(4)
+
+    tt = time.time()
+    d = drf.read_hdf5(dirn)
+    tvec, z0, z1 = pcal_get_delay.get_range(d, t0, t0 + n_files*n_out/out_rate, integrate)
+    t_read = time.time() - tt
+
+    delay_ps = pcal_get_delay.phase_to_delay(z0, z1)
+    # injected delay averaged over each integration window, relative to the first window
+    t = n.arange(len(tvec)*integrate, dtype=n.float64)/out_rate + 0.5/out_rate
+    tau_ps = 1e12*n.mean(injected_delay(t, delay_amplitude, delay_period).reshape((len(tvec), integrate)), axis=1)
+    err_ps = (delay_ps - delay_ps[0]) - (tau_ps - tau_ps[0])
+
+    n_samples = float(n_files*n_out*window_len)
+    print("samples %d (%1.1f s at %1.1f MHz), %d files per channel"%(n_samples, n_samples/sample_rate, sample_rate/1e6, n_files))
+    print("synthesis %1.2f Msamples/s (not part of the chain)"%(n_samples/t_gen/1e6))
+    print("down conversion (numpy model, not dddc) %1.2f Msamples/s (%1.2f x real time)"%(n_samples/t_ddc/1e6, n_samples/sample_rate/t_ddc))
+    print("writer latency per file (both channels) mean %1.3f ms max %1.3f ms"%(1e3*n.mean(t_write), 1e3*n.max(t_write)))
+    print("reader %1.3f s per hour of data (integration %1.2f s)"%(t_read*3600.0/(n_samples/sample_rate), integrate/out_rate))
+    print("delay error rms %1.4f ps max %1.4f ps (injected %1.1f ps amplitude, %1.1f s period)"%(n.sqrt(n.mean(err_ps**2.0)), n.max(n.abs(err_ps)), 1e12*delay_amplitude, delay_period))
+
+if __name__ == "__main__":
+    parser = OptionParser()
+    parser.add_option("-d", "--dir", dest="dir", type="string", default=None,
+                      help="Directory to write to, must not exist. (default temporary directory, removed afterwards)")
+    parser.add_option("-t", "--duration", dest="duration", type="float", default=10.0,
+                      help="Seconds of data to generate. (default %default)")
+    parser.add_option("-i", "--integrate", dest="integrate", type="int", default=100,
+                      help="Integration factor (default %default)")
+    parser.add_option("-a", "--amplitude", dest="amplitude", type="float", default=8000.0,
+                      help="Tone amplitude in ADC units (default %default)")
+    # without noise, rounding to 16 bits is periodic with the tone and biases the phase
+    parser.add_option("-n", "--noise", dest="noise", type="float", default=10.0,
+                      help="Noise standard deviation in ADC units (default %default)")
+    parser.add_option("--delay_amplitude", dest="delay_amplitude", type="float", default=10.0,
+                      help="Amplitude of injected delay in ps (default %default)")
+    parser.add_option("--delay_period", dest="delay_period", type="float", default=20.0,
+                      help="Period of injected delay in seconds (default %default)")
+    (op, args) = parser.parse_args()
+
+    if op.dir is None:
+        dirn = tempfile.mkdtemp(prefix="pcal_benchmark")
+    else:
+        os.makedirs(op.dir)
+        dirn = op.dir
+    try:
+        run(dirn, op.duration, op.integrate, op.amplitude, op.delay_amplitude*1e-12, op.delay_period, op.noise)
+    finally:
+        if op.dir is None:
+            shutil.rmtree(dirn)
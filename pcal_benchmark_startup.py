@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+#
+# Startup time of the phasecal tools.
+#
+# Each module is imported in a fresh python process, a number of times,
+# and the median import time is reported, together with the heavy
+# modules that were loaded. Short queries (pcal_get_delay.py -n or -a)
+# are dominated by this, so it should stay small.
+#
+import subprocess
+import sys
+import numpy as n
+from optparse import OptionParser
+
+modules = ["stuffr", "pcal_get_delay", "pcal_pyramid", "pcal_server"]
+
+# modules that none of the tools need unless plotting or fitting
+heavy_modules = ["matplotlib", "scipy"]
+
+_probe = """
+import sys, time
+t0 = time.time()
+import %s
+print(time.time() - t0)
+print(" ".join([m for m in %s if m in sys.modules]))
+"""
+
+def import_time(module, repeats=5):
+    """ median import time (s) of module in a fresh process, and the heavy modules it loads """
+    times = []
+    for ri in range(repeats):
+        out = subprocess.check_output([sys.executable, "-c", _probe%(module, repr(heavy_modules))])
+        lines = out.split("\n")
+        times.append(float(lines[0]))
+    return(n.median(times), lines[1].split())
+
+if __name__ == "__main__":
+    parser = OptionParser()
+    parser.add_option("-n", "--repeats", dest="repeats", type="int", default=5,
+                      help="Number of imports of each module. (default %default)")
+    parser.add_option("-m", "--max_ms", dest="max_ms", type="float", default=None,
+                      help="Exit with an error if any import takes longer than this (ms)")
+    (op, args) = parser.parse_args()
+
+    slow = False
+    for m in modules:
+        t, loaded = import_time(m, op.repeats)
+        print("%-16s %7.1f ms  heavy modules: %s"%(m, 1e3*t, " ".join(loaded) if len(loaded) > 0 else "none"))
+        if op.max_ms is not None and 1e3*t > op.max_ms:
+            slow = True
+    if slow:
+        print("Import time over %1.1f ms"%(op.max_ms))
+        exit(1)
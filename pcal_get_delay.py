@@ -2,121 +2,367 @@
 
 import h5py
 import digital_rf_hdf5 as drf
-import matplotlib.pyplot as plt
 import numpy as n
-import sys, time
+import sys, time, os
+import multiprocessing
 import stuffr
+import pcal_pyramid
 from optparse import OptionParser
 
-parser = OptionParser()
-parser.add_option("-d", "--dir", dest="dir", type="string", default="/data/phasecal",
-                  help="Directory. (default %default)")
+sample_rate = 100.0
 
-parser.add_option("-i", "--integrate",dest="integrate", action="store",default=100, type="int", help="Integration factor (default %default)")
+# samples of raw data per channel read at once in get_range, one hour at 100 Hz
+chunk_samples = 360000
 
-parser.add_option("-b", "--baseline_time",dest="baseline_time", action="store",default=-1.0, type="float", help="Time to use as reference for cable delay, unix seconds. Default, now - 5 minutes")
+# reader of pool worker processes, see make_pool
+_worker_d = None
 
-parser.add_option("-0", "--t0",dest="t0", action="store",default=-1.0, type="float", help="Start time in unix seconds, default: now-5 minutes")
+def phase_to_delay(z0, z1):
+    # phase in 5 MHz to picoseconds ( (1/5e6)/ 1e-12)
+    return(200e3*n.angle(z0/z1)/2.0/n.pi)
 
-parser.add_option("-1", "--t1",dest="t1", action="store",default=-1.0, type="float", help="End time in unix seconds, default: now")
+def get_reference_delay(d, baseline_time, integrate):
+    """ delay in ps at baseline_time (unix seconds). IOError if there is no data """
+    z0, z1 = n.mean(d.read_vectors(["000","001"],long(baseline_time*sample_rate),integrate,dtype=n.complex128),axis=1)
+    return(phase_to_delay(z0,z1))
 
-parser.add_option("-p", "--plot",dest="plot", action="store_true",help="plot relative time delay")
+def get_latest(d, integrate):
+    """ (t0, t1, delay) of the last integrate samples of recorded data """
+    b1 = d.get_bounds("001")
+    idx0 = long(b1[1]-integrate)
+    idx1 = long(b1[1])
+    z0, z1 = n.mean(d.read_vectors(["000","001"],idx0,integrate,dtype=n.complex128),axis=1)
+    return(idx0/sample_rate, idx1/sample_rate, phase_to_delay(z0,z1))
 
-parser.add_option("-o", "--overview_plot",dest="overview_plot", action="store_true",help="plot sparse overview plot")
+def get_overview(d, t0, t1, integrate, n_overview=300):
+    """
+    Mean phasors of n_overview windows evenly spread between t0 and t1.
+    Returns (tvec, z0, z1, missing), windows with missing data are nan.
+    """
+    t0s = n.floor(sample_rate*n.linspace(t0,t1,num=n_overview))
 
-parser.add_option("-a", "--ascii_out",dest="ascii_out", action="store_true",help="output delays in ascii")
+    tvec = t0s/sample_rate
 
-parser.add_option("-n", "--latest",dest="latest", action="store_true",help="Latest recorded delay")
+    # read all windows at once, each file is only opened once
+    zw0, valid0 = d.read_windows("000",t0s,integrate,dtype=n.complex128)
+    zw1, valid1 = d.read_windows("001",t0s,integrate,dtype=n.complex128)
+    z0 = n.mean(zw0,axis=1)
+    z1 = n.mean(zw1,axis=1)
 
-(op, args) = parser.parse_args()
+    missing = n.logical_not(n.logical_and(n.all(valid0,axis=1),n.all(valid1,axis=1)))
+    z0[missing]=n.nan
+    z1[missing]=n.nan
+    return(tvec, z0, z1, missing)
 
-d=drf.read_hdf5(op.dir)
-b0=d.get_bounds("000")
-b1=d.get_bounds("001")
-sample_rate = 100.0
-#print(b0)
-#print(b1)
-
-t_now = time.time()
-if op.baseline_time < 0.0:
-    op.baseline_time = t_now - 5*60.0
-
-if op.t0 < 0.0:
-    op.t0 = t_now - 5*60.0
-
-if op.t1 < 0.0:
-    op.t1 = b0[1]/sample_rate - 2
-
-# get baseline
-try:
-    z0 = n.mean(d.read_vector_c81d(long(op.baseline_time*sample_rate),op.integrate,"000"))
-                            
-    z1 = n.mean(d.read_vector_c81d(long(op.baseline_time*sample_rate),op.integrate,"001"))
-except:
-    print("Couldn't find data for determining baseline delay at %s"%(stuffr.unix2datestr(op.baseline_time)))
-    exit(0)
-
-    
-
-# phase in 5 MHz to picoseconds ( (1/5e6)/ 1e-12)
-reference_delay_ps = 200e3*n.angle(z0/z1)/2.0/n.pi
-#print(""reference_delay_ps)
-n_samples = long(n.floor((op.t1-op.t0)*sample_rate))
-
-# if overview plot, calculate delay sparsely over span of data
-if op.latest:
-    idx0 = long(b1[1]-op.integrate)
-    idx1 = long(b1[1])
-    z0 = n.mean(d.read_vector_c81d(b1[1]-op.integrate,op.integrate,"000"))
-    z1 = n.mean(d.read_vector_c81d(b1[1]-op.integrate,op.integrate,"001"))
-    delay_ps = 200e3*n.angle(z0/z1)/2.0/n.pi - reference_delay_ps 
-    print("t0 %1.3f t1 %1.3f delay %1.3f reference time %1.2f"%(idx0/sample_rate,idx1/sample_rate,delay_ps,op.baseline_time))
-    exit(0)
-    
-if op.overview_plot:
-    n_overview = 300
-    z0 = n.zeros(n_overview,dtype=n.complex64)
-    z1 = n.zeros(n_overview,dtype=n.complex64)
-    
-    t0s = n.floor(sample_rate*n.linspace(op.t0,op.t1,num=n_overview))
+def _init_worker(dirn):
+    global _worker_d
+    _worker_d = drf.read_hdf5(dirn)
 
-    tvec = t0s/sample_rate
+def make_pool(dirn, processes=None):
+    """ process pool for get_range, each worker keeps its own reader of dirn open """
+    return(multiprocessing.Pool(processes, _init_worker, (dirn,)))
+
+class lazy_pool:
+    """ pool of make_pool(dirn, processes), started on first use so that ranges without raw data start no workers """
+    def __init__(self, dirn, processes=None):
+        self.dirn = dirn
+        self.processes = processes
+        self.pool = None
+
+    def map(self, func, iterable, chunksize=None):
+        if self.pool is None:
+            self.pool = make_pool(self.dirn, self.processes)
+        return(self.pool.map(func, iterable, chunksize))
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+
+def _chunk_edges(d, s0, s1):
+    """
+    Edges of chunks of about chunk_samples samples between samples s0 and s1. Inner
+    edges are on rf file boundaries (counted from the first sample of channel 000,
+    a gap in the data shifts later files), so no file is read by two chunks.
+    """
+    samples_per_file = long(d.get_rf_file_metadata("000")["samples_per_file"][0])
+    step = max(1, chunk_samples/samples_per_file)*samples_per_file
+    first = d.get_bounds("000")[0]
+    e0 = first + ((s0 - first)/step + 1)*step
+    return([s0] + range(e0, s1, step) + [s1])
+
+def _read_chunk(d, a, b, s0, integrate):
+    """
+    Sums of samples a to b (excluding) of both channels in windows of integrate samples from s0,
+    nan if data is missing. Returns (index of the first window, sums of shape (2, windows)),
+    the first and last window may be partial.
+    """
+    # both channels are read at the same time
+    z = d.read_vectors(["000","001"],a,b - a,dtype=n.complex128,fill_gaps=True)
+    pre = (a - s0) % integrate
+    n_w = (pre + b - a + integrate - 1)/integrate
+    if pre != 0 or n_w*integrate != b - a:
+        zp = n.zeros((2, n_w*integrate), dtype=n.complex128)
+        zp[:, pre:(pre + b - a)] = z
+        z = zp
+    return((a - s0)/integrate, n.sum(z.reshape((2, n_w, integrate)), axis=2))
+
+def _read_chunk_worker(args):
+    a, b, s0, integrate = args
+    # data may have been recorded since the worker opened the reader
+    if b > min(_worker_d.get_bounds("000")[1],_worker_d.get_bounds("001")[1]):
+        _worker_d.reload()
+    return(_read_chunk(_worker_d, a, b, s0, integrate))
+
+def get_range(d, t0, t1, integrate, pyramid_file=None, pool=None):
+    """
+    Mean phasors of consecutive windows of integrate samples between t0 and t1.
+    Precomputed sums in pyramid_file are used if given and it exists.
+    Raw data is processed in chunks of about chunk_samples samples, in parallel
+    if a pool made with make_pool (or a lazy_pool) is given.
+    Returns (tvec, z0, z1), windows with missing data are nan.
+    """
+    n_samples = long(n.floor((t1-t0)*sample_rate))
+    n_windows = long(n_samples/integrate)
+    z0, z1 = get_windows(d,long(t0*sample_rate),n_windows,integrate,pyramid_file,pool)
+    tvec = integrate*n.arange(len(z0))/sample_rate + t0
+    return(tvec, z0, z1)
+
+def get_windows(d, i0, n_windows, integrate, pyramid_file=None, pool=None):
+    """
+    Mean phasors of n_windows consecutive windows of integrate samples starting
+    at sample i0, as get_range. Returns (z0, z1), windows with missing data are nan.
+    """
+    z0 = n.zeros(0,dtype=n.complex128)
+    z1 = n.zeros(0,dtype=n.complex128)
+
+    # use precomputed sums for as much of the range as possible
+    if pyramid_file is not None and os.path.exists(pyramid_file):
+        try:
+            res = pcal_pyramid.read_pyramid(pyramid_file,i0,integrate,n_windows,d)
+            if res is not None:
+                z0, z1 = res
+        except IOError:
+            # stdout may be the csv or server output
+            sys.stderr.write("Couldn't read %s, using raw data\n"%(pyramid_file))
+
+    # rest from raw data, windows with missing data are nan
+    if len(z0) < n_windows:
+        s0 = i0 + len(z0)*integrate
+        n_left = n_windows - len(z0)
+        # windows on a chunk edge are summed from both chunks
+        edges = _chunk_edges(d, s0, s0 + n_left*integrate)
+        chunks = [(edges[k], edges[k + 1], s0, integrate) for k in range(len(edges) - 1)]
+        if pool is not None and len(chunks) > 1:
+            res = pool.map(_read_chunk_worker, chunks, 1)
+        else:
+            res = [_read_chunk(d, a, b, cs0, cint) for a, b, cs0, cint in chunks]
+        sums = n.zeros((2, n_left), dtype=n.complex128)
+        for w, chunk_sums in res:
+            sums[:, w:(w + chunk_sums.shape[1])] += chunk_sums
+        z0 = n.concatenate((z0, sums[0]/float(integrate)))
+        z1 = n.concatenate((z1, sums[1]/float(integrate)))
+    return(z0, z1)
+
+def write_header(fo, baseline_time, reference_delay_ps, integrate):
+    fo.write("# pcal out\n")
+    fo.write("# reference delay at %1.2f (unix seconds), ref: %1.2f (ps)\n"%(baseline_time,reference_delay_ps))
+    fo.write("# integration %1.2f (seconds)\n"%(integrate/sample_rate))
+    fo.write("# time (unix seconds), delay (ps)\n")
+
+def write_delays_ascii(fo, tvec, delay_ps, sep=" ", block_len=100000):
+    """ write time and delay columns, a whole block of rows is formatted at once """
+    for i in range(0,len(tvec),block_len):
+        cols = n.column_stack((tvec[i:(i+block_len)],delay_ps[i:(i+block_len)]))
+        fo.write((("%1.2f"+sep+"%1.2f\n")*cols.shape[0]) % tuple(cols.ravel().tolist()))
+
+# formats of write_delays, by file name extension
+out_formats = [".npy", ".h5", ".csv"]
+
+def out_format(fname):
+    """ format (extension) of output file fname, ValueError if it is not one of out_formats """
+    ext = os.path.splitext(fname)[1].lower()
+    if ext not in out_formats:
+        raise ValueError, "Unknown output format %s, use .npy, .h5 or .csv"%(ext)
+    return(ext)
+
+def write_delays(fname, tvec, delay_ps, baseline_time, reference_delay_ps, integrate):
+    """ write delays to fname, format given by the extension: .npy, .h5 or .csv """
+    ext = out_format(fname)
+    if ext == ".npy":
+        # columns: time (unix seconds), delay (ps)
+        n.save(fname,n.column_stack((tvec,delay_ps)))
+    elif ext == ".h5":
+        ho = h5py.File(fname,"w")
+        ho["t"] = tvec
+        ho["delay_ps"] = delay_ps
+        ho.attrs["reference_time"] = baseline_time
+        ho.attrs["reference_delay_ps"] = reference_delay_ps
+        ho.attrs["integration_s"] = integrate/sample_rate
+        ho.close()
+    elif ext == ".csv":
+        fo = open(fname,"w")
+        write_header(fo,baseline_time,reference_delay_ps,integrate)
+        write_delays_ascii(fo,tvec,delay_ps,sep=",")
+        fo.close()
+
+def follow(d, integrate, reference_delay_ps, fo, follow_interval=1.0):
+    """
+    Keep the reader open and write delays of newly recorded samples to fo,
+    until interrupted.
+    """
+    b0 = d.get_bounds("000")
+    b1 = d.get_bounds("001")
+    # start at the first full integration window after the data that already exists
+    i0 = long(n.ceil(min(b0[1],b1[1])/float(integrate)))*integrate
+    try:
+        while True:
+            time.sleep(follow_interval)
+            # only subdirectories with new or removed files are rescanned
+            d.reload()
+            i1 = min(d.get_bounds("000")[1],d.get_bounds("001")[1])
+            n_windows = long((i1-i0)/integrate)
+            if n_windows < 1:
+                continue
+            t0s = i0 + integrate*n.arange(n_windows,dtype=n.int64)
+            zw0, valid0 = d.read_windows("000",t0s,integrate,dtype=n.complex128)
+            zw1, valid1 = d.read_windows("001",t0s,integrate,dtype=n.complex128)
+            ok = n.logical_and(n.all(valid0,axis=1),n.all(valid1,axis=1))
+            # files of the last few seconds may not be complete yet, so incomplete windows
+            # close to the end of the data are retried, older ones are data gaps
+            retry = n.where(n.logical_and(n.logical_not(ok),t0s+integrate > i1-long(10*sample_rate)))[0]
+            if len(retry) > 0:
+                n_windows = retry[0]
+            good = n.where(ok[:n_windows])[0]
+            if len(good) > 0:
+                delay_ps = phase_to_delay(n.mean(zw0[good],axis=1),n.mean(zw1[good],axis=1)) - reference_delay_ps
+                for wi in range(len(good)):
+                    fo.write("%1.2f %1.2f\n"%(t0s[good[wi]]/sample_rate,delay_ps[wi]))
+                fo.flush()
+            i0 = i0 + n_windows*integrate
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    parser = OptionParser()
+    parser.add_option("-d", "--dir", dest="dir", type="string", default="/data/phasecal",
+                      help="Directory. (default %default)")
 
-    for ni in range(n_overview):
+    parser.add_option("-i", "--integrate",dest="integrate", action="store",default=100, type="int", help="Integration factor (default %default)")
+
+    parser.add_option("-b", "--baseline_time",dest="baseline_time", action="store",default=-1.0, type="float", help="Time to use as reference for cable delay, unix seconds. Default, now - 5 minutes")
+
+    parser.add_option("-0", "--t0",dest="t0", action="store",default=-1.0, type="float", help="Start time in unix seconds, default: now-5 minutes")
+
+    parser.add_option("-1", "--t1",dest="t1", action="store",default=-1.0, type="float", help="End time in unix seconds, default: now")
+
+    parser.add_option("-p", "--plot",dest="plot", action="store_true",help="plot relative time delay")
+
+    parser.add_option("-o", "--overview_plot",dest="overview_plot", action="store_true",help="plot sparse overview plot")
+
+    parser.add_option("-a", "--ascii_out",dest="ascii_out", action="store_true",help="output delays in ascii")
+
+    parser.add_option("-n", "--latest",dest="latest", action="store_true",help="Latest recorded delay")
+
+    parser.add_option("--out",dest="out", action="store",default=None, type="string", help="write delays to file, format given by extension: .npy, .h5 or .csv")
+
+    parser.add_option("-f", "--follow",dest="follow", action="store_true",help="keep running and output delays of newly recorded data as it arrives")
+
+    parser.add_option("--follow_file",dest="follow_file", action="store",default=None, type="string", help="Append delays in follow mode to this file (default stdout)")
+
+    parser.add_option("--follow_interval",dest="follow_interval", action="store",default=1.0, type="float", help="Seconds between checks for new data in follow mode (default %default)")
+
+    parser.add_option("--pyramid_file",dest="pyramid_file", action="store",default=None, type="string", help="Precomputed phasor sums made with pcal_pyramid.py (default DIR/pcal_pyramid.h5, used if it exists)")
+
+    parser.add_option("--no_pyramid",dest="no_pyramid", action="store_true",help="always use raw data, even if precomputed phasor sums exist")
+
+    parser.add_option("-j", "--processes",dest="processes", action="store",default=multiprocessing.cpu_count(), type="int", help="Number of processes for long ranges (default %default)")
+
+    (op, args) = parser.parse_args()
+
+    # fail before reading anything, h5py for .h5 is already imported by digital_rf
+    if op.out is not None:
         try:
-            z0[ni] = n.mean(d.read_vector_c81d(long(t0s[ni]),op.integrate,"000"))
-            z1[ni] = n.mean(d.read_vector_c81d(long(t0s[ni]),op.integrate,"001"))
-        except:
-            z0[ni]=n.nan
-            z1[ni]=n.nan
-            print("Missing data at %s"%(stuffr.unix2datestr(t0s[ni]/sample_rate)))
-
-else:
+            out_format(op.out)
+        except ValueError, e:
+            parser.error(str(e))
+
+    d=drf.read_hdf5(op.dir)
+    b0=d.get_bounds("000")
+    b1=d.get_bounds("001")
+    #print(b0)
+    #print(b1)
+
+    t_now = time.time()
+    if op.baseline_time < 0.0:
+        op.baseline_time = t_now - 5*60.0
+
+    if op.t0 < 0.0:
+        op.t0 = t_now - 5*60.0
+
+    if op.t1 < 0.0:
+        op.t1 = b0[1]/sample_rate - 2
+
+    if op.pyramid_file is None:
+        op.pyramid_file = pcal_pyramid.default_pyramid_file(op.dir)
+    if op.no_pyramid:
+        op.pyramid_file = None
+
     # get baseline
-    z0 = stuffr.decimate(d.read_vector_c81d(long(op.t0*sample_rate),n_samples,"000"),dec=op.integrate)
-    
-    z1 = stuffr.decimate(d.read_vector_c81d(long(op.t0*sample_rate),n_samples,"001"),dec=op.integrate)
-    tvec = op.integrate*n.arange(len(z0))/sample_rate + op.t0
+    try:
+        reference_delay_ps = get_reference_delay(d,op.baseline_time,op.integrate)
+    except:
+        print("Couldn't find data for determining baseline delay at %s"%(stuffr.unix2datestr(op.baseline_time)))
+        exit(0)
+
+    #print(""reference_delay_ps)
+
+    # keep the reader open and only process newly recorded samples
+    if op.follow:
+        if op.follow_file is None:
+            fo = sys.stdout
+        else:
+            fo = open(op.follow_file,"a")
+        write_header(fo,op.baseline_time,reference_delay_ps,op.integrate)
+        fo.flush()
+        follow(d,op.integrate,reference_delay_ps,fo,op.follow_interval)
+        if op.follow_file is not None:
+            fo.close()
+        exit(0)
 
-# phase in 5 MHz to picoseconds ( (1/5e6)/ 1e-12)
-delay_ps = 200e3*n.angle(z0/z1)/2.0/n.pi - reference_delay_ps
+    if op.latest:
+        t0, t1, delay_ps = get_latest(d,op.integrate)
+        print("t0 %1.3f t1 %1.3f delay %1.3f reference time %1.2f"%(t0,t1,delay_ps - reference_delay_ps,op.baseline_time))
+        exit(0)
 
-#print(stuffr.unix2date(tvec[0]))
-dates = [stuffr.unix2date(ts) for ts in tvec]
+    # if overview plot, calculate delay sparsely over span of data
+    if op.overview_plot:
+        tvec, z0, z1, missing = get_overview(d,op.t0,op.t1,op.integrate)
+        for ni in n.where(missing)[0]:
+            print("Missing data at %s"%(stuffr.unix2datestr(tvec[ni])))
+    else:
+        # workers are only started if raw data is left after the pyramid
+        pool = None
+        if op.processes > 1:
+            pool = lazy_pool(op.dir,op.processes)
+        tvec, z0, z1 = get_range(d,op.t0,op.t1,op.integrate,op.pyramid_file,pool)
+        if pool is not None:
+            pool.close()
 
-if op.plot:
-    plt.plot(dates,delay_ps)
-    plt.ylabel("Delay (ps)")
-    plt.xlabel("Time (UTC)")
-    plt.show()
+    delay_ps = phase_to_delay(z0,z1) - reference_delay_ps
 
-if op.ascii_out:
-    print("# pcal out")
-    print("# reference delay at %1.2f (unix seconds), ref: %1.2f (ps)"%(op.baseline_time,reference_delay_ps))
-    print("# integration %1.2f (seconds)"%(op.integrate/sample_rate))
-    print("# time (unix seconds), delay (ps)")
-    for ti in range(len(tvec)):
-        print("%1.2f %1.2f"%(tvec[ti],delay_ps[ti]))
-    
+    if op.out is not None:
+        write_delays(op.out,tvec,delay_ps,op.baseline_time,reference_delay_ps,op.integrate)
 
+    if op.plot:
+        # only plotting needs matplotlib, which is slow to import
+        import matplotlib.pyplot as plt
+        #print(stuffr.unix2date(tvec[0]))
+        dates = [stuffr.unix2date(ts) for ts in tvec]
+        plt.plot(dates,delay_ps)
+        plt.ylabel("Delay (ps)")
+        plt.xlabel("Time (UTC)")
+        plt.show()
 
+    if op.ascii_out:
+        write_header(sys.stdout,op.baseline_time,reference_delay_ps,op.integrate)
+        write_delays_ascii(sys.stdout,tvec,delay_ps)
@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+#
+# Multi-resolution store of summed phasecal phasors.
+#
+# The 100 Hz phasors of channels 000 and 001 are summed into
+# 1 s, 10 s, 100 s and 1000 s bins. Sums (not means) and the
+# number of samples in each bin are stored, so that any
+# integration can be rebuilt exactly: the aligned interior of
+# each window from the coarsest level that fits, and only the
+# ends shorter than 1 s from the raw data.
+#
+# Run this periodically (e.g., from cron) to keep the store
+# up to date. pcal_get_delay.py uses it when it exists.
+#
+import h5py
+import digital_rf_hdf5 as drf
+import numpy as n
+import os
+from optparse import OptionParser
+
+# bin lengths in samples (at 100 Hz: 1 s, 10 s, 100 s and 1000 s)
+levels = [100, 1000, 10000, 100000]
+channels = ["000", "001"]
+
+def default_pyramid_file(dirn):
+    return(os.path.join(dirn, "pcal_pyramid.h5"))
+
+def _create_level(f, bin_len, first_bin):
+    g = f.create_group("level_%d"%(bin_len))
+    g.attrs["bin_len"] = bin_len
+    g.attrs["first_bin"] = first_bin
+    g.attrs["n_bins"] = 0
+    for ci in range(len(channels)):
+        g.create_dataset("z%d"%(ci), shape=(0,), maxshape=(None,), dtype=n.complex128, chunks=(4096,))
+        g.create_dataset("n%d"%(ci), shape=(0,), maxshape=(None,), dtype=n.int32, chunks=(4096,))
+    return(g)
+
+def _n_bins(g):
+    """
+    Number of bins of level group g that were completely written. The datasets
+    can be longer if an update was interrupted, files without the n_bins
+    attribute use the shortest dataset.
+    """
+    if "n_bins" in g.attrs:
+        return(long(g.attrs["n_bins"]))
+    return(long(min([g[name].shape[0] for name in g])))
+
+def _truncate(g):
+    """ drop bins of an interrupted update of level group g """
+    n_bins = _n_bins(g)
+    for name in g:
+        if g[name].shape[0] != n_bins:
+            g[name].resize((n_bins,))
+    g.attrs["n_bins"] = n_bins
+
+def _append(g, zs, ns):
+    n_old = _n_bins(g)
+    n_new = n_old + len(zs[0])
+    for ci in range(len(channels)):
+        g["z%d"%(ci)].resize((n_new,))
+        g["z%d"%(ci)][n_old:n_new] = zs[ci]
+        g["n%d"%(ci)].resize((n_new,))
+        g["n%d"%(ci)][n_old:n_new] = ns[ci]
+    # written last, bins after n_bins are not used
+    g.attrs["n_bins"] = n_new
+
+def _next_bin(g):
+    return(long(g.attrs["first_bin"]) + _n_bins(g))
+
+def _sum_raw(d, bin0, n_bins, bin_len):
+    """ sum raw phasors of all channels into n_bins bins starting at bin0 """
+    starts = (bin0 + n.arange(n_bins, dtype=n.int64))*bin_len
+    zs = []
+    ns = []
+    for ch in channels:
+        z, valid = d.read_windows(ch, starts, bin_len, dtype=n.complex128)
+        z[n.logical_not(valid)] = 0.0
+        zs.append(n.sum(z, axis=1))
+        ns.append(n.array(n.sum(valid, axis=1), dtype=n.int32))
+    return(zs, ns)
+
+def _sum_level(lower, g, bin1):
+    """ sum bins of lower level group into bins of g, up to (excluding) bin bin1 of g """
+    ratio = int(g.attrs["bin_len"])/int(lower.attrs["bin_len"])
+    b0 = _next_bin(g)
+    if bin1 <= b0:
+        return
+    # index of the first needed lower level bin, relative to the lower level start
+    lo0 = b0*ratio - long(lower.attrs["first_bin"])
+    lo1 = bin1*ratio - long(lower.attrs["first_bin"])
+    zs = []
+    ns = []
+    for ci in range(len(channels)):
+        z = n.zeros(lo1 - lo0, dtype=n.complex128)
+        c = n.zeros(lo1 - lo0, dtype=n.int32)
+        # lower level bins before the first stored bin have no data
+        i0 = max(lo0, 0)
+        z[(i0 - lo0):] = lower["z%d"%(ci)][i0:lo1]
+        c[(i0 - lo0):] = lower["n%d"%(ci)][i0:lo1]
+        zs.append(n.sum(z.reshape((-1, ratio)), axis=1))
+        ns.append(n.sum(c.reshape((-1, ratio)), axis=1))
+    _append(g, zs, ns)
+
+def update_pyramid(d, fname, chunk_bins=3600):
+    """
+    Extend the pyramid in file fname with all complete bins of new data in
+    read_hdf5 object d. Only data after the last stored bin is read.
+    """
+    b0 = d.get_bounds(channels[0])
+    b1 = d.get_bounds(channels[1])
+    start_sample = max(b0[0], b1[0])
+    end_sample = min(b0[1], b1[1])
+
+    f = h5py.File(fname, "a")
+    if "level_%d"%(levels[0]) not in f:
+        first_bin = start_sample/levels[0]
+        for bin_len in levels:
+            _create_level(f, bin_len, (first_bin*levels[0])/bin_len)
+    for bin_len in levels:
+        _truncate(f["level_%d"%(bin_len)])
+
+    # finest level from raw data, one chunk at a time
+    g = f["level_%d"%(levels[0])]
+    last_bin = end_sample/levels[0]
+    while _next_bin(g) < last_bin:
+        bin0 = _next_bin(g)
+        n_bins = min(chunk_bins, last_bin - bin0)
+        zs, ns = _sum_raw(d, bin0, n_bins, levels[0])
+        _append(g, zs, ns)
+        f.flush()
+
+    # coarser levels, only bins that are complete in the level below
+    for li in range(1, len(levels)):
+        lower = f["level_%d"%(levels[li-1])]
+        g = f["level_%d"%(levels[li])]
+        _sum_level(lower, g, (_next_bin(lower)*levels[li-1])/levels[li])
+    f.close()
+
+def _runs(starts, lengths):
+    """ bin indices and window number of runs of lengths[k] bins from starts[k] for each window k """
+    lengths = n.maximum(lengths, 0)
+    total = long(n.sum(lengths))
+    win = n.repeat(n.arange(len(lengths)), lengths)
+    offsets = n.cumsum(lengths) - lengths
+    idx = n.arange(total, dtype=n.int64) - n.repeat(offsets, lengths) + n.repeat(starts, lengths)
+    return(idx, win)
+
+def _sum_bins(g, idx, win, n_windows):
+    """ per window sums of phasors and counts of the bins idx (absolute bin numbers) of level group g """
+    first_bin = long(g.attrs["first_bin"])
+    rel = idx - first_bin
+    # bins before the first stored bin have no data
+    have = rel >= 0
+    rel = rel[have]
+    win = win[have]
+    zs = []
+    cs = []
+    for ci in range(len(channels)):
+        if len(rel) == 0:
+            z = n.zeros(0, dtype=n.complex128)
+            c = n.zeros(0, dtype=n.int32)
+        elif 4*len(rel) < rel.max() - rel.min():
+            # few bins spread out, only read those
+            u, inv = n.unique(rel, return_inverse=True)
+            z = g["z%d"%(ci)][list(u)][inv]
+            c = g["n%d"%(ci)][list(u)][inv]
+        else:
+            r0 = rel.min()
+            r1 = rel.max() + 1
+            z = g["z%d"%(ci)][r0:r1][rel - r0]
+            c = g["n%d"%(ci)][r0:r1][rel - r0]
+        zs.append(n.bincount(win, weights=z.real, minlength=n_windows) +
+                  1j*n.bincount(win, weights=z.imag, minlength=n_windows))
+        cs.append(n.bincount(win, weights=c, minlength=n_windows))
+    return(zs, cs)
+
+def _sum_raw_ends(d, starts, lengths):
+    """ per window sums of raw phasors and valid counts of lengths[k] < levels[0] samples from starts[k] """
+    mask = n.arange(levels[0])[n.newaxis, :] < lengths[:, n.newaxis]
+    zs = []
+    cs = []
+    for ch in channels:
+        z, valid = d.read_windows(ch, starts, levels[0], dtype=n.complex128)
+        valid = n.logical_and(valid, mask)
+        z[n.logical_not(valid)] = 0.0
+        zs.append(n.sum(z, axis=1))
+        cs.append(n.sum(valid, axis=1))
+    return(zs, cs)
+
+def read_pyramid(fname, start_sample, integrate, n_windows, d=None):
+    """
+    Mean phasors of both channels for n_windows consecutive windows of integrate samples
+    starting at start_sample. The aligned interior of each window is summed from the
+    coarsest level that fits, the parts left at its edges from the finer levels, and
+    only the ragged ends shorter than the finest bin are read from the raw data in
+    read_hdf5 object d. Returns (z0, z1) for the windows that the pyramid covers
+    (possibly fewer than n_windows, windows are consecutive from start_sample). Windows
+    that are not complete are set to nan. Returns None if the windows are shorter than
+    the finest bin, or if they need raw data and d is None.
+    """
+    if integrate < levels[0]:
+        return(None)
+    f = h5py.File(fname, "r")
+    groups = [f["level_%d"%(bin_len)] for bin_len in levels]
+    # end (in samples) of the stored bins of each level
+    ends = [(_next_bin(g))*bin_len for g, bin_len in zip(groups, levels)]
+
+    starts = long(start_sample) + integrate*n.arange(n_windows, dtype=n.int64)
+    stops = starts + integrate
+    # windows whose finest bins are all stored
+    n_covered = int(n.searchsorted((stops/levels[0])*levels[0], ends[0], side="right"))
+    starts = starts[:n_covered]
+    stops = stops[:n_covered]
+    lo0 = -((-starts)/levels[0])*levels[0]
+    hi0 = (stops/levels[0])*levels[0]
+    if n_covered > 0 and d is None and (n.any(lo0 != starts) or n.any(hi0 != stops)):
+        f.close()
+        return(None)
+
+    z = [n.zeros(n_covered, dtype=n.complex128) for ci in range(len(channels))]
+    c = [n.zeros(n_covered, dtype=n.int64) for ci in range(len(channels))]
+    # [lo, hi) is the part of each window already summed, coarsest level first
+    lo = None
+    hi = None
+    for li in reversed(range(len(levels))):
+        bin_len = levels[li]
+        a = -((-starts)/bin_len)*bin_len
+        b = n.maximum(n.minimum((stops/bin_len)*bin_len, ends[li]), a)
+        if lo is None:
+            lo = b
+            hi = b
+        # empty so far, so all of [a, b) is on the left
+        empty = lo == hi
+        lo = n.where(empty, b, lo)
+        hi = n.where(empty, b, hi)
+        idx_l, win_l = _runs(a/bin_len, (lo - a)/bin_len)
+        idx_r, win_r = _runs(hi/bin_len, (b - hi)/bin_len)
+        zs, cs = _sum_bins(groups[li], n.concatenate((idx_l, idx_r)), n.concatenate((win_l, win_r)), n_covered)
+        for ci in range(len(channels)):
+            z[ci] += zs[ci]
+            c[ci] += n.array(cs[ci], dtype=n.int64)
+        lo = a
+        hi = b
+    f.close()
+
+    # ragged ends from raw data
+    if n_covered > 0 and (n.any(lo != starts) or n.any(hi != stops)):
+        for ends_starts, ends_len in ((starts, lo - starts), (hi, stops - hi)):
+            zs, cs = _sum_raw_ends(d, ends_starts, ends_len)
+            for ci in range(len(channels)):
+                z[ci] += zs[ci]
+                c[ci] += cs[ci]
+
+    for ci in range(len(channels)):
+        complete = c[ci] == integrate
+        z[ci][complete] = z[ci][complete]/c[ci][complete]
+        z[ci][n.logical_not(complete)] = n.nan
+    return(z[0], z[1])
+
+if __name__ == "__main__":
+    parser = OptionParser()
+    parser.add_option("-d", "--dir", dest="dir", type="string", default="/data/phasecal",
+                      help="Directory. (default %default)")
+    parser.add_option("-f", "--file", dest="file", type="string", default=None,
+                      help="Pyramid file. (default DIR/pcal_pyramid.h5)")
+    (op, args) = parser.parse_args()
+
+    if op.file is None:
+        op.file = default_pyramid_file(op.dir)
+
+    d = drf.read_hdf5(op.dir)
+    update_pyramid(d, op.file)
@@ -0,0 +1,291 @@
+#!/usr/bin/env python
+#
+# Local HTTP service for phasecal delays.
+#
+# Keeps one read_hdf5 object open, so that queries don't pay for
+# python startup, imports and metadata discovery. Reference delays,
+# and delays of data that can no longer change in fixed segments of
+# segment_samples, are kept in an LRU cache. Responses are assembled
+# from the segments, so repeated, overlapping and sliding queries are
+# answered from memory as long as their windows line up (t0 moves by
+# a multiple of the integration).
+#
+# Queries (all parameters optional, same defaults as pcal_get_delay.py):
+#
+#   /latest?integrate=100&baseline_time=1448903561
+#       same as pcal_get_delay.py -n
+#   /delay?integrate=100&baseline_time=1448903561&t0=1448903561&t1=1448903571
+#       same as pcal_get_delay.py -a, add overview=1 for -o
+#   /stats
+#       cache statistics
+#
+import digital_rf_hdf5 as drf
+import numpy as n
+import BaseHTTPServer
+import collections
+import cStringIO
+import multiprocessing
+import time
+import urlparse
+import stuffr
+import pcal_get_delay
+import pcal_pyramid
+from optparse import OptionParser
+
+sample_rate = pcal_get_delay.sample_rate
+
+# results that depend on data newer than this (seconds) are not cached,
+# the last files may still be being written
+stable_margin = 10.0
+
+# samples of each cached segment of delays (5 minutes at 100 Hz),
+# rounded down to whole integration windows
+segment_samples = 30000
+
+def _n_windows(value):
+    """ number of windows of a cached result, a reference delay counts as one """
+    if isinstance(value, tuple):
+        return(len(value[0]))
+    return(1)
+
+class lru_cache:
+    """
+    least recently used cache of results with at most max_size windows in total,
+    so that memory use does not depend on how the results are split into items
+    """
+    def __init__(self, max_size=4000000):
+        self.max_size = max_size
+        self.size = 0
+        self.items = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """ cached value of key, None if not in cache """
+        if key not in self.items:
+            self.misses += 1
+            return(None)
+        self.hits += 1
+        value = self.items.pop(key)
+        self.items[key] = value
+        return(value)
+
+    def put(self, key, value):
+        if key in self.items:
+            self.size -= _n_windows(self.items.pop(key))
+        self.items[key] = value
+        self.size += _n_windows(value)
+        while self.size > self.max_size and len(self.items) > 1:
+            self.size -= _n_windows(self.items.popitem(last=False)[1])
+
+class delay_service:
+    """ warm reader and cache, answers queries as text in the pcal_get_delay.py output format """
+    def __init__(self, dirn, pyramid_file=None, cache_size=4000000, reload_interval=1.0, pool=None):
+        self.d = drf.read_hdf5(dirn)
+        self.pyramid_file = pyramid_file
+        self.pool = pool
+        self.reload_interval = reload_interval
+        self.last_reload = time.time()
+        self.cache = lru_cache(cache_size)
+
+    def _reload_if_needed(self):
+        if time.time() - self.last_reload > self.reload_interval:
+            self.d.reload()
+            self.last_reload = time.time()
+
+    def _is_stable(self, t1):
+        """ True if data before t1 (unix seconds) can no longer change """
+        b0 = self.d.get_bounds("000")
+        b1 = self.d.get_bounds("001")
+        return(t1 < min(b0[1],b1[1])/sample_rate - stable_margin)
+
+    def _defaults(self, integrate, baseline_time, t0=None, t1=None):
+        t_now = time.time()
+        if integrate is None:
+            integrate = 100
+        if integrate < 1:
+            raise ValueError, "integrate must be at least 1, not %d"%(integrate)
+        if baseline_time is None:
+            baseline_time = t_now - 5*60.0
+        if t0 is None:
+            t0 = t_now - 5*60.0
+        if t1 is None:
+            t1 = self.d.get_bounds("000")[1]/sample_rate - 2
+        return(integrate, baseline_time, t0, t1)
+
+    def reference_delay(self, baseline_time, integrate):
+        key = ("baseline", long(baseline_time*sample_rate), integrate)
+        ref = self.cache.get(key)
+        if ref is None:
+            try:
+                ref = pcal_get_delay.get_reference_delay(self.d,baseline_time,integrate)
+            except IOError:
+                raise IOError, "Couldn't find data for determining baseline delay at %s"%(stuffr.unix2datestr(baseline_time))
+            if self._is_stable(baseline_time + integrate/sample_rate):
+                self.cache.put(key,ref)
+        return(ref)
+
+    def latest(self, integrate=None, baseline_time=None):
+        self._reload_if_needed()
+        integrate, baseline_time, t0, t1 = self._defaults(integrate, baseline_time)
+        reference_delay_ps = self.reference_delay(baseline_time,integrate)
+        t0, t1, delay_ps = pcal_get_delay.get_latest(self.d,integrate)
+        return("t0 %1.3f t1 %1.3f delay %1.3f reference time %1.2f\n"%(t0,t1,delay_ps - reference_delay_ps,baseline_time))
+
+    def _windows(self, i0, n_windows, integrate):
+        """
+        Mean phasors (z0, z1) of n_windows windows of integrate samples from sample i0, as
+        pcal_get_delay.get_windows. Assembled from segments of windows on the same grid
+        (i0 modulo integrate), each cached once the data it covers can no longer change.
+        Consecutive segments that are not cached are computed at once, so that long ranges
+        are split over the pool.
+        """
+        if n_windows <= 0:
+            return(n.zeros(0,dtype=n.complex128), n.zeros(0,dtype=n.complex128))
+        seg_windows = max(1, segment_samples/integrate)
+        phase = i0 % integrate
+        # windows are numbered on the grid from sample phase
+        w0 = (i0 - phase)/integrate
+        w1 = w0 + n_windows
+        segs = range(w0/seg_windows, (w1 - 1)/seg_windows + 1)
+        res = {}
+        for seg in segs:
+            value = self.cache.get(("segment", integrate, phase, seg))
+            if value is not None:
+                res[seg] = value
+        # segments with data that can no longer change, later ones may still change
+        n_stable = 0
+        while n_stable < len(segs) and self._is_stable((phase + (segs[n_stable] + 1)*seg_windows*integrate)/sample_rate):
+            n_stable += 1
+
+        # runs of consecutive stable segments that are not cached
+        si = 0
+        while si < n_stable:
+            if segs[si] in res:
+                si += 1
+                continue
+            sj = si
+            while sj < n_stable and segs[sj] not in res:
+                sj += 1
+            z0, z1 = pcal_get_delay.get_windows(self.d,phase + segs[si]*seg_windows*integrate,(sj - si)*seg_windows,
+                                                integrate,self.pyramid_file,self.pool)
+            for k in range(si, sj):
+                a = (k - si)*seg_windows
+                res[segs[k]] = (z0[a:a + seg_windows], z1[a:a + seg_windows])
+                self.cache.put(("segment", integrate, phase, segs[k]), res[segs[k]])
+            si = sj
+
+        z0 = []
+        z1 = []
+        for seg in segs[:n_stable]:
+            a = max(w0,seg*seg_windows) - seg*seg_windows
+            b = min(w1,(seg + 1)*seg_windows) - seg*seg_windows
+            z0.append(res[seg][0][a:b])
+            z1.append(res[seg][1][a:b])
+        if n_stable < len(segs):
+            # may still change, only the windows asked for
+            a = max(w0,segs[n_stable]*seg_windows)
+            tail = pcal_get_delay.get_windows(self.d,phase + a*integrate,w1 - a,integrate,self.pyramid_file,self.pool)
+            z0.append(tail[0])
+            z1.append(tail[1])
+        return(n.concatenate([n.zeros(0,dtype=n.complex128)] + z0), n.concatenate([n.zeros(0,dtype=n.complex128)] + z1))
+
+    def delay(self, integrate=None, baseline_time=None, t0=None, t1=None, overview=False):
+        self._reload_if_needed()
+        integrate, baseline_time, t0, t1 = self._defaults(integrate, baseline_time, t0, t1)
+        reference_delay_ps = self.reference_delay(baseline_time,integrate)
+
+        if overview:
+            # windows spread over the whole range, only the same query can reuse them
+            key = ("overview", t0, t1, integrate)
+            res = self.cache.get(key)
+            if res is None:
+                res = pcal_get_delay.get_overview(self.d,t0,t1,integrate)
+                if self._is_stable(t1 + integrate/sample_rate):
+                    self.cache.put(key,res)
+        else:
+            # same windows as pcal_get_delay.get_range
+            n_windows = long(n.floor((t1-t0)*sample_rate))/integrate
+            z0, z1 = self._windows(long(t0*sample_rate),n_windows,integrate)
+            res = (integrate*n.arange(len(z0))/sample_rate + t0, z0, z1)
+        tvec, z0, z1 = res[0:3]
+        delay_ps = pcal_get_delay.phase_to_delay(z0,z1) - reference_delay_ps
+
+        fo = cStringIO.StringIO()
+        if overview:
+            for ni in n.where(res[3])[0]:
+                fo.write("Missing data at %s\n"%(stuffr.unix2datestr(tvec[ni])))
+        pcal_get_delay.write_header(fo,baseline_time,reference_delay_ps,integrate)
+        pcal_get_delay.write_delays_ascii(fo,tvec,delay_ps)
+        return(fo.getvalue())
+
+    def stats(self):
+        return("cache items %d windows %d hits %d misses %d\n"%(len(self.cache.items),self.cache.size,self.cache.hits,self.cache.misses))
+
+class delay_request_handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        query = urlparse.parse_qs(url.query)
+        try:
+            args = {}
+            for name, conv in (("integrate",int),("baseline_time",float),("t0",float),("t1",float)):
+                if name in query:
+                    args[name] = conv(query[name][0])
+            if url.path == "/latest":
+                text = self.server.service.latest(args.get("integrate"),args.get("baseline_time"))
+            elif url.path == "/delay":
+                overview = query.get("overview",["0"])[0] not in ("0","")
+                text = self.server.service.delay(overview=overview,**args)
+            elif url.path == "/stats":
+                text = self.server.service.stats()
+            else:
+                self.send_error(404,"Unknown query %s"%(url.path))
+                return
+        except ValueError, e:
+            self.send_error(400,str(e))
+            return
+        except IOError, e:
+            self.send_error(404,str(e))
+            return
+        self.send_response(200)
+        self.send_header("Content-Type","text/plain")
+        self.send_header("Content-Length",str(len(text)))
+        self.end_headers()
+        self.wfile.write(text)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+if __name__ == "__main__":
+    parser = OptionParser()
+    parser.add_option("-d", "--dir", dest="dir", type="string", default="/data/phasecal",
+                      help="Directory. (default %default)")
+    parser.add_option("-p", "--port", dest="port", type="int", default=8765,
+                      help="Port on localhost to listen on. (default %default)")
+    parser.add_option("-c", "--cache_size", dest="cache_size", type="int", default=4000000,
+                      help="Number of cached delay windows, about 32 bytes each. (default %default)")
+    parser.add_option("--pyramid_file",dest="pyramid_file", action="store",default=None, type="string", help="Precomputed phasor sums made with pcal_pyramid.py (default DIR/pcal_pyramid.h5, used if it exists)")
+    parser.add_option("--no_pyramid",dest="no_pyramid", action="store_true",help="always use raw data, even if precomputed phasor sums exist")
+    parser.add_option("-j", "--processes",dest="processes", action="store",default=multiprocessing.cpu_count(), type="int", help="Number of processes for long ranges (default %default)")
+    parser.add_option("-v", "--verbose", dest="verbose", action="store_true", help="log requests")
+    (op, args) = parser.parse_args()
+
+    if op.pyramid_file is None:
+        op.pyramid_file = pcal_pyramid.default_pyramid_file(op.dir)
+    if op.no_pyramid:
+        op.pyramid_file = None
+
+    # start the workers before the reader opens any files
+    pool = None
+    if op.processes > 1:
+        pool = pcal_get_delay.make_pool(op.dir, op.processes)
+
+    server = BaseHTTPServer.HTTPServer(("127.0.0.1", op.port), delay_request_handler)
+    server.service = delay_service(op.dir, op.pyramid_file, op.cache_size, pool=pool)
+    server.verbose = op.verbose
+    print("Serving %s on http://127.0.0.1:%d"%(op.dir, op.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -4,19 +4,15 @@
 # Nothing extremely complicated, just conveniece functions
 #
 #
+# Only light modules are imported here. matplotlib, h5py, pickle and
+# scipy are imported by the functions that need them, so that tools
+# using the time and array helpers start quickly.
+#
 import numpy
 import math
-import matplotlib
-import matplotlib.cbook
-import matplotlib.pyplot as plt
 import datetime
 import time
-import pickle
-import h5py
-
-# fit_velocity
-import scipy.constants
-import scipy.optimize
+import os
 
 # seed is a way of reproducing the random code without
 # having to store all actual codes. the seed can then
@@ -31,50 +27,154 @@ def periodic_convolution_matrix(envelope,rmin=0,rmax=100):
     # we imply that the number of measurements is equal to the number of elements in code
     L = len(envelope)
     ridx = numpy.arange(rmin,rmax)
-    A = numpy.zeros([L,rmax-rmin],dtype=numpy.complex64)
-    for i in numpy.arange(L):
-        A[i,:] = envelope[(i-ridx)%L]
+    A = numpy.array(envelope[(numpy.arange(L)[:,None]-ridx[None,:])%L],dtype=numpy.complex64)
     result = {}
     result['A'] = A
     result['ridx'] = ridx
     return(result)
 
-def analyze_prc_file(fname="data-000001.gdf",clen=10000,station=0,Nranges=1000):
-    z = numpy.fromfile(fname,dtype=numpy.complex64)
-    code = create_pseudo_random_code(len=clen,seed=station)
+# estimators of prc_estimator, keyed by (seed, clen, rmin, rmax)
+prc_cache = {}
+
+def prc_estimator(seed=0,clen=10000,rmin=0,rmax=1000):
+    """
+    FFT based least squares estimator of ranges rmin..rmax-1 for the periodic
+    pseudo random code of seed and length clen. Cached, the code is only
+    generated and the normal matrix only inverted once for each key.
+    """
+    key = (seed,clen,rmin,rmax)
+    if key in prc_cache:
+        return(prc_cache[key])
+    R = rmax-rmin
+    if R < 1 or R > clen:
+        raise ValueError, 'number of ranges must be between 1 and the code length %d, not %d' % (clen, R)
+    code = create_pseudo_random_code(len=clen,seed=seed)
+    C = numpy.fft.fft(numpy.array(code,dtype=numpy.complex128))
+    result = {}
+    result['ridx'] = numpy.arange(rmin,rmax)
+    result['C'] = C
+    if R == clen:
+        # all ranges, the convolution can be inverted in frequency domain
+        result['Ginv'] = None
+    else:
+        # normal matrix A^H A is toeplitz, made of the periodic autocorrelation of the code
+        acf = numpy.fft.ifft(numpy.abs(C)**2.0)
+        ri = numpy.arange(R)
+        result['Ginv'] = numpy.linalg.inv(acf[(ri[:,None]-ri[None,:])%clen])
+    prc_cache[key] = result
+    return(result)
+
+def prc_matched_filter(Z,seed=0,clen=10000,rmin=0,rmax=1000):
+    """ A^H z of each code period (row) of Z, for ranges rmin..rmax-1 """
+    r = prc_estimator(seed,clen,rmin,rmax)
+    MF = numpy.fft.ifft(numpy.fft.fft(Z,axis=1)*numpy.conj(r['C'])[None,:],axis=1)
+    return(MF[:,r['ridx']%clen])
+
+def prc_deconvolve(Z,seed=0,clen=10000,rmin=0,rmax=1000):
+    """
+    Least squares estimate of ranges rmin..rmax-1 for each code period (row) of Z,
+    same as multiplying each row with the B matrix of create_estimation_matrix.
+    """
+    r = prc_estimator(seed,clen,rmin,rmax)
+    if r['Ginv'] is None:
+        X = numpy.fft.ifft(numpy.fft.fft(Z,axis=1)/r['C'][None,:],axis=1)
+        return(X[:,r['ridx']%clen])
+    MF = prc_matched_filter(Z,seed,clen,rmin,rmax)
+    return(numpy.dot(MF,r['Ginv'].T))
+
+def analyze_prc_file(fname="data-000001.gdf",clen=10000,station=0,Nranges=1000,block_len=2**22):
+    """
+    Range profile of each code period in file and the range-Doppler spectrum.
+    Code periods are deconvolved block_len samples at a time.
+    """
+    z = numpy.memmap(fname,dtype=numpy.complex64,mode='r')
     N = len(z)/clen
+    Z = z[:(N*clen)].reshape((N,clen))
     res = numpy.zeros([N,Nranges],dtype=numpy.complex64)
-    idx = numpy.arange(clen)
-    r = create_estimation_matrix(code=code,cache=True)
-    B = r['B']
-    spec = numpy.zeros([N,Nranges],dtype=numpy.float32)
-
-    for i in numpy.arange(N):
-        res[i,:] = numpy.dot(B,z[idx + i*clen])
-    for i in numpy.arange(Nranges):
-        spec[:,i] = numpy.abs(numpy.fft.fft(res[:,i]))
+    n_block = max(1,block_len/clen)
+    for i in range(0,N,n_block):
+        res[i:(i+n_block),:] = prc_deconvolve(Z[i:(i+n_block)],seed=station,clen=clen,rmin=0,rmax=Nranges)
+    spec = numpy.array(numpy.abs(numpy.fft.fft(res,axis=0)),dtype=numpy.float32)
+    r = {}
+    r['ridx'] = prc_estimator(station,clen,0,Nranges)['ridx']
     r['res'] = res
     r['spec'] = spec
     return(r)
 
-B_cache = 0
-r_cache = 0
-B_cached = False
+def analyze_prc_file_stream(fname="data-000001.gdf",clen=10000,station=0,Nranges=1000,n_fft=128,block_len=2**22,out_fname=None):
+    """
+    Streaming version of analyze_prc_file for files that don't fit in memory.
+    Blocks of block_len samples (whole multiples of n_fft code periods) of the
+    file are memory mapped and processed one at a time, so memory use doesn't
+    depend on the length of the file. The range-Doppler spectrum is the mean
+    power spectrum of consecutive segments of n_fft code periods, periods after
+    the last full segment are left out of it. If out_fname is given, the range
+    profiles of all periods are written to its HDF5 dataset res as they are
+    computed, together with spec and ridx.
+    """
+    itemsize = numpy.dtype(numpy.complex64).itemsize
+    N = os.path.getsize(fname)/(itemsize*clen)
+    n_block = n_fft*max(1,block_len/(n_fft*clen))
+    spec = numpy.zeros([n_fft,Nranges],dtype=numpy.float64)
+    n_spec = 0
+
+    f = None
+    if out_fname is not None:
+        import h5py
+        f = h5py.File(out_fname,'w')
+    # the output file is closed also if processing fails
+    try:
+        if f is not None:
+            res_ds = f.create_dataset('res',shape=(N,Nranges),dtype=numpy.complex64,maxshape=(None,Nranges),chunks=(n_fft,Nranges))
+
+        for i in range(0,N,n_block):
+            # a new map for each block, pages of old blocks are released with it
+            Z = numpy.memmap(fname,dtype=numpy.complex64,mode='r',offset=i*clen*itemsize,shape=(min(n_block,N-i),clen))
+            res = numpy.array(prc_deconvolve(Z,seed=station,clen=clen,rmin=0,rmax=Nranges),dtype=numpy.complex64)
+            if f is not None:
+                res_ds[i:(i+res.shape[0]),:] = res
+            del Z
+            n_seg = res.shape[0]/n_fft
+            if n_seg > 0:
+                segs = res[:(n_seg*n_fft)].reshape((n_seg,n_fft,Nranges))
+                spec += numpy.sum(numpy.abs(numpy.fft.fft(segs,axis=1))**2.0,axis=0)
+                n_spec += n_seg
+        if n_spec > 0:
+            spec = spec/n_spec
+
+        r = {}
+        r['ridx'] = prc_estimator(station,clen,0,Nranges)['ridx']
+        r['spec'] = numpy.array(spec,dtype=numpy.float32)
+        r['n_spec'] = n_spec
+        r['n_periods'] = N
+        if f is not None:
+            f['spec'] = r['spec']
+            f['ridx'] = r['ridx']
+            f.attrs['clen'] = clen
+            f.attrs['station'] = station
+            f.attrs['n_fft'] = n_fft
+            f.attrs['n_spec'] = n_spec
+    finally:
+        if f is not None:
+            f.close()
+    return(r)
+
+# estimation matrices of create_estimation_matrix, keyed by code and range interval
+B_cache = {}
 def create_estimation_matrix(code,rmin=0,rmax=1000,cache=True):
-    global B_cache
-    global r_cache
-    global B_cached
-
-    if cache == False or B_cached == False:
-        r_cache = periodic_convolution_matrix(envelope=code,rmin=rmin,rmax=rmax)
-        A = r_cache['A']
-        Ah = numpy.transpose(numpy.conjugate(A))
-        B_cache = numpy.dot(numpy.linalg.inv(numpy.dot(Ah,A)),Ah)
-        r_cache['B'] = B_cache
-        B_cached = True
-        return(r_cache)
-    else:
-        return(r_cache)
+    # the bytes of the code, not their hash, so that different codes never share a matrix
+    code = numpy.asarray(code)
+    key = (code.dtype.str,code.tostring(),rmin,rmax)
+    if cache and key in B_cache:
+        return(B_cache[key])
+
+    r_cache = periodic_convolution_matrix(envelope=code,rmin=rmin,rmax=rmax)
+    A = r_cache['A']
+    Ah = numpy.transpose(numpy.conjugate(A))
+    r_cache['B'] = numpy.dot(numpy.linalg.inv(numpy.dot(Ah,A)),Ah)
+    if cache:
+        B_cache[key] = r_cache
+    return(r_cache)
 
 def grid_search1d(fun,xmin,xmax,nstep=100):
     vals = numpy.linspace(xmin,xmax,num=nstep)
@@ -88,6 +188,7 @@ def grid_search1d(fun,xmin,xmax,nstep=100):
     return(vals[best_idx])
 
 def fit_velocity(z,t,var,frad=440.2e6):
+    import scipy.constants
     zz = numpy.exp(1.0j*numpy.angle(z))
     def ssfun(x):
         freq = 2.0*frad*x/scipy.constants.c
@@ -103,6 +204,8 @@ def fit_velocity(z,t,var,frad=440.2e6):
     return(v0)
 
 def fit_velocity_and_power(z,t,var,frad=440.2e6):
+    import scipy.constants
+    import scipy.optimize
     zz = numpy.exp(1.0j*numpy.angle(z))
     def ssfun(x):
         freq = 2.0*frad*x/scipy.constants.c
@@ -117,17 +220,93 @@ def fit_velocity_and_power(z,t,var,frad=440.2e6):
 
     return([v0,p0])
 
+def _fit_velocities(z,t,var,frad,vmin,vmax,nstep,refine,n_iter):
+    import scipy.constants
+    # phase of doppler shift per unit velocity and time
+    a = 2.0*math.pi*2.0*frad/scipy.constants.c
+    zz = numpy.exp(1.0j*numpy.angle(z))
+    w = numpy.zeros(z.shape)+1.0/var
+    wz = w*zz
+
+    # with unit phasors |model-zz|^2 = 2-2*re(conj(model)*zz), so the sum of squares
+    # of all gates and grid velocities is one matrix product
+    # the refinement starts from a grid fine enough to resolve the main lobe of each minimum
+    if refine:
+        nstep = (nstep-1)*8+1
+    vals = numpy.linspace(vmin,vmax,num=nstep)
+    ss = 2.0*numpy.sum(w,axis=1)[:,None] - 2.0*numpy.real(numpy.dot(wz,numpy.exp(-1.0j*a*vals[None,:]*t[:,None])))
+    v = vals[numpy.argmin(ss,axis=1)]
+
+    if refine:
+        # newton iterations maximizing re(sum(w*zz*conj(model))), steps are limited to
+        # the grid spacing and only taken if they reduce the sum of squares
+        dv = (vmax-vmin)/max(nstep-1,1)
+        at = a*t[None,:]
+        q = numpy.sum(wz*numpy.exp(-1.0j*at*v[:,None]),axis=1)
+        for i in range(n_iter):
+            qt = wz*numpy.exp(-1.0j*at*v[:,None])
+            d1 = numpy.real(numpy.sum(-1.0j*at*qt,axis=1))
+            d2 = numpy.real(numpy.sum(-(at**2.0)*qt,axis=1))
+            step = numpy.where(d2 < 0.0,-d1/numpy.where(d2 < 0.0,d2,-1.0),0.0)
+            step = numpy.clip(step,-dv,dv)
+            vn = v + step
+            qn = numpy.sum(wz*numpy.exp(-1.0j*at*vn[:,None]),axis=1)
+            better = numpy.real(qn) > numpy.real(q)
+            v = numpy.where(better,vn,v)
+            q = numpy.where(better,qn,q)
+            if numpy.max(numpy.abs(step[better]),initial=0.0) < 1e-9:
+                break
+
+    dc = numpy.real(numpy.exp(-1.0j*a*v[:,None]*t[None,:])*z)
+    p = numpy.sum(w*dc,axis=1)/numpy.sum(w,axis=1)
+    return(v,p)
+
+def _fit_velocities_block(args):
+    return(_fit_velocities(*args))
+
+def fit_velocities(z,t,var,frad=440.2e6,vmin=-800.0,vmax=800.0,nstep=50,refine=True,n_iter=20,processes=1,block_len=1000):
+    """
+    Batched fit_velocity_and_power for many range gates at once.
+    z is (gates, samples), var is broadcast to the shape of z.
+    refine=False gives the grid search result of fit_velocity. Otherwise the best
+    velocity of an 8 times finer grid is refined, where fmin in
+    fit_velocity_and_power ends in another local minimum this fit is the better one.
+    With processes > 1, blocks of block_len gates are fitted in parallel.
+    Returns [v, p], arrays with one value per gate.
+    """
+    z = numpy.atleast_2d(z)
+    t = numpy.asarray(t,dtype=numpy.float64)
+    var_in = var
+    var = numpy.zeros(z.shape)+var
+    blocks = [(z[i:(i+block_len)],t,var[i:(i+block_len)],frad,vmin,vmax,nstep,refine,n_iter) for i in range(0,z.shape[0],block_len)]
+    if processes > 1 and len(blocks) > 1:
+        import multiprocessing
+        pool = multiprocessing.Pool(processes)
+        res = pool.map(_fit_velocities_block,blocks,1)
+        pool.close()
+    else:
+        res = [_fit_velocities(*b) for b in blocks]
+    v = numpy.concatenate([r[0] for r in res])
+    p = numpy.concatenate([r[1] for r in res])
+    if numpy.ndim(var_in) == 0:
+        # as in fit_velocity_and_power, a scalar var is normalized with 1/var, not sum(1/var)
+        p = p*z.shape[1]
+    return([v,p])
+
 def dict2hdf5(d,fname):
+    import h5py
     f = h5py.File(fname,'w')
     for k in d.keys():
         f[k] = d[k]
     f.close()
 
 def save_object(obj, filename):
+    import pickle
     with open(filename, 'wb') as output:
         pickle.dump(obj, output, pickle.HIGHEST_PROTOCOL)
 
 def load_object(filename):
+    import pickle
     with open(filename, 'rb') as input:
         return(pickle.load(input))
 
@@ -142,11 +321,15 @@ def unix2datestr(x):
     return(unix2date(x).strftime('%Y-%m-%d %H:%M:%S'))
 
 def compr(x,fr=0.001):
+    """ Clip values to the fr and 1-fr quantiles """
     sh = x.shape
     x = x.reshape(-1)
-    xs = numpy.sort(x)
-    mini = xs[int(fr*len(x))]
-    maxi = xs[int((1.0-fr)*len(x))]
+    # only the two order statistics are needed, not a full sort
+    i0 = int(fr*len(x))
+    i1 = int((1.0-fr)*len(x))
+    xs = numpy.partition(x,[i0,i1])
+    mini = xs[i0]
+    maxi = xs[i1]
     mx = numpy.ones_like(x)*maxi
     mn = numpy.ones_like(x)*mini
     x = numpy.where(x < maxi, x, mx)
@@ -173,24 +356,35 @@ def comprz_dB(xx,fr=0.05):
     xx = xx.reshape(sh)
     return(10.0*numpy.log10(xx))
 
-def decimate(x,dec=2):
-    Nout = int(math.floor(len(x)/dec))
-    idx = numpy.arange(Nout)*dec
-    res = x[idx]*0.0
-
-    for i in numpy.arange(dec):
-        res = res + x[idx+i]
-    return(res/float(dec))
+def decimate(x,dec=2,axis=0):
+    """ Average of each dec consecutive elements along axis, an incomplete last block is dropped """
+    x = numpy.asarray(x)
+    Nout = int(math.floor(x.shape[axis]/dec))
+    xs = numpy.moveaxis(x,axis,0)[:(Nout*dec)]
+    res = numpy.sum(xs.reshape((Nout,dec)+xs.shape[1:]),axis=1)
+    return(numpy.moveaxis(res/float(dec),0,axis))
 
 def decimate_mat(M,dec0=10,dec1=10):
-    shape2 = [math.floor(M.shape[0]/dec0),math.floor(M.shape[1]/dec1)]
-    M2 = numpy.zeros(shape2,dtype=M.dtype)
-    for i in numpy.arange(shape2[0]):
-        for j in numpy.arange(dec0):
-            M2[i,:] = M2[i,:] + decimate(M[i+j,:],dec=dec1)
+    """
+    Columns of M averaged over each dec1 columns, output row i is the sum of
+    the overlapping rows i ... i+dec0-1 of that. See decimate_mat_blocks for
+    sums of non-overlapping blocks of rows.
+    """
+    C = decimate(M,dec=dec1,axis=1)
+    Nout = int(math.floor(M.shape[0]/dec0))
+    M2 = numpy.zeros([Nout,C.shape[1]],dtype=M.dtype)
+    # one row offset at a time, summed in the same order as a loop over rows
+    for j in range(dec0):
+        M2 = numpy.array(M2 + C[j:(j+Nout),:],dtype=M.dtype)
     return(M2)
 
+def decimate_mat_blocks(M,dec0=10,dec1=10):
+    """ Sum of each block of dec0 rows i*dec0 ... i*dec0+dec0-1 of M, averaged over each dec1 columns """
+    M2 = dec0*decimate(decimate(M,dec=dec1,axis=1),dec=dec0,axis=0)
+    return(numpy.array(M2,dtype=M.dtype))
+
 def plot_cts(x,plot_abs=False,plot_show=True):
+    import matplotlib.pyplot as plt
     time_vec = numpy.linspace(0,len(x)-1,num=len(x))
     plt.clf()
     plt.plot(time_vec,numpy.real(x),"blue")
@@ -202,14 +396,27 @@ def plot_cts(x,plot_abs=False,plot_show=True):
 
 def hanning(L=1000):
     n = numpy.linspace(0.0,L-1,num=L)
-    return(0.5*(1.0-numpy.cos(2.0*scipy.constants.pi*n/L)))
+    return(0.5*(1.0-numpy.cos(2.0*math.pi*n/L)))
 
-def spectrogram(x,window=1024,wf=hanning):
+def spectrogram(x,window=1024,wf=hanning,block_len=2**20):
+    """
+    Power spectra of consecutive windows of x, zero frequency in the middle.
+    Windows are transformed block_len samples at a time.
+    """
     wfv = wf(L=window)
     Nwindow = int(math.floor(len(x)/window))
     res = numpy.zeros([Nwindow,window])
-    for i in range(Nwindow):
-        res[i,] = numpy.abs(numpy.fft.fftshift(numpy.fft.fft(wfv*x[i*window + numpy.arange(window)])))**2
+    X = x[:(Nwindow*window)].reshape((Nwindow,window))
+    real_input = not numpy.iscomplexobj(x)
+    n_block = max(1,block_len/window)
+    for i in range(0,Nwindow,n_block):
+        if real_input:
+            # spectrum of real data is symmetric, only half of it is computed
+            P = numpy.abs(numpy.fft.rfft(wfv*X[i:(i+n_block)],axis=1))**2
+            P = numpy.concatenate((P,P[:,(window-P.shape[1]):0:-1]),axis=1)
+        else:
+            P = numpy.abs(numpy.fft.fft(wfv*X[i:(i+n_block)],axis=1))**2
+        res[i:(i+n_block)] = numpy.fft.fftshift(P,axes=1)
     return(res)
 
 
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+#
+# Benchmark and parity check of the stuffr signal processing functions
+# against the loop based versions they replaced.
+#
+# Inputs of 10^7 samples run in seconds. 10^9 samples need about 40 GB
+# of memory, use --no_old there, the loop versions take very long.
+#
+import numpy
+import math
+import time
+import stuffr
+from optparse import OptionParser
+
+# loop based versions, as they were before vectorization
+def old_decimate(x,dec=2):
+    Nout = int(math.floor(len(x)/dec))
+    idx = numpy.arange(Nout)*dec
+    res = x[idx]*0.0
+
+    for i in numpy.arange(dec):
+        res = res + x[idx+i]
+    return(res/float(dec))
+
+# as it was, only the float shape that fails on current numpy is made int
+def old_decimate_mat(M,dec0=10,dec1=10):
+    shape2 = [int(math.floor(M.shape[0]/dec0)),int(math.floor(M.shape[1]/dec1))]
+    M2 = numpy.zeros(shape2,dtype=M.dtype)
+    for i in numpy.arange(shape2[0]):
+        for j in numpy.arange(dec0):
+            M2[i,:] = M2[i,:] + old_decimate(M[i+j,:],dec=dec1)
+    return(M2)
+
+# decimate_mat_blocks has no old version, it is checked against this loop
+def old_decimate_mat_blocks(M,dec0=10,dec1=10):
+    shape2 = [int(math.floor(M.shape[0]/dec0)),int(math.floor(M.shape[1]/dec1))]
+    M2 = numpy.zeros(shape2,dtype=M.dtype)
+    for i in numpy.arange(shape2[0]):
+        for j in numpy.arange(dec0):
+            M2[i,:] = M2[i,:] + old_decimate(M[i*dec0+j,:],dec=dec1)
+    return(M2)
+
+def old_spectrogram(x,window=1024,wf=stuffr.hanning):
+    wfv = wf(L=window)
+    Nwindow = int(math.floor(len(x)/window))
+    res = numpy.zeros([Nwindow,window])
+    for i in range(Nwindow):
+        res[i,] = numpy.abs(numpy.fft.fftshift(numpy.fft.fft(wfv*x[i*window + numpy.arange(window)])))**2
+    return(res)
+
+def old_compr(x,fr=0.001):
+    sh = x.shape
+    x = x.reshape(-1)
+    xs = numpy.sort(x)
+    mini = xs[int(fr*len(x))]
+    maxi = xs[int((1.0-fr)*len(x))]
+    mx = numpy.ones_like(x)*maxi
+    mn = numpy.ones_like(x)*mini
+    x = numpy.where(x < maxi, x, mx)
+    x = numpy.where(x > mini, x, mn)
+    x = x.reshape(sh)
+    return(x)
+
+def old_prc(Z,seed=0,clen=10000,rmin=0,rmax=1000):
+    code = stuffr.create_pseudo_random_code(len=clen,seed=seed)
+    L = len(code)
+    ridx = numpy.arange(rmin,rmax)
+    A = numpy.zeros([L,rmax-rmin],dtype=numpy.complex64)
+    for i in numpy.arange(L):
+        A[i,:] = code[(i-ridx)%L]
+    Ah = numpy.transpose(numpy.conjugate(A))
+    B = numpy.dot(numpy.linalg.inv(numpy.dot(Ah,A)),Ah)
+    res = numpy.zeros([Z.shape[0],rmax-rmin],dtype=numpy.complex64)
+    for i in numpy.arange(Z.shape[0]):
+        res[i,:] = numpy.dot(B,Z[i,:])
+    return(res)
+
+def new_prc(Z,seed=0,clen=10000,rmin=0,rmax=1000):
+    # includes building the estimator
+    stuffr.prc_cache.clear()
+    return(stuffr.prc_deconvolve(Z,seed,clen,rmin,rmax))
+
+def _time(fun, *args):
+    t0 = time.time()
+    res = fun(*args)
+    return(res, time.time() - t0)
+
+def compare(name, n_samples, old_fun, new_fun, args, run_old=True, tol=None):
+    """
+    time old and new on the same arguments, report the largest difference relative to the
+    largest old value. The default tolerance is 1000 times the precision of the result type.
+    """
+    new_res, t_new = _time(new_fun, *args)
+    if not run_old:
+        print("%-20s %10d  old        -  new %8.3f s"%(name, n_samples, t_new))
+        return(True)
+    old_res, t_old = _time(old_fun, *args)
+    if tol is None:
+        tol = 1e3*numpy.finfo(old_res.dtype).eps
+    scale = numpy.max(numpy.abs(old_res))
+    err = numpy.max(numpy.abs(old_res - new_res))/scale
+    ok = old_res.shape == new_res.shape and err < tol
+    print("%-20s %10d  old %8.3f s  new %8.3f s  speedup %6.1f  max rel diff %1.1e %s"%(name, n_samples, t_old, t_new, t_old/t_new, err, "" if ok else "MISMATCH"))
+    return(ok)
+
+def old_fit_velocities(z,t,var):
+    res = [stuffr.fit_velocity_and_power(z[g],t,var[g]) for g in range(z.shape[0])]
+    return(numpy.array([r[0][0] for r in res]),numpy.array([r[1] for r in res]))
+
+def compare_fit(n_gates, n_t=100, run_old=True, processes=1):
+    """ gates/s of fit_velocity_and_power one gate at a time and of fit_velocities """
+    t = numpy.arange(n_t)*1e-4
+    a = 2.0*math.pi*2.0*440.2e6/299792458.0
+    v_true = numpy.random.uniform(-700.0,700.0,n_gates)
+    z = numpy.exp(1j*a*v_true[:,None]*t[None,:]) + 0.3*(numpy.random.randn(n_gates,n_t)+1j*numpy.random.randn(n_gates,n_t))
+    var = numpy.random.uniform(0.5,1.5,(n_gates,n_t))
+    (v, p), t_new = _time(stuffr.fit_velocities, z, t, var, 440.2e6, -800.0, 800.0, 50, True, 20, processes)
+    if not run_old:
+        print("%-20s %10d  new %10.1f gates/s"%("fit_velocities", n_gates, n_gates/t_new))
+        return(True)
+    (ov, op), t_old = _time(old_fit_velocities, z, t, var)
+    same = numpy.abs(v-ov) < 1e-3
+    dp = numpy.max(numpy.abs(p[same]-op[same])/numpy.abs(op[same]))
+    # fmin sometimes ends in another local minimum, then the new fit must be better
+    zz = numpy.exp(1j*numpy.angle(z))
+    def ss(vv):
+        return(numpy.sum((1.0/var)*numpy.abs(numpy.exp(1j*a*vv[:,None]*t[None,:])-zz)**2.0,axis=1))
+    worse = numpy.logical_and(numpy.logical_not(same),ss(v) > ss(ov))
+    ok = dp < 1e-4 and numpy.sum(worse) == 0
+    print("%-20s %10d  old %10.1f gates/s  new %10.1f gates/s  same v %5.1f %%  better %d worse %d  max p rel diff %1.1e %s"%("fit_velocities", n_gates, n_gates/t_old, n_gates/t_new, 100.0*numpy.mean(same), numpy.sum(numpy.logical_not(same))-numpy.sum(worse), numpy.sum(worse), dp, "" if ok else "MISMATCH"))
+    return(ok)
+
+if __name__ == "__main__":
+    parser = OptionParser()
+    parser.add_option("-s", "--sizes", dest="sizes", type="string", default="1e7",
+                      help="Comma separated input sizes in samples. (default %default)")
+    parser.add_option("--no_old", dest="no_old", action="store_true",
+                      help="Only time the new versions")
+    parser.add_option("-g", "--gates", dest="gates", type="string", default="1000",
+                      help="Comma separated numbers of range gates for velocity fitting. (default %default)")
+    parser.add_option("-j", "--processes", dest="processes", type="int", default=1,
+                      help="Number of processes for velocity fitting. (default %default)")
+    (op, args) = parser.parse_args()
+
+    ok = True
+    for n_samples in [int(float(s)) for s in op.sizes.split(",")]:
+        run_old = not op.no_old
+        x = numpy.random.randn(n_samples)
+        ok = compare("decimate", n_samples, old_decimate, stuffr.decimate, (x, 100), run_old) and ok
+        z = x + 1j*numpy.random.randn(n_samples)
+        ok = compare("decimate complex", n_samples, old_decimate, stuffr.decimate, (z, 100), run_old) and ok
+        z64 = numpy.array(z, dtype=numpy.complex64)
+        ok = compare("decimate c64", n_samples, old_decimate, stuffr.decimate, (z64, 100), run_old) and ok
+        M = x[:((n_samples/1000)*1000)].reshape((-1, 1000))
+        ok = compare("decimate_mat", n_samples, old_decimate_mat, stuffr.decimate_mat, (M, 10, 10), run_old) and ok
+        M64 = z64[:((n_samples/1000)*1000)].reshape((-1, 1000))
+        ok = compare("decimate_mat c64", n_samples, old_decimate_mat, stuffr.decimate_mat, (M64, 10, 10), run_old) and ok
+        ok = compare("decimate_mat_blocks", n_samples, old_decimate_mat_blocks, stuffr.decimate_mat_blocks, (M, 10, 10), run_old) and ok
+        ok = compare("spectrogram", n_samples, old_spectrogram, stuffr.spectrogram, (x, 1024), run_old) and ok
+        ok = compare("compr", n_samples, old_compr, stuffr.compr, (x, 0.001), run_old) and ok
+        # 1000 ranges of a 10000 long code, the old estimator is single precision
+        Z = numpy.array(z[:((n_samples/10000)*10000)].reshape((-1, 10000)), dtype=numpy.complex64)
+        ok = compare("prc deconvolution", n_samples, old_prc, new_prc, (Z, 0, 10000, 0, 1000), run_old, 1e-4) and ok
+        del x, z, z64, M, M64, Z
+    for n_gates in [int(float(g)) for g in op.gates.split(",")]:
+        ok = compare_fit(n_gates, run_old=not op.no_old, processes=op.processes) and ok
+    if not ok:
+        print("Results differ from the loop versions")
+        exit(1)
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+#
+# Test of pcal_pyramid.py: mean phasors rebuilt from the stored sums must
+# match the raw data, also for windows that do not start on a bin boundary.
+#
+# Writes 2.5 hours of random 100 Hz phasors with a short gap to a temporary
+# directory, builds the pyramid and compares pcal_get_delay.get_range with
+# and without it.
+#
+import digital_rf_hdf5 as drf
+import h5py
+import numpy as n
+import os, shutil, tempfile, time
+import pcal_get_delay
+import pcal_pyramid
+
+sample_rate = 100
+start = long(1448903000*sample_rate + 37)
+n_samples = 900000
+file_samples = 10000
+gap_start = 400000
+gap_len = 250
+
+dirn = tempfile.mkdtemp(prefix="test_pcal_pyramid")
+try:
+    n.random.seed(0)
+    for ch in pcal_pyramid.channels:
+        os.makedirs(os.path.join(dirn, ch))
+        w = drf.write_hdf5_channel(os.path.join(dirn, ch), "d", file_samples, 3600, start, sample_rate,
+                                   "THIS_UUID_LACKS_ENTROPY", 0, False, True, 1, False)
+        for i in range(0, n_samples, file_samples):
+            arr = n.random.randn(file_samples, 2)
+            if i <= gap_start < i + file_samples:
+                # leave a gap, the rest of this block is written after it
+                k = gap_start - i
+                w.rf_write(arr[:k], i)
+                w.rf_write(arr[k:], i + k + gap_len)
+            else:
+                w.rf_write(arr, i + (gap_len if i > gap_start else 0))
+        w.close()
+    # files modified in the last few seconds are considered to be still written
+    time.sleep(4)
+
+    d = drf.read_hdf5(dirn)
+    pyramid_file = pcal_pyramid.default_pyramid_file(dirn)
+    pcal_pyramid.update_pyramid(d, pyramid_file)
+
+    print("Test of pyramid sums against raw sums")
+    # (offset from start, integrate, windows): unaligned starts, integrations that are and are not
+    # multiples of a bin, windows spanning the coarsest level, and windows over the gap
+    cases = [(0, 100, 50), (12345, 100, 200), (12345, 1050, 300), (4321, 25000, 20),
+             (98765, 300000, 2), (gap_start - 5000, 1000, 20), (gap_start - 12345, 12000, 3)]
+    for offset, integrate, n_windows in cases:
+        t0 = (start + offset)/float(sample_rate)
+        t1 = t0 + integrate*n_windows/float(sample_rate)
+        res = pcal_pyramid.read_pyramid(pyramid_file, start + offset, integrate, n_windows, d)
+        if res is None or len(res[0]) != n_windows:
+            raise ValueError, "pyramid does not cover %i windows of %i samples at offset %i" % \
+                (n_windows, integrate, offset)
+        tvec, z0, z1 = pcal_get_delay.get_range(d, t0, t1, integrate, pyramid_file)
+        rtvec, rz0, rz1 = pcal_get_delay.get_range(d, t0, t1, integrate)
+        for z, rz in ((z0, rz0), (z1, rz1)):
+            if len(z) != len(rz) or not n.all(n.isnan(z) == n.isnan(rz)):
+                raise ValueError, "missing windows of %i samples at offset %i differ" % (integrate, offset)
+            good = n.logical_not(n.isnan(rz))
+            if not n.allclose(z[good], rz[good], rtol=1e-9, atol=1e-12):
+                raise ValueError, "pyramid sums of %i samples at offset %i differ from raw sums" % \
+                    (integrate, offset)
+    # the gap makes some windows incomplete
+    if not n.any(n.isnan(z0)):
+        raise ValueError, "no incomplete window over the gap"
+
+    # aligned windows do not need the raw data
+    res = pcal_pyramid.read_pyramid(pyramid_file, (start/1000 + 1)*1000, 1000, 10)
+    if res is None or len(res[0]) != 10:
+        raise ValueError, "aligned windows not read without raw data"
+    if pcal_pyramid.read_pyramid(pyramid_file, start + 12345, 1000, 10) is not None:
+        raise ValueError, "unaligned windows read without raw data"
+
+    print("Test of an interrupted pyramid update")
+    # windows up to the end of the data
+    t0 = (start + n_samples + gap_len - 20000 - 37)/float(sample_rate)
+    t1 = t0 + 1000*20/float(sample_rate)
+    tvec, z0, z1 = pcal_get_delay.get_range(d, t0, t1, 1000, pyramid_file)
+    # as if the update stopped after writing z0 of the finest level
+    f = h5py.File(pyramid_file, "a")
+    g = f["level_%d"%(pcal_pyramid.levels[0])]
+    n_bins = g["z0"].shape[0]
+    g["z0"].resize((n_bins + 10,))
+    g["z0"][n_bins:] = 1e9*n.ones(10, dtype=n.complex128)
+    f.close()
+    tvec, iz0, iz1 = pcal_get_delay.get_range(d, t0, t1, 1000, pyramid_file)
+    good = n.logical_not(n.isnan(z0))
+    if not n.array_equal(n.isnan(iz0), n.isnan(z0)) or not n.allclose(iz0[good], z0[good]):
+        raise ValueError, "bins of an interrupted update are used"
+    pcal_pyramid.update_pyramid(d, pyramid_file)
+    f = h5py.File(pyramid_file, "r")
+    g = f["level_%d"%(pcal_pyramid.levels[0])]
+    lens = [g[name].shape[0] for name in ("z0", "n0", "z1", "n1")]
+    f.close()
+    if lens != [n_bins]*4:
+        raise ValueError, "bins of an interrupted update not dropped"
+finally:
+    shutil.rmtree(dirn)
+
+print("Overall test passed")